@@ -8,9 +8,62 @@ Parameters:
 --connection    Location of the configuration file for establishing XNAT connection.
 --params        Location of the configuration file for the variables in the .param files.
 --tags          Location of the configuration file for the tags.
+--schema-cache  Directory of the cache of the classes that xnatpy generates from the XSD schemas of XNAT, for
+                example QIBschemas. Without it the classes are generated on every run. Only used with
+                xnatpy 0.3.20 up to 0.4, the directory must only be writable by the user that runs the export.
+--workers       Number of threads that retrieve the data from XNAT, default 1.
+--retrieval     bulk (default) to find the QIB experiments with one project listing, crawl to list the experiments per subject.
+--engine        xnatpy (default) to read the QIB sessions with the xnatpy objects, rest to download the XML of every
+                session with one request and parse it without the xnatpy objects.
+--cache-dir     Directory of the session cache, default QIBcache.
+--cache-size    Maximum size of the session cache in MB, default 1024.
+--no-cache      Always download all the sessions from XNAT.
+--incremental   Location of the state file for an incremental export. QIB experiments that did not change
+                since the last run are not downloaded again.
+--delta         Only write the new or changed subjects, instead of all the subjects.
+--format        Output formats, one or more of tsv (default, the TranSMART files), parquet and feather
+                (a biomarker table with a typed column per concept, needs pyarrow) and database (the staging
+                tables of the tranSMART database, see --database).
+--database      libpq connection string of the tranSMART PostgreSQL database of --format database, for example
+                "host=localhost dbname=transmart user=tm_cz", or sqlite:FILE for a SQLite database. The observations,
+                the column map and the tags of the study are replaced in one transaction after the harvest.
+--precision     Number of decimals of the numbers in the clinical data file, default as they are in XNAT.
+--validate      Check the numbers of all the subjects for NaN and infinite values, the files are not written when
+                a problem is found.
+--value-range   MIN MAX, also check that all the numbers are in this range, implies --validate.
+--timeout       Seconds to wait for an answer of XNAT, default 60.
+--retries       Number of retries of a XNAT request after a connection error or a 5xx status, default 3.
+--backoff       Seconds before the first retry, doubled for every next retry, default 0.5.
+--checkpoint    Location of the checkpoint of the harvest, default QIBcheckpoint.db. It is removed after the files are written.
+                With --shard it gets the study and the shard in its name, QIBcheckpoint_(STUDY_ID)_(i)_of_(N).db.
+--checkpoint-interval   Number of subjects between two saves of the checkpoint, default 100.
+--resume        Continue the harvest of a run that did not finish from its checkpoint, instead of starting again.
+--subjects-file Location of a file with the labels of the subjects to export, one per line.
+--since         Only export the QIB sessions that were added or changed since this date, YYYY-MM-DD[ HH:MM:SS].
+--analysis-tool Only export the QIB sessions of this analysis tool, its name or its name and version separated by a space.
+--label-pattern Only export the QIB sessions with a label that matches this regular expression.
+                The filters are applied to the XNAT listings, the sessions that are left out are not downloaded.
+--shard         i/N, only export the subjects of shard i of N, by a hash of the subject label. The partial output is
+                written to (STUDY_ID)_shard_(i)_of_(N).jsonl in the directory of --params, instead of the study directory.
+--merge         The partial outputs of all the shards, they are merged into the study directory without connecting to
+                XNAT. The files are the same as the files of an export without shards.
+--watch         Keep running and export the new and changed QIB sessions, with the --incremental state, to a micro-batch
+                directory batch_(date)_(time)_(number) in the directory path for every change. Implies --delta.
+--poll-interval Seconds between two listings of the QIB experiments of the project, default 60.
+--debounce      Seconds the listing should not change before a micro-batch is exported, default 30.
+--webhook       Port on localhost for a webhook of the XNAT event service, a POST to it starts a poll right away.
+--batch         Location of the configuration file with the projects of a batch export, see below. All the projects
+                are exported over one connection, each to its own study directory, and the report gets a summary per project.
+--batch-workers Number of projects of a batch export that are exported at the same time, default 1.
+--report        Location of the JSON report of the run, default QIBreport.json: time per stage, XNAT requests and
+                bytes, peak memory and the p50/p95 download time of the sessions.
+--profile       Location of a cProfile dump of the run, for example for python -m pstats.
 
 Requirements:
 xnatpy      Downloadable here: https://bitbucket.org/bigr_erasmusmc/xnatpy
+requests    Installed with xnatpy.
+pyarrow     Optional, for --format parquet and feather.
+psycopg2    Optional, for --format database with PostgreSQL.
 
 Formats:
 
@@ -37,328 +90,2675 @@ path =
 [Tags]
 Taglist = 
 
+--batch configuration file, a section per XNAT project. SECURITY_REQUIRED and path are optional, by default they are
+taken from the --params file. The project of the --connection file is not used and can be left out.
+
+[(XNAT project)]
+STUDY_ID =
+SECURITY_REQUIRED =
+TOP_NODE =
+path =
+
 
 """
 
 
-import argparse
-import os
-import sys
-import logging
-if sys.version_info.major == 3:
-    import configparser as ConfigParser
-elif sys.version_info.major == 2:
-    import ConfigParser
-import xnat
+import argparse
+import array
+import collections
+import contextlib
+import copy
+import cProfile
+import hashlib
+import heapq
+import io
+import itertools
+import json
+import math
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import sys
+import logging
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+from xml.etree import ElementTree
+try:
+    import resource
+except ImportError:
+    resource = None
+if sys.version_info.major == 3:
+    import configparser as ConfigParser
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+elif sys.version_info.major == 2:
+    import ConfigParser
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+import requests.adapters
+from requests.packages.urllib3.util.retry import Retry
+import xnat
+try:
+    import pyarrow
+    import pyarrow.feather
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+try:
+    import psycopg2
+    import psycopg2.extras
+except ImportError:
+    psycopg2 = None
+
+#Columns of the XNAT experiment listings, last_modified is used to see if a cached session is still valid.
+EXPERIMENT_COLUMNS = 'ID,label,last_modified'
+#Default maximum size of the session cache in MB.
+DEFAULT_CACHE_SIZE = 1024
+#Number of bytes at the start of the subject log that are used to see if the log was replaced.
+LOG_HEAD_SIZE = 1024
+#Defaults of --timeout (seconds), --retries and --backoff (seconds) of the XNAT requests.
+DEFAULT_TIMEOUT = 60.0
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.5
+#Default number of subjects between two saves of the --checkpoint.
+DEFAULT_CHECKPOINT_INTERVAL = 100
+#HTTP status codes of XNAT that are retried, with --retries.
+RETRY_STATUS_CODES = (500, 502, 503, 504)
+#Lock of the subject log, that is shared by the projects of a --batch export.
+SUBJECT_LOG_LOCK = threading.Lock()
+#Output formats of --format, parquet and feather need pyarrow, database needs psycopg2 for PostgreSQL.
+OUTPUT_FORMATS = ("tsv", "parquet", "feather", "database")
+#XNAT datatype of the QIB sessions and its analysis tool columns, which are listed for --analysis-tool.
+QIB_XSI_TYPE = 'qib:qibSessionData'
+ANALYSIS_TOOL_COLUMNS = 'qib:qibSessionData/analysis_tool,qib:qibSessionData/analysis_tool_version'
+#Number of sessions per worker that are downloaded ahead of the subject that is harvested.
+PREFETCH_PER_WORKER = 4
+#Formats of the date of --since.
+SINCE_FORMATS = ("%Y-%m-%d", "%Y-%m-%d %H:%M:%S")
+#Engines of --engine that read the QIB sessions, with the xnatpy objects or from the XML of the XNAT REST API.
+ENGINES = ("xnatpy", "rest")
+#Staging tables of --format database and their columns, in the tm_lz schema of tranSMART on PostgreSQL.
+#The clinical data table is the landing zone table of tranSMART, the column map and tag tables hold the
+#(STUDY_ID)_columns.txt and tags.txt files.
+DATABASE_SCHEMA = "tm_lz"
+DATABASE_TABLES = collections.OrderedDict([
+    ("lt_src_clinical_data", ("study_id", "site_id", "subject_id", "visit_name", "data_label", "data_value", "category_cd")),
+    ("lt_src_column_map", ("study_id", "category_cd", "column_number", "data_label")),
+    ("lt_src_tags", ("study_id", "concept_path", "title", "description", "weight"))])
+#Number of rows that are sent to the database per executemany.
+DATABASE_BATCH_SIZE = 10000
+#Defaults of --poll-interval and --debounce of --watch, in seconds.
+DEFAULT_POLL_INTERVAL = 60.0
+DEFAULT_DEBOUNCE = 30.0
+
+def main(args):
+    """
+    Function: Call all the methods, passing along all the needed variables.
+              The configuration files are read once, before the connection is made.
+    Parameters:
+        -args   ArgumentParser      Contains the location of the configuration files.
+    """
+
+    #Maybe create a liberary of this script and a seperate one as running script.
+    logging.info("Start.")
+    run_stats.reset()
+    config = QIBConfig(args)
+    #Run as script the ontology and accession identifier tags of the concepts are written, see retrieveQIB.
+    config.concept_tags = getattr(args, "concept_tags", True)
+
+    if config.merge:
+        try:
+            merge_shards(config)
+        except ValueError as e:
+            logging.critical(e)
+            print(str(e) + "\nExit")
+            sys.exit()
+        if config.report:
+            run_stats.write(config.report)
+        logging.info("Exit.")
+        return
+
+    print('Establishing connection\n')
+    project, connection = make_connection(config)
+    request_counter = RequestCounter(connection)
+
+    def write_report(summaries):
+        if config.report:
+            run_stats.write(config.report, request_counter, summaries if config.batch else None,
+                            summaries if config.watch else None)
+
+    if config.batch:
+        summaries = export_batch(connection, config)
+    elif config.watch:
+        summaries = watch(project, config, on_batch=write_report)
+    else:
+        summaries = [export_project(project, config)]
+    logging.info("Data obtained from XNAT and written to files.")
+
+    request_counter.log()
+    if run_stats.failed_subjects:
+        print("%d subjects skipped because of errors, see the log.\n" % len(run_stats.failed_subjects))
+    if config.report:
+        write_report(summaries)
+        logging.info("Run report written to " + config.report + ".")
+    connection.disconnect()
+    logging.info("Exit.")
+
+
+def export_project(project, args):
+    """
+    Function: Export a XNAT project to the study directory of the configuration, in every --format.
+
+    Parameters:
+        - project   xnatpy object   Xnat connection to a specific project.
+        - args      QIBConfig       Settings of the run, or of the study in a --batch export.
+
+    Returns:
+        - summary   Dict            project, study_id, path, subjects (number of subjects written), columns and seconds.
+    """
+    config = as_config(args)
+    summary = {'project': config.project, 'study_id': config.study_id, 'subjects': 0}
+    start = time.time()
+
+    state = None
+    if config.incremental:
+        state = ExportState(config.incremental)
+
+    if config.shard:
+        print('Obtaining data from XNAT and writing the shard\n')
+        data_header_list = []
+        tag_registry = TagRegistry()
+        summary['path'] = shard_file_name(config, config.shard[0])
+        summary['subjects'] = write_shard(summary['path'], harvest(project, tag_registry, config, data_header_list,
+                                                                   state, positions=True),
+                                          data_header_list, tag_registry, config)
+    else:
+        print('Creating directory structure\n')
+        summary['path'] = create_dir(config)
+
+        print('Obtaining data from XNAT and writing it to files\n')
+        data_header_list = []
+        tag_registry = write_export(config, summary, lambda tag_registry: harvest(project, tag_registry, config,
+                                                                                  data_header_list, state),
+                                    data_header_list)
+
+    if state is not None:
+        state.save()
+        logging.info("Export state saved.")
+    remove_checkpoint(config)
+    summary['columns'] = max(len(data_header_list) - 1, 0)
+    summary['seconds'] = time.time() - start
+    return summary
+
+
+def write_export(config, summary, obtain_rows, data_header_list):
+    """
+    Function: Write the study directory in every --format.
+
+    Parameters:
+        - config            QIBConfig       Settings of the run.
+        - summary           Dict            Summary of the export, the number of subjects is counted in it.
+        - obtain_rows       Function        Gets the TagRegistry of the tag file and returns the rows, see harvest.
+        - data_header_list  List            List the headers are added to by the rows.
+
+    Returns:
+        - tag_registry      TagRegistry     The metadata tags that were written.
+    """
+    print('Write headers\n')
+    writers = [make_writer(output_format, summary['path'], config) for output_format in config.formats]
+    tag_files = [writer.tag_file for writer in writers if writer.tag_file is not None]
+    tag_registry = TagRegistry(tag_files[0] if tag_files else None)
+
+    value_check = ValueCheck(config.value_range) if config.validate else None
+
+    def counted_rows(data_list):
+        for data_row_dict in data_list:
+            summary['subjects'] += 1
+            if value_check is not None:
+                value_check.add(data_row_dict)
+            yield data_row_dict
+        #The writers spool the rows until the harvest is finished, so nothing is written yet when the values are invalid.
+        if value_check is not None and not check_values(value_check.problems):
+            raise ValueError("Invalid values found, see the log.")
+
+    data_list = counted_rows(obtain_rows(tag_registry))
+    try:
+        if not (len(writers) == 1 and writers[0].streaming):
+            #The columnar writers need all the subjects, the harvest is stored once and given to every writer.
+            store = ColumnStore()
+            for data_row_dict in data_list:
+                store.append(data_row_dict)
+            data_list = store
+        for writer in writers:
+            writer.write(data_list, data_header_list, tag_registry)
+            writer.close()
+    except ValueError:
+        if value_check is None or not value_check.problems or config.batch or config.watch:
+            raise
+        print("Invalid values found, see the log.\nExit")
+        sys.exit()
+    return tag_registry
+
+
+def shard_file_name(config, shard):
+    """
+    Function: Get the location of the partial output of a shard, (STUDY_ID)_shard_(i)_of_(N).jsonl in the directory path.
+    """
+    return os.path.join(config.base_path, "%s_shard_%d_of_%d.jsonl" % (config.study_id, shard, config.shard[1]))
+
+
+def write_shard(file_name, rows, data_header_list, tag_registry, config):
+    """
+    Function: Write the partial output of a --shard export, a JSON lines file. The first line holds the project, the
+              study and the shard, the other lines a subject each, in the order of the subject listing: its position
+              in the listing, its row, and the headers and metadata tags that were new in this shard at this subject.
+              A header or tag is always new in the shard of the first subject that has it, so merge_shards can
+              register them in the same order as an export without shards. Every tag also has the header it was
+              written together with, see writeOntologyTag, or None. Those tags are only written for the first subject
+              of all the shards that has the header, another shard can have them with the values of a later subject.
+
+    Parameters:
+        - file_name         String          Location of the partial output.
+        - rows              Generator       (position, data_row_dict) per subject, see harvest.
+        - data_header_list  List            List the headers are added to by the rows.
+        - tag_registry      TagRegistry     Registry the metadata tags are added to by the rows.
+        - config            QIBConfig       Settings of the run.
+
+    Returns:
+        - subjects          Int             Number of subjects that were written.
+    """
+    if not os.path.exists(os.path.dirname(file_name) or "."):
+        os.makedirs(os.path.dirname(file_name))
+    subjects = 0
+    header_count = 0
+    tag_count = 0
+    with open(file_name + '.tmp', 'w') as shard_file:
+        shard_file.write(json.dumps({'project': config.project, 'study_id': config.study_id,
+                                     'shard': config.shard[0], 'shards': config.shard[1]}) + '\n')
+        for position, data_row_dict in rows:
+            with run_stats.stage("write_data"):
+                headers = data_header_list[header_count:]
+                new_headers = set(headers)
+                tags = [(concept_key, tag, value, weight, concept_key if concept_key in new_headers else None)
+                        for concept_key, tag, value, weight in tag_registry.entries[tag_count:]]
+                shard_file.write(json.dumps({'position': position, 'row': dump_row(data_row_dict),
+                                             'headers': headers, 'tags': tags}, default=str) + '\n')
+                header_count = len(data_header_list)
+                tag_count = len(tag_registry.entries)
+                subjects += 1
+    if os.path.exists(file_name):
+        os.remove(file_name)
+    os.rename(file_name + '.tmp', file_name)
+    return subjects
+
+
+def merge_shards(args):
+    """
+    Function: Merge the partial outputs of all the shards of a --shard export, the --merge files, into the study directory
+              of the configuration, in every --format. The files are the same as the files of an export without shards.
+
+    Parameters:
+        - args      QIBConfig       Settings of the run.
+
+    Returns:
+        - summary   Dict            project, study_id, path, subjects (number of subjects written), columns and seconds.
+    """
+    config = as_config(args)
+    start = time.time()
+    shard_files = [open(file_name, 'r') for file_name in config.merge]
+    try:
+        shards = [json.loads(shard_file.readline()) for shard_file in shard_files]
+        shard_count = shards[0]['shards']
+        if sorted(shard['shard'] for shard in shards) != list(range(1, shard_count + 1)) or \
+                any(shard['shards'] != shard_count or shard['project'] != shards[0]['project'] for shard in shards):
+            raise ValueError("--merge needs the partial output of every shard of one export, 1 to %d." % shard_count)
+        summary = {'project': shards[0]['project'], 'study_id': config.study_id, 'subjects': 0}
+
+        print('Creating directory structure\n')
+        summary['path'] = create_dir(config)
+
+        print('Merging the shards and writing them to files\n')
+        data_header_list = []
+        write_export(config, summary, lambda tag_registry: merged_rows(shard_files, data_header_list, tag_registry),
+                     data_header_list)
+    finally:
+        for shard_file in shard_files:
+            shard_file.close()
+    summary['columns'] = max(len(data_header_list) - 1, 0)
+    summary['seconds'] = time.time() - start
+    return summary
+
+
+def merged_rows(shard_files, data_header_list, tag_registry):
+    """
+    Function: Generator that merges the subjects of the shards in the order of the subject listing, and registers their
+              headers and metadata tags before the subject is yielded, like harvest does. The tags that were written
+              together with a header are only registered when the header is new in the merge.
+
+    Parameters:
+        - shard_files       List            The partial outputs, after their first line, see write_shard.
+        - data_header_list  List            List the headers are added to.
+        - tag_registry      TagRegistry     Registry the metadata tags are added to.
+
+    Yields:
+        - data_row_dict     Dict            Dict per subject, key = header, value = value.
+    """
+    header_registry = OrderedRegistry(data_header_list)
+    subjects = heapq.merge(*[((record['position'], shard_index, record) for record in (json.loads(line) for line in shard_file))
+                             for shard_index, shard_file in enumerate(shard_files)])
+    for position, shard_index, record in subjects:
+        new_headers = set(header for header in record['headers'] if header_registry.add(header))
+        for concept_key, tag, value, weight, header in record['tags']:
+            if header is None or header in new_headers:
+                tag_registry.add(concept_key, tag, value, weight)
+        yield load_row(record['row'])
+
+
+def export_batch(connection, args):
+    """
+    Function: Export all the projects of the --batch file over one XNAT connection, --batch-workers projects at a time.
+              A project that fails is logged and the other projects are exported.
+
+    Parameters:
+        - connection    xnatpy object   Connection to XNAT.
+        - args          QIBConfig       Settings of the run.
+
+    Returns:
+        - summaries     List            Summary per project, see export_project, in the order of the --batch file.
+                                        The summary of a project that failed has the error instead.
+    """
+    config = as_config(args)
+
+    def export(study_config):
+        start = time.time()
+        summary = isolate(lambda: export_project(connection.projects[study_config.project], study_config))
+        if isinstance(summary, Exception):
+            logging.error("Export of project " + study_config.project + " failed: " + repr(summary))
+            summary = {'project': study_config.project, 'study_id': study_config.study_id, 'error': repr(summary),
+                       'seconds': time.time() - start}
+        return summary
+
+    study_configs = [config.for_study(study) for study in config.studies]
+    pool = ThreadPool(config.batch_workers) if config.batch_workers > 1 else None
+    try:
+        summaries = list(map_work(pool, export, study_configs))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    for summary in summaries:
+        if 'error' in summary:
+            message = "Project %s (%s): failed, %s" % (summary['project'], summary['study_id'], summary['error'])
+        else:
+            message = "Project %s (%s): %d subjects, %d columns, %.2f s" % (
+                summary['project'], summary['study_id'], summary['subjects'], summary['columns'], summary['seconds'])
+        print(message)
+        logging.info(message)
+    return summaries
+
+
+def watch(project, args, wake=None, stop=None, on_batch=None):
+    """
+    Function: Keep exporting the new and changed QIB sessions of the project over the open connection, until stop is
+              set or the run is interrupted. Every --poll-interval seconds, or when the --webhook is called, the QIB
+              experiments of the project are listed with their last modified date. When they changed since the last
+              export, and did not change for --debounce seconds, the new and changed subjects are exported with the
+              --incremental state to a micro-batch directory, see export_micro_batch. An export that fails is logged
+              and tried again at the next poll.
+
+    Parameters:
+        - project       xnatpy object   Xnat connection to a specific project.
+        - args          QIBConfig       Settings of the run.
+        - wake          Event           Event that starts a poll before the --poll-interval is over.
+        - stop          Event           Event that stops the watch, it should be set together with wake.
+        - on_batch      Function        Called with the summaries after every micro-batch.
+
+    Returns:
+        - summaries     List            Summary per micro-batch, see export_project.
+    """
+    config = as_config(args)
+    wake = wake if wake is not None else threading.Event()
+    stop = stop if stop is not None else threading.Event()
+    webhook = start_webhook(config.webhook, wake) if config.webhook is not None else None
+    summaries = []
+    exported_signature = None
+    listed_signature = None
+    changed_time = None
+    print("Watching project " + project.id + " for new QIB sessions\n")
+    try:
+        while not stop.is_set():
+            with run_stats.stage("watch_poll"):
+                signature = isolate(experiment_signature, project, config)
+            wait = config.poll_interval
+            if isinstance(signature, Exception):
+                logging.error("Listing of the QIB experiments failed: " + repr(signature))
+            else:
+                now = time.time()
+                if signature != listed_signature:
+                    listed_signature = signature
+                    changed_time = now
+                if signature != exported_signature and now - changed_time >= config.debounce:
+                    summary = isolate(export_micro_batch, project, config, len(summaries) + 1)
+                    if isinstance(summary, Exception):
+                        logging.error("Export of a micro-batch failed: " + repr(summary))
+                    else:
+                        exported_signature = signature
+                        if summary['subjects']:
+                            summaries.append(summary)
+                            if on_batch is not None:
+                                on_batch(summaries)
+                elif signature != exported_signature:
+                    wait = min(wait, changed_time + config.debounce - now)
+            wake.wait(wait)
+            wake.clear()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if webhook is not None:
+            webhook.shutdown()
+            webhook.server_close()
+    logging.info("Watch stopped after %d micro-batches." % len(summaries))
+    return summaries
+
+
+def experiment_signature(project, config):
+    """
+    Function: List the QIB experiments of the project that pass the filters of the configuration.
+
+    Returns:
+        - signature     Dict            key = experiment ID, value = last modified date of the experiment.
+    """
+    return dict((experiment['ID'], experiment.get('last_modified'))
+                for experiments in list_project_qib_experiments(project, config).values()
+                for experiment in experiments if experiment_selected(experiment, config))
+
+
+def export_micro_batch(project, args, batch_number):
+    """
+    Function: Export the new and changed subjects since the --incremental state to a micro-batch directory,
+              batch_(date)_(time)_(number) in the directory path, that holds a study directory with only these
+              subjects. A micro-batch without subjects is removed.
+
+    Returns:
+        - summary       Dict            Summary of the export, see export_project.
+    """
+    config = copy.copy(as_config(args))
+    config.base_path = os.path.join(config.base_path, "batch_%s_%d" % (time.strftime("%Y%m%d_%H%M%S"), batch_number)) + "/"
+    summary = export_project(project, config)
+    if summary['subjects']:
+        message = "Micro-batch %s: %d subjects" % (config.base_path, summary['subjects'])
+        print(message)
+        logging.info(message)
+    elif os.path.exists(config.base_path):
+        shutil.rmtree(config.base_path)
+    return summary
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """
+    Function: Handler of the --webhook, a POST from the event service of XNAT starts a poll of the listing.
+              The body of the request is not used, the poll finds what changed.
+    """
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        logging.info("Webhook called, polling XNAT.")
+        self.server.wake.set()
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_webhook(port, wake):
+    """
+    Function: Start the --webhook server on localhost in a background thread.
+
+    Parameters:
+        - port          Int             Port of the server, 0 for any free port.
+        - wake          Event           Event that is set when the webhook is called.
+
+    Returns:
+        - server        HTTPServer      The server, server_address has the port.
+    """
+    server = HTTPServer(("127.0.0.1", port), WebhookHandler)
+    server.wake = wake
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def make_connection(args):
+    """
+    Function: Create the connection to XNAT.
+    Returns: 
+        -project    xnatpy object   Xnat connection to a specific project.
+    """
+    config = as_config(args)
+
+    try:
+        with run_stats.stage("make_connection"):
+            connection = connect_xnat(config)
+            project = connection.projects[config.project] if config.project is not None else None
+        logging.info("Connection established.")
+        return project, connection
+
+    except KeyError:
+        print("Project not found in XNAT.\nExit")
+        logging.critical("Project not found in XNAT.")
+        if __name__ == "__main__":
+            sys.exit()
+        else:
+            return None, None
+
+    except Exception as e:
+        print(str(e) + "\nExit")
+        if __name__ == "__main__":
+            logging.critical(str(e))
+            sys.exit()
+        else:
+            return e, None
+
+
+def tune_session(session, args):
+    """
+    Function: Set up the HTTP connection pool of the requests session of a XNAT connection. The pool keeps a
+              connection to XNAT open for every worker, so the connections are reused (keep-alive) instead of
+              opened again for every request. Requests that get no answer within --timeout seconds fail, and
+              failed connections and the status codes in RETRY_STATUS_CODES are retried --retries times,
+              with exponential backoff starting at --backoff seconds.
+
+    Parameters:
+        - session   requests.Session    Session of the XNAT connection, connection.interface in xnatpy.
+        - args      QIBConfig           Settings of the run.
+    """
+    config = as_config(args)
+    retry = Retry(total=config.retries, connect=config.retries, read=config.retries, status=config.retries,
+                  backoff_factor=config.backoff, status_forcelist=RETRY_STATUS_CODES, raise_on_status=False)
+    adapter = TimeoutHTTPAdapter(config.timeout, pool_connections=1, pool_maxsize=max(config.workers, 10),
+                                 max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+
+def connect_xnat(config):
+    """
+    Function: Connect to XNAT and tune its HTTP session, see tune_session. xnatpy downloads the XSD schemas of the server
+              and generates its classes from them on every connect. With --schema-cache the generated classes are
+              loaded from the cache when the server and its schemas did not change, see SchemaCache. An xnatpy that
+              can not connect without building the classes (no_parse_model), that is not a version of
+              XNATPY_MODEL_VERSIONS or that misses one of the private functions of XNATPY_MODEL_NAMES, connects
+              without the cache.
+
+    Returns:
+        - connection    XNATSession     Xnat connection.
+    """
+    if config.schema_cache and has_model_api():
+        try:
+            connection = xnat.connect(config.url, user=config.user, password=config.password, no_parse_model=True)
+        except TypeError:
+            connection = None
+        if connection is not None and hasattr(connection, "XNAT_CLASS_LOOKUP"):
+            tune_session(connection.interface, config)
+            try:
+                SchemaCache(config.schema_cache).build_model(connection, config.url)
+                return connection
+            except AttributeError as e:
+                logging.warning("Schema cache not used, xnatpy is not compatible: " + str(e))
+        if connection is not None:
+            connection.disconnect()
+    connection = xnat.connect(config.url, user=config.user, password=config.password)
+    tune_session(connection.interface, config)
+    return connection
+
+
+XNATPY_MODEL_NAMES = ("build_model", "parse_schemas_16", "parse_schemas_17", "convert_xsd.SchemaParser.parse_schema_xmlstring",
+                      "convert_xsd.SchemaParser.find_schema_uris", "convert_xsd.SchemaParser.write")
+#The versions of xnatpy of which SchemaCache is known to work with the private functions, from (included) and to (excluded).
+XNATPY_MODEL_VERSIONS = ((0, 3, 20), (0, 4, 0))
+
+
+def xnatpy_version():
+    """
+    Function: Get the version of xnatpy as a tuple of numbers, like (0, 3, 20) for 0.3.20.
+
+    Returns:
+        - version       Tuple       The numbers of the version, None when xnatpy has no version number.
+    """
+    match = re.match(r'(\d+)\.(\d+)(?:\.(\d+))?', str(getattr(xnat, "__version__", "")))
+    if match is None:
+        return None
+    return tuple(int(number or 0) for number in match.groups())
+
+
+def has_model_api():
+    """
+    Function: Check that xnatpy has the functions that SchemaCache uses to do the same as xnat.build_model. They are
+              not part of the public API of xnatpy and may change or disappear in another version, the names do not
+              say whether their arguments are the same, so the version of xnatpy is checked as well.
+
+    Returns:
+        - found         Boolean     True when the version of xnatpy is in XNATPY_MODEL_VERSIONS and all names of
+                                    XNATPY_MODEL_NAMES are found in xnatpy.
+    """
+    version = xnatpy_version()
+    if version is None or not XNATPY_MODEL_VERSIONS[0] <= version < XNATPY_MODEL_VERSIONS[1]:
+        logging.info("Schema cache not used, xnatpy " + str(getattr(xnat, "__version__", None)) + " is not a supported version.")
+        return False
+    for name in XNATPY_MODEL_NAMES:
+        target = xnat
+        for part in name.split('.'):
+            target = getattr(target, part, None)
+            if target is None:
+                return False
+    return True
+
+
+class SchemaCache(object):
+    """
+    Function: Disk cache of the classes that xnatpy generates from the XSD schemas of a XNAT server. An entry is the
+              generated code and the names of the classes that are registered, stored under a checksum of the server
+              URL, the xnatpy version and the schemas. A warm start still downloads the schemas for the checksum,
+              but does not parse them or generate the code. build_model does the same as xnat.build_model of xnatpy.
+              Whether the classes came from the cache is added to the report as schema_cache, cold or warm.
+              The cached code is executed on a warm start, so the checksum of the code is stored with it and an
+              entry of which the code does not match is generated again. The checksum is stored in the cache
+              directory itself, so it only detects a damaged entry, not one that was changed on purpose: the cache
+              directory must only be writable by the user that runs the export.
+    Parameters:
+        -cache_dir      String      Directory of the cache, it is created when it does not exist yet.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def key(self, url, schemas):
+        """
+        Function: Make the checksum of an entry.
+
+        Parameters:
+            - url           String      URL of the XNAT server.
+            - schemas       List        Tuple (uri, text) per XSD schema of the server.
+        """
+        checksum = hashlib.sha256()
+        for part in [url.rstrip('/'), str(getattr(xnat, "__version__", ""))] + [part for schema in schemas for part in schema]:
+            checksum.update(part.encode('utf-8') + b'\0')
+        return checksum.hexdigest()
+
+    def get(self, key):
+        """
+        Function: Read an entry, an entry of which the code does not match the stored checksum is not read.
+
+        Returns:
+            - code_file     String      Location of the generated code, None when the entry is not in the cache.
+            - class_names   List        Names of the classes in the code that are registered.
+        """
+        code_file = os.path.join(self.cache_dir, key + '.py')
+        class_file = os.path.join(self.cache_dir, key + '.json')
+        if not (os.path.exists(code_file) and os.path.exists(class_file)):
+            return None, None
+        with open(class_file, 'r') as open_class_file:
+            entry = json.load(open_class_file)
+        with open(code_file, 'rb') as open_code_file:
+            checksum = hashlib.sha256(open_code_file.read()).hexdigest()
+        if not isinstance(entry, dict) or entry.get('sha256') != checksum:
+            logging.warning("Schema cache entry " + code_file + " does not match its checksum, it is generated again.")
+            return None, None
+        return code_file, entry['class_names']
+
+    def put(self, key, code, class_names):
+        """
+        Function: Store an entry with the checksum of the code, the class names are written last so a half written
+                  entry is never read.
+
+        Returns:
+            - code_file     String      Location of the generated code.
+        """
+        code_file = os.path.join(self.cache_dir, key + '.py')
+        class_file = os.path.join(self.cache_dir, key + '.json')
+        if not isinstance(code, bytes):
+            code = code.encode('utf-8')
+        with open(code_file + '.tmp', 'wb') as open_code_file:
+            open_code_file.write(code)
+        os.rename(code_file + '.tmp', code_file)
+        with open(class_file + '.tmp', 'w') as open_class_file:
+            json.dump({'sha256': hashlib.sha256(code).hexdigest(), 'class_names': class_names}, open_class_file)
+        os.rename(class_file + '.tmp', class_file)
+        return code_file
+
+    def build_model(self, xnat_session, url, extension_types=True):
+        """
+        Function: Add the classes of the XNAT data model to a connection that was made with no_parse_model,
+                  from the cache or, when they are not in it, by parsing the schemas with xnatpy.
+
+        Parameters:
+            - xnat_session      XNATSession     Xnat connection without data model.
+            - url               String          URL of the XNAT server.
+            - extension_types   Boolean         Also use the schemas of the extension types, like the QIB datatype.
+        """
+        schemas = download_schemas(xnat_session, extension_types)
+        key = self.key(url, schemas)
+        code_file, class_names = self.get(key)
+        if code_file is None:
+            run_stats.schema_cache = "cold"
+            parser = xnat.convert_xsd.SchemaParser(debug=xnat_session.debug, logger=xnat_session.logger)
+            for schema_uri, text in schemas:
+                parser.parse_schema_xmlstring(text, schema_uri=schema_uri)
+            #The parser writes str, which is bytes on Python 2.
+            code = io.StringIO() if sys.version_info.major == 3 else io.BytesIO()
+            parser.write(code_file=code)
+            class_names = [cls.writer.python_name for cls in parser.class_list.values()
+                           if not (cls.name is None or (cls.base_class is not None and cls.base_class.startswith('xs:')))]
+            code_file = self.put(key, code.getvalue(), class_names)
+        else:
+            run_stats.schema_cache = "warm"
+
+        xnat_module = load_module('xnat_gen_' + key[:16] + '_' + str(id(xnat_session)), code_file)
+        for class_name in class_names:
+            getattr(xnat_module, class_name).__register__(xnat_module.XNAT_CLASS_LOOKUP)
+        xnat_module.SESSION = xnat_session
+        xnat_session.XNAT_CLASS_LOOKUP.update(xnat_module.XNAT_CLASS_LOOKUP)
+        xnat_session.classes = xnat_module
+        xnat_session._source_code_file = code_file
+
+
+def download_schemas(xnat_session, extension_types=True):
+    """
+    Function: Download the XSD schemas that xnatpy parses for the version of the XNAT server.
+
+    Returns:
+        - schemas       List            Tuple (uri, text) per schema, in the order xnatpy parses them.
+    """
+    recorder = SchemaRecorder()
+    if xnat_session.xnat_version.startswith('1.6'):
+        xnat.parse_schemas_16(recorder, xnat_session, extension_types=extension_types)
+    elif xnat_session.xnat_version.startswith('1.7'):
+        xnat.parse_schemas_17(recorder, xnat_session, extension_types=extension_types)
+    else:
+        raise ValueError("Cannot continue on unsupported XNAT version " + str(xnat_session.xnat_version))
+    return recorder.schemas
+
+
+class SchemaRecorder(object):
+    """
+    Function: Stand-in for the schema parser of xnatpy, that only downloads the schemas.
+    """
+
+    def __init__(self):
+        self.schemas = []
+
+    def parse_schema_uri(self, xnat_session, schema_uri):
+        response = xnat_session.get(schema_uri, headers={'Accept-Encoding': None})
+        self.schemas.append((schema_uri, response.text))
+        return True
+
+    def find_schema_uris(self, text):
+        return xnat.convert_xsd.SchemaParser.find_schema_uris(text)
+
+
+def load_module(name, file_name):
+    """
+    Function: Import a Python file as module name.
+    """
+    if sys.version_info.major == 2:
+        import imp
+        return imp.load_source(name, file_name)
+    import importlib.util
+    spec = importlib.util.spec_from_file_location(name, file_name)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+class TimeoutHTTPAdapter(requests.adapters.HTTPAdapter):
+    """
+    Function: HTTPAdapter with a default timeout, requests itself waits forever for an answer.
+    Parameters:
+        -timeout    Float   Seconds to wait for a connection and for an answer, None to wait forever.
+    """
+
+    def __init__(self, timeout, *args, **kwargs):
+        self.timeout = timeout
+        requests.adapters.HTTPAdapter.__init__(self, *args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return requests.adapters.HTTPAdapter.send(self, request, **kwargs)
+
+
+class RequestCounter(object):
+    """
+    Function: Counts the HTTP requests that are done by a XNAT connection, the number of bytes received
+              and the wall time since the counter was made. Used to keep an eye on the number of round-trips to XNAT.
+              The requests that are done while a thread downloads a session (see session_scope) are also counted
+              per session, in session_requests.
+    Parameters:
+        -connection     xnatpy object   Xnat connection, the counter hooks into its requests session.
+    """
+
+    scope = threading.local()
+
+    def __init__(self, connection):
+        self.requests = 0
+        self.bytes = 0
+        self.session_requests = {}
+        self.request_time = 0.0
+        self.start_time = time.time()
+        self.lock = threading.Lock()
+        connection.interface.hooks['response'].append(self.count)
+
+    def count(self, response, *args, **kwargs):
+        content_length = response.headers.get('Content-Length')
+        if content_length is not None:
+            size = int(content_length)
+        else:
+            size = len(response.content)
+        session_id = getattr(RequestCounter.scope, 'session_id', None)
+        with self.lock:
+            self.requests += 1
+            self.bytes += size
+            self.request_time += response.elapsed.total_seconds()
+            if session_id is not None:
+                self.session_requests[session_id] = self.session_requests.get(session_id, 0) + 1
+
+    @classmethod
+    def session_scope(cls, session_id):
+        """
+        Function: Count the requests of the calling thread for session_id, until it is called with None.
+        """
+        cls.scope.session_id = session_id
+
+    def log(self):
+        message = "XNAT requests: %d, bytes received: %d, request time: %.2f s, wall time: %.2f s" % (
+            self.requests, self.bytes, self.request_time, time.time() - self.start_time)
+        if self.session_requests:
+            message += ", sessions downloaded: %d, requests per session: %.1f (max %d)" % (
+                len(self.session_requests), float(sum(self.session_requests.values())) / len(self.session_requests),
+                max(self.session_requests.values()))
+        print(message + "\n")
+        logging.info(message)
+
+
+class RunStats(object):
+    """
+    Function: Timers of the stages of a run, the download time of every session and the peak memory use, written
+              as JSON report at the end of the run. A stage is timed with the stage context manager, its time is
+              summed over all the calls. The stages can run in the worker threads and can contain other stages
+              (obtain_data contains writeMetaData and the wait for fetch_session), so the sum of the stages is not
+              the wall time. The module has one RunStats, run_stats, that is reset at the start of main.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.start_time = time.time()
+        self.stages = {}
+        self.session_times = []
+        self.failed_subjects = []
+        self.schema_cache = "off"
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start)
+
+    def add(self, name, seconds):
+        with self.lock:
+            stage = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0})
+            stage['calls'] += 1
+            stage['seconds'] += seconds
+
+    def add_session(self, seconds):
+        """
+        Function: Register the time it took to download a session from XNAT.
+        """
+        self.add("fetch_session", seconds)
+        with self.lock:
+            self.session_times.append(seconds)
+
+    def add_failure(self, subject_label):
+        """
+        Function: Register a subject that is skipped because its sessions could not be retrieved.
+        """
+        with self.lock:
+            self.failed_subjects.append(subject_label)
+
+    def report(self, request_counter=None, projects=None, micro_batches=None):
+        """
+        Function: Make the report of the run.
+
+        Parameters:
+            - request_counter   RequestCounter  Counter of the XNAT requests of the run, None to leave them out.
+            - projects          List            Summaries of the projects of a --batch export, None to leave them out.
+            - micro_batches     List            Summaries of the micro-batches of --watch, None to leave them out.
+
+        Returns:
+            - report            Dict            wall_seconds, peak_memory_mb, stages, session_latency, failed_subjects,
+                                                schema_cache, http, projects and micro_batches.
+        """
+        session_times = sorted(self.session_times)
+        report = {'wall_seconds': time.time() - self.start_time,
+                  'peak_memory_mb': peak_memory(),
+                  'failed_subjects': list(self.failed_subjects),
+                  'schema_cache': self.schema_cache,
+                  'stages': dict((name, dict(stage)) for name, stage in self.stages.items()),
+                  'session_latency': {'count': len(session_times),
+                                      'p50': percentile(session_times, 0.50),
+                                      'p95': percentile(session_times, 0.95),
+                                      'max': session_times[-1] if session_times else None}}
+        if request_counter is not None:
+            session_requests = list(request_counter.session_requests.values())
+            report['http'] = {'requests': request_counter.requests,
+                              'bytes': request_counter.bytes,
+                              'request_seconds': request_counter.request_time,
+                              'sessions_downloaded': len(session_requests),
+                              'requests_per_session': float(sum(session_requests)) / len(session_requests)
+                              if session_requests else None}
+        if projects is not None:
+            report['projects'] = projects
+        if micro_batches is not None:
+            report['micro_batches'] = micro_batches
+        return report
+
+    def write(self, file_name, request_counter=None, projects=None, micro_batches=None):
+        with open(file_name, 'w') as report_file:
+            json.dump(self.report(request_counter, projects, micro_batches), report_file, indent=2, sort_keys=True)
+
+
+run_stats = RunStats()
+
+
+def percentile(sorted_values, fraction):
+    """
+    Function: Nearest-rank percentile.
+
+    Parameters:
+        - sorted_values     List    The values, sorted.
+        - fraction          Float   The percentile as fraction, 0.95 for the 95th percentile.
+
+    Returns:
+        - value             Float   The percentile, None when there are no values.
+    """
+    if not sorted_values:
+        return None
+    return sorted_values[max(0, int(math.ceil(fraction * len(sorted_values))) - 1)]
+
+
+def peak_memory():
+    """
+    Function: Peak memory use of the process.
+
+    Returns:
+        - peak      Float   Peak resident set size in MB, None when it can not be measured on this platform.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #ru_maxrss is in bytes on macOS and in KiB on Linux.
+    if sys.platform == "darwin":
+        return peak / 1e6
+    return peak * 1024 / 1e6
+
+
+def create_dir(args):
+    """
+    Function: Create the directory structure.
+    Returns: 
+        -new_path    String   Path to the directory where all the files will be saved.
+    """
+    config = as_config(args)
+    path = config.base_path + config.study_id
+    #Test if the /tags/ and /clinical are also there
+    if not os.path.exists(path):
+        os.makedirs(path)
+        os.makedirs(path + "/tags/")
+        os.makedirs(path + "/clinical/")
+    return path
+
+
+def write_params(path, args):
+    """
+    Function: Uses the configuration files to write the .params files.
+    Parameters:
+        -path   String  Path to the directory where all the files will be saved.
+    """
+    config = as_config(args)
+    tag_param_file = open(path + '/tags/tags.params', 'w')
+    tag_param_file.write("TAGS_FILE=tags.txt")
+    study_param_file = open(path + '/study.params', 'w')
+    study_param_file.write("STUDY_ID=" + config.study_id +
+                     "\nSECURITY_REQUIRED=" + config.security_required +
+                     "\nTOP_NODE=" + config.top_node)
+    clinical_param_file = open(path + '/clinical/clinical.params', 'w')
+    clinical_param_file.write("COLUMN_MAP_FILE=" + str(config.study_id) + "_columns.txt")
+    tag_param_file.close()
+    study_param_file.close()
+    clinical_param_file.close()
+
+
+def write_headers(path, args):
+    """
+    Function: Uses the configuration files to write the headers of the .txt files. 
+    Parameters:
+        -path   String  Path to the directory where all the files will be saved.
+    Returns:
+        -tag_file        File    tags.txt, used to upload the metadata into TranSMART.
+        -data_file       File    (STUDY_ID)_clinical.txt, used to upload the clinical data into TranSMART.
+        -concept_file    File    (STUDY_ID)_columns.txt, used to determine which values are in which columns for uploading to TranSMART.
+    """
+    config = as_config(args)
+    data_file = open(path + '/clinical/' + config.study_id + '_clinical.txt', 'w')
+    concept_file = open(path + '/clinical/' + config.study_id + '_columns.txt', 'w')
+    tag_file = open(path + '/tags/tags.txt', 'w')
+    #Hardcoded right now, because transmart does not need other headers. But this can be subject to change.
+    concept_headers = ['Filename', 'Category Code', 'Column Number', 'Data Label']
+    tag_headers = ['Concept Path', 'Title', 'Description', 'Weight']
+    concept_file.write("\t".join(concept_headers) + '\n')
+    tag_file.write("\t".join(tag_headers) + "\n")
+    tag_file.flush()
+    data_file.flush()
+    concept_file.flush()
+    return tag_file, data_file, concept_file
+
+
+class ValueCheck(object):
+    """
+    Function: Count the NaN, infinite and out of range numbers of every column while the subject rows are harvested,
+              the same as ColumnStore.validate, without keeping the rows.
+
+    Parameters:
+        - value_range   Tuple   (minimum, maximum) of the values, None to only look for NaN and infinite values.
+    """
+
+    def __init__(self, value_range=None):
+        self.value_range = value_range
+        self.problems = {}
+
+    def add(self, data_row_dict):
+        """
+        Function: Check the numbers of the row of a subject.
+        """
+        for concept_key, value in data_row_dict.items():
+            if not isinstance(value, float):
+                continue
+            names = []
+            if math.isnan(value):
+                names.append('nan')
+            if math.isinf(value):
+                names.append('infinite')
+            if self.value_range is not None and (value < self.value_range[0] or value > self.value_range[1]):
+                names.append('out_of_range')
+            for name in names:
+                counts = self.problems.setdefault(concept_key, {})
+                counts[name] = counts.get(name, 0) + 1
+
+
+def check_values(problems):
+    """
+    Function: Log the columns with problems in the harvested values.
+
+    Parameters:
+        - problems      Dict            The problems per concept key, see ColumnStore.validate and ValueCheck.
+
+    Returns:
+        - valid         Boolean         True when no problems are found.
+    """
+    for concept_key in sorted(problems):
+        logging.error("Invalid values in " + concept_key + ": " +
+                      ", ".join("%d %s" % (count, name) for name, count in sorted(problems[concept_key].items())))
+    return not problems
+
+
+def make_writer(output_format, path, args):
+    """
+    Function: Create the output backend of a --format.
+
+    Parameters:
+        - output_format     String          tsv, parquet or feather.
+        - path              String          Path to the directory where all the files will be saved.
+
+    Returns:
+        - writer            Writer          TranSMARTWriter, ArrowWriter or DatabaseWriter.
+    """
+    config = as_config(args)
+    if output_format == "tsv":
+        return TranSMARTWriter(path, config)
+    if output_format == "database":
+        return DatabaseWriter(config)
+    return ArrowWriter(path, config, output_format)
+
+
+class TranSMARTWriter(object):
+    """
+    Function: Output backend for the tMDataLoader layout of TranSMART. Writes the .params files, tags/tags.txt,
+              clinical/(STUDY_ID)_clinical.txt and clinical/(STUDY_ID)_columns.txt. The rows are written while
+              they are harvested, the tags are written to tag_file by the TagRegistry of the harvest.
+    Parameters:
+        -path   String      Path to the directory where all the files will be saved.
+        -args   QIBConfig   Settings of the run.
+    """
+    streaming = True
+
+    def __init__(self, path, args):
+        write_params(path, args)
+        self.precision = as_config(args).precision
+        self.tag_file, self.data_file, self.concept_file = write_headers(path, args)
+
+    def write(self, data_list, data_header_list, tag_registry):
+        write_data(self.data_file, self.concept_file, data_list, data_header_list, self.precision)
+
+    def close(self):
+        self.tag_file.close()
+        self.concept_file.close()
+
+
+class ArrowWriter(object):
+    """
+    Function: Output backend for the wide biomarker table, (STUDY_ID)_biomarkers.parquet or .feather (Arrow IPC).
+              There is one row per subject and one column per concept key, numeric columns are stored as float64.
+              The concept path, data label and the metadata tags of a concept are stored as column metadata.
+    Parameters:
+        -path           String      Path to the directory where all the files will be saved.
+        -args           QIBConfig   Settings of the run.
+        -file_format    String      parquet or feather.
+    """
+    streaming = False
+    tag_file = None
+
+    def __init__(self, path, args, file_format):
+        config = as_config(args)
+        self.file_format = file_format
+        self.file_name = os.path.join(path, config.study_id + "_biomarkers." + file_format)
+
+    def write(self, store, data_header_list, tag_registry):
+        table = arrow_table(store, data_header_list, tag_registry)
+        if self.file_format == "parquet":
+            pyarrow.parquet.write_table(table, self.file_name)
+        else:
+            pyarrow.feather.write_feather(table, self.file_name)
+
+    def close(self):
+        pass
+
+
+def arrow_table(store, data_header_list, tag_registry):
+    """
+    Function: Convert the harvested data to an Arrow table.
+
+    Parameters:
+        - store             ColumnStore     The harvested subject rows.
+        - data_header_list  List            The headers, in column order.
+        - tag_registry      TagRegistry     The metadata tags of the concepts.
+
+    Returns:
+        - table             pyarrow.Table   One column per header, float64 for numeric and string for other columns.
+    """
+    fields = []
+    columns = []
+    for header in data_header_list:
+        if isinstance(store.columns[store.concept_index[header]], array.array):
+            data_type = pyarrow.float64()
+        else:
+            data_type = pyarrow.string()
+        metadata = None
+        if header != "subject":
+            metadata = {'concept_path': "\\".join(header.split("\\")[:-1]), 'data_label': header.split("\\")[-1]}
+            for tag, value in tag_registry.tags_of(header):
+                metadata[tag] = str(value)
+        values = store.column(header)
+        if data_type == pyarrow.string():
+            values = [None if value is None else format_value(value) for value in values]
+        fields.append(pyarrow.field(header, data_type, metadata=metadata))
+        columns.append(pyarrow.array(values, type=data_type))
+    return pyarrow.Table.from_arrays(columns, schema=pyarrow.schema(fields))
+
+
+class DatabaseWriter(object):
+    """
+    Function: Output backend that loads the harvest straight into the staging tables of the tranSMART database,
+              see DATABASE_TABLES, instead of writing files that tMDataLoader reads again. There is one row per
+              observation in lt_src_clinical_data, the empty cells are left out. The rows are spooled to a
+              temporary file while they are harvested. When the harvest is finished the rows of the study are
+              replaced in one short transaction, in batches of DATABASE_BATCH_SIZE, so the tables are not locked
+              during the harvest and never hold half a study, also when the harvest fails.
+    Parameters:
+        -args           QIBConfig   Settings of the run, with the --database to connect to.
+        -connection     Connection  DB-API connection to use instead of --database, it is closed by close.
+    """
+    streaming = True
+    tag_file = None
+
+    def __init__(self, args, connection=None):
+        config = as_config(args)
+        self.study_id = config.study_id
+        self.precision = config.precision
+        self.connection = connection if connection is not None else connect_database(config.database)
+        self.sqlite = isinstance(self.connection, sqlite3.Connection)
+        create_staging_tables(self.connection)
+
+    def write(self, data_list, data_header_list, tag_registry):
+        if isinstance(data_list, ColumnStore):
+            data_list = data_list.rows()
+        spool_file = tempfile.TemporaryFile(mode='w+')
+        try:
+            for row in self.observations(data_list):
+                spool_file.write(json.dumps(row) + '\n')
+            spool_file.seek(0)
+            cursor = self.connection.cursor()
+            try:
+                with run_stats.stage("write_database"):
+                    for table in DATABASE_TABLES:
+                        cursor.execute("DELETE FROM " + self.table(table) + " WHERE study_id = " + self.placeholder(),
+                                       (self.study_id,))
+                self.insert(cursor, "lt_src_clinical_data", (tuple(json.loads(line)) for line in spool_file))
+                self.insert(cursor, "lt_src_column_map", self.column_map(data_header_list))
+                self.insert(cursor, "lt_src_tags", ((self.study_id, concept_key, tag, str(value), weight)
+                                                    for concept_key, tag, value, weight in tag_registry.entries))
+                with run_stats.stage("write_database"):
+                    self.connection.commit()
+            except Exception:
+                self.connection.rollback()
+                raise
+            finally:
+                cursor.close()
+        finally:
+            spool_file.close()
+
+    def observations(self, data_list):
+        """
+        Function: Generator of the lt_src_clinical_data rows of the subject rows.
+        """
+        for data_row_dict in data_list:
+            with run_stats.stage("write_database"):
+                subject_id = data_row_dict.get("subject")
+                rows = []
+                for header, value in data_row_dict.items():
+                    value = format_value(value, self.precision)
+                    if header != "subject" and value != '':
+                        category_cd, data_label = column_code(header)
+                        rows.append((self.study_id, '', subject_id, '', data_label, value, category_cd))
+            for row in rows:
+                yield row
+
+    def column_map(self, data_header_list):
+        """
+        Function: Generator of the lt_src_column_map rows, the column numbers are those of the clinical data file.
+        """
+        for index, header in enumerate(data_header_list):
+            if header != "subject":
+                category_cd, data_label = column_code(header)
+                yield self.study_id, category_cd, index + 1, data_label
+
+    def insert(self, cursor, table, rows):
+        """
+        Function: Insert rows into a staging table, DATABASE_BATCH_SIZE rows per call.
+        """
+        columns = DATABASE_TABLES[table]
+        statement = ("INSERT INTO " + self.table(table) + " (" + ", ".join(columns) + ") VALUES (" +
+                     ", ".join([self.placeholder()] * len(columns)) + ")")
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == DATABASE_BATCH_SIZE:
+                self.send(cursor, statement, batch)
+                batch = []
+        if batch:
+            self.send(cursor, statement, batch)
+
+    def send(self, cursor, statement, batch):
+        with run_stats.stage("write_database"):
+            if self.sqlite:
+                cursor.executemany(statement, batch)
+            else:
+                #executemany of psycopg2 makes one round trip per row, execute_batch sends them in pages.
+                psycopg2.extras.execute_batch(cursor, statement, batch, page_size=1000)
+
+    def table(self, table):
+        return table if self.sqlite else DATABASE_SCHEMA + "." + table
+
+    def placeholder(self):
+        return "?" if self.sqlite else "%s"
+
+    def close(self):
+        self.connection.close()
+
+
+def connect_database(database):
+    """
+    Function: Connect to the database of --database.
+
+    Parameters:
+        - database      String      libpq connection string of the tranSMART PostgreSQL database, or sqlite:FILE
+                                    for a SQLite database with the staging tables, to test the loading.
+
+    Returns:
+        - connection    Connection  DB-API connection.
+    """
+    if database.startswith("sqlite:"):
+        return sqlite3.connect(database[len("sqlite:"):], timeout=60)
+    return psycopg2.connect(database)
+
+
+def create_staging_tables(connection):
+    """
+    Function: Create the staging tables of DATABASE_TABLES that do not exist yet. Existing tables, like the
+              lt_src_clinical_data of tranSMART with its other columns, are left as they are.
+    """
+    sqlite = isinstance(connection, sqlite3.Connection)
+    cursor = connection.cursor()
+    for table, columns in DATABASE_TABLES.items():
+        cursor.execute("CREATE TABLE IF NOT EXISTS " + (table if sqlite else DATABASE_SCHEMA + "." + table) +
+                       " (" + ", ".join(column + (" INTEGER" if column in ("column_number", "weight") else " TEXT")
+                                        for column in columns) + ")")
+    cursor.close()
+    connection.commit()
+
+
+def column_code(header):
+    """
+    Function: Split the header of a column in its category code and data label, as in the column map file.
+    """
+    parts = header.split("\\")
+    return "\\".join(parts[:-1]), parts[-1]
+
+
+def obtain_data(project, tag_file, args, state=None):
+    """
+    Function: Obtains all the QIB data from the XNAT project, see harvest.
+    Parameters: 
+        -project        xnatpy object   Xnat connection to a specific project.
+        -tag_file        File            tags.txt, used to upload the metadata into TranSMART.
+        -state          ExportState     State of the last run for an incremental export, None for a full export.
+    Returns:
+        -data_list           List    List containing directories per subject, key = header, value = value.
+        -data_header_list     List    List containing all the headers.
+    """
+    config = as_config(args)
+    data_iterator = DataIterator(project, config, tag_file, state)
+    data_header_list = data_iterator.data_header_list
+    data_list = list(data_iterator)
+    if data_list == [{}] or data_list == []:
+        if state is not None and config.delta and data_list == []:
+            return data_list, data_header_list
+        return data_list
+
+    return data_list, data_header_list
+
+
+class DataIterator(object):
+    """
+    Function: Lazy iterator over the QIB data of the XNAT project, one dict per subject, for the use of the
+              harvest as a library. A subject is harvested when it is read, see harvest, and at most
+              PREFETCH_PER_WORKER sessions per worker are downloaded ahead. A reader can stop early with close,
+              then the other sessions are not downloaded.
+    Parameters:
+        -project            xnatpy object   Xnat connection to a specific project.
+        -args               QIBConfig       Settings of the run, with the filters of the subjects and sessions.
+        -tag_file           File            tags.txt or a TagRegistry, None to only keep the tags in tag_registry.
+        -state              ExportState     State of the last run for an incremental export, None for a full export.
+    Attributes:
+        -data_header_list   List            The headers of the subjects that were read so far.
+        -tag_registry       TagRegistry     The metadata tags of the subjects that were read so far.
+    """
+
+    def __init__(self, project, args, tag_file=None, state=None):
+        self.data_header_list = []
+        self.tag_registry = tag_file if isinstance(tag_file, TagRegistry) else TagRegistry(tag_file)
+        self.rows = harvest(project, self.tag_registry, as_config(args), self.data_header_list, state)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.rows)
+
+    next = __next__
+
+    def close(self):
+        """
+        Function: Stop the harvest, the sessions that are still being downloaded are finished first.
+        """
+        self.rows.close()
+
+
+def harvest(project, tag_file, args, data_header_list, state=None, positions=False):
+    """
+    Function: Generator that obtains the QIB data from the XNAT project, one subject at a time.
+              With --retrieval bulk the QIB experiments of the whole project are found with one listing,
+              with --retrieval crawl the experiments of every subject are listed.
+              Sessions that did not change since the last run are read from the --cache-dir cache.
+              The XNAT requests are done by a pool of --workers threads, the results are merged in subject order,
+              so the output is the same as with a single worker.
+              The time per subject is added to the obtain_data stage of run_stats, this includes waiting for
+              the sessions of the subject.
+              When a session of a subject can not be retrieved, after the retries of tune_session, the subject is
+              logged and skipped, and the other subjects are exported. An incremental export retries it next run.
+              With an export state the QIB experiments that did not change since the last run are taken from
+              the state, with --delta the subjects without changes are left out.
+              With --checkpoint the harvested subjects are saved every --checkpoint-interval subjects. With
+              --resume the subjects in the checkpoint are yielded first, with the headers and tags they had,
+              and the harvest continues with the other subjects, so the output is the same as without a break.
+              The --subjects-file filter is applied to the subject listing, before the experiments of the subjects
+              are listed, and the --since, --label-pattern and --analysis-tool filters to the experiment listing,
+              so the sessions that are left out are never downloaded, see select_subjects.
+              The sessions are downloaded at most PREFETCH_PER_WORKER per worker ahead of the subject that is
+              yielded, so a reader that stops early does not wait for the whole project.
+              When nothing is found the run stops, except in a --batch, --shard or --watch export.
+    Parameters:
+        -project            xnatpy object   Xnat connection to a specific project.
+        -tag_file           File            tags.txt, used to upload the metadata into TranSMART,
+                                            or the TagRegistry the metadata tags are added to.
+        -data_header_list   List            List the headers are added to, when they are found.
+        -state              ExportState     State of the last run for an incremental export, None for a full export.
+        -positions          Boolean         Yield the position of the subject in the subject listing with the row.
+    Yields:
+        -data_row_dict      Dict            Dict per subject, key = header, value = value,
+                                            or a tuple (position, data_row_dict) with positions.
+    """
+    config = as_config(args)
+    tag_list = config.tag_list
+    header_registry = OrderedRegistry(data_header_list)
+    tag_registry = tag_file if isinstance(tag_file, TagRegistry) else TagRegistry(tag_file)
+    row_count = 0
+    first_row_empty = False
+    cache = open_cache(config)
+    checkpoint = open_checkpoint(config)
+    pool = ThreadPool(config.workers) if config.workers > 1 else None
+    try:
+        with run_stats.stage("list_experiments"):
+            listed_subjects = project.subjects.values()
+            subject_positions = dict((subject.label, position) for position, subject in enumerate(listed_subjects))
+            subjects = select_listed_subjects(listed_subjects, config, state)
+            if config.retrieval == "bulk":
+                experiment_dict = list_project_qib_experiments(project, config)
+                subject_list = [(subject, experiment_dict.get(subject.id, [])) for subject in subjects]
+            else:
+                subject_list = list(map_work(pool, lambda subject: list_qib_experiments(project, subject, config),
+                                             subjects))
+            subject_list = select_subjects(subject_list, config, state)
+        if state is not None:
+            subject_list = [(subject, experiments, state.stored_sessions(subject.label, experiments))
+                            for subject, experiments in subject_list]
+        else:
+            subject_list = [(subject, experiments, [None] * len(experiments)) for subject, experiments in subject_list]
+        restored_rows = []
+        if checkpoint is not None:
+            subject_labels, restored_rows, headers, tags, subject_states = checkpoint.load()
+            if subject_labels:
+                logging.info("Resuming from the checkpoint, %d subjects were harvested already." % len(subject_labels))
+            for header in headers:
+                header_registry.add(header)
+            for concept_key, tag, value, weight in tags:
+                tag_registry.add(concept_key, tag, value, weight)
+            if state is not None:
+                state.seen_subjects.update(subject_states)
+            subject_labels = set(subject_labels)
+            subject_list = [(subject, experiments, stored_sessions) for subject, experiments, stored_sessions in subject_list
+                            if subject.label not in subject_labels]
+        for subject_label, data_row_dict in restored_rows:
+            if row_count == 0:
+                first_row_empty = data_row_dict == {}
+            row_count += 1
+            yield (subject_positions.get(subject_label), data_row_dict) if positions else data_row_dict
+
+        experiment_list = [experiment for subject, experiments, stored_sessions in subject_list
+                           for experiment, stored_session in zip(experiments, stored_sessions) if stored_session is None]
+        sessions = map_work(pool, lambda experiment: isolate(fetch_session, project, experiment, tag_list, cache,
+                                                             config.engine, config.concept_tags),
+                            experiment_list, config.workers * PREFETCH_PER_WORKER)
+        for subject, experiments, stored_sessions in subject_list:
+            with run_stats.stage("obtain_data"):
+                session_infos = [next(sessions) if stored_session is None else stored_session
+                                 for stored_session in stored_sessions]
+                errors = [session_info for session_info in session_infos if isinstance(session_info, Exception)]
+                if errors:
+                    logging.error("Subject " + subject.label + " skipped, a QIB session could not be retrieved: " + str(errors[0]))
+                    run_stats.add_failure(subject.label)
+                    continue
+                if config.analysis_tool:
+                    selected = [(experiment, session_info) for experiment, session_info in zip(experiments, session_infos)
+                                if analysis_tool_selected(session_info['concept_key'], config.analysis_tool)]
+                    if not selected:
+                        if state is not None:
+                            state.keep(subject.label)
+                        continue
+                    experiments, session_infos = [list(column) for column in zip(*selected)]
+                data_row_dict = {}
+                if state is not None:
+                    changed = state.update(subject.label, experiments, session_infos)
+                    if config.delta and not changed:
+                        data_row_dict = None
+                if data_row_dict is not None:
+                    for session_info in session_infos:
+                        data_row_dict = retrieveQIB(session_info, data_row_dict, subject, header_registry, tag_registry,
+                                                    config.concept_tags)
+                if checkpoint is not None:
+                    checkpoint.add(subject.label, data_row_dict)
+                    if len(checkpoint.pending) >= checkpoint.interval:
+                        checkpoint.save(data_header_list, tag_registry, state)
+            if data_row_dict is None:
+                continue
+            if row_count == 0:
+                first_row_empty = data_row_dict == {}
+            row_count += 1
+            yield (subject_positions[subject.label], data_row_dict) if positions else data_row_dict
+        if checkpoint is not None:
+            checkpoint.save(data_header_list, tag_registry, state)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if cache is not None:
+            cache.close()
+        if checkpoint is not None:
+            checkpoint.close()
+    #Only a single export stops here, the empty micro-batches of --watch are only logged.
+    stops = __name__ == "__main__" and not (config.batch or config.shard or config.watch)
+    if state is not None and config.delta and row_count == 0:
+        logging.info("No new or changed subjects since the last run.")
+        if stops:
+            print("No new or changed subjects since the last run.\nExit")
+            state.save()
+            sys.exit()
+        elif not config.watch:
+            print("No new or changed subjects since the last run.")
+    elif row_count == 0 or (row_count == 1 and first_row_empty):
+        if config.watch:
+            logging.info("No QIB datatypes found.")
+        else:
+            logging.warning("No QIB datatypes found.")
+        if stops:
+            print("No QIB datatypes found.\nExit")
+            sys.exit()
+        elif not config.watch:
+            print("No QIB datatypes found.")
+
+
+def obtain_store(project, tag_file, args, state=None):
+    """
+    Function: Obtains all the QIB data from the XNAT project in a ColumnStore, see harvest.
+    Parameters:
+        -project        xnatpy object   Xnat connection to a specific project.
+        -tag_file        File            tags.txt, used to upload the metadata into TranSMART.
+        -state          ExportState     State of the last run for an incremental export, None for a full export.
+    Returns:
+        -store              ColumnStore     The data of all the subjects.
+        -data_header_list   List            List containing all the headers.
+    """
+    data_header_list = []
+    store = ColumnStore()
+    for data_row_dict in harvest(project, tag_file, as_config(args), data_header_list, state):
+        store.append(data_row_dict)
+    return store, data_header_list
+
+
+class ColumnStore(object):
+    """
+    Function: Columnar store of the harvested subject rows. Every concept key is stored once, in the concept table,
+              and the values of a concept are stored in one column with a mask of the subjects that have a value.
+              A column is an array of floats as long as all its values are numbers, otherwise it is a list of the
+              values, floats and strings. The text of a BiomarkerNumber that is not written the same as the float,
+              like 1 or NaN, is kept next to the array. Missing values (None) are left out of the mask.
+              write_data accepts a ColumnStore as data_list, the values are formatted when they are written.
+    """
+
+    def __init__(self):
+        self.concept_index = {}
+        self.concept_keys = []
+        self.columns = []
+        self.texts = []
+        self.masks = []
+        self.row_count = 0
+
+    def __len__(self):
+        return self.row_count
+
+    def append(self, data_row_dict):
+        """
+        Function: Add the row of a subject.
+        """
+        for concept_key, value in data_row_dict.items():
+            index = self.concept_index.get(concept_key)
+            if index is None:
+                index = len(self.concept_keys)
+                self.concept_index[concept_key] = index
+                self.concept_keys.append(concept_key)
+                self.columns.append(array.array('d'))
+                self.texts.append({})
+                self.masks.append(bytearray())
+            if value is not None:
+                self.set_value(index, value)
+        self.row_count += 1
+
+    def set_value(self, index, value):
+        column = self.columns[index]
+        mask = self.masks[index]
+        missing = self.row_count - len(mask)
+        if isinstance(column, array.array):
+            number = numeric_value(value)
+            if number is None:
+                column = self.columns[index] = [self.stored_value(index, row) for row in range(len(column))]
+                self.texts[index] = {}
+            else:
+                column.extend([0.0] * missing)
+                column.append(number)
+                if isinstance(value, BiomarkerNumber) and value.text != repr(number):
+                    self.texts[index][self.row_count] = value.text
+        if not isinstance(column, array.array):
+            column.extend([None] * missing)
+            column.append(value)
+        mask.extend(bytearray(missing))
+        mask.append(1)
+
+    def stored_value(self, index, row):
+        """
+        Function: Get a stored value, a number with a text is returned as BiomarkerNumber.
+        """
+        text = self.texts[index].get(row)
+        if text is not None:
+            return BiomarkerNumber(text)
+        return self.columns[index][row]
+
+    def column(self, concept_key):
+        """
+        Function: Get the values of a concept for all the subjects.
+
+        Returns:
+            - values    List    The values, None for the subjects without a value.
+        """
+        index = self.concept_index[concept_key]
+        mask = self.masks[index]
+        values = [self.stored_value(index, row) if mask[row] else None for row in range(len(mask))]
+        return values + [None] * (self.row_count - len(mask))
+
+    def summary(self, concept_key):
+        """
+        Function: Count, minimum, maximum and mean of a numeric concept.
+
+        Returns:
+            - summary   Dict    count, min, max and mean, None when the concept is not numeric.
+        """
+        index = self.concept_index[concept_key]
+        column = self.columns[index]
+        if not isinstance(column, array.array):
+            return None
+        values = [value for value, present in zip(column, self.masks[index]) if present]
+        if not values:
+            return {'count': 0, 'min': None, 'max': None, 'mean': None}
+        return {'count': len(values), 'min': min(values), 'max': max(values), 'mean': sum(values) / len(values)}
+
+    def validate(self, value_range=None):
+        """
+        Function: Check the numbers of every column for all the subjects at once, before the data is written.
+
+        Parameters:
+            - value_range   Tuple   (minimum, maximum) of the values, None to only look for NaN and infinite values.
+
+        Returns:
+            - problems      Dict    key = concept key, value = dict with the number of nan, infinite and out_of_range
+                                    values, only for the columns with problems.
+        """
+        problems = {}
+        for concept_key, column, mask in zip(self.concept_keys, self.columns, self.masks):
+            values = [value for value, present in zip(column, mask) if present and isinstance(value, float)]
+            counts = {'nan': sum(1 for value in values if math.isnan(value)),
+                      'infinite': sum(1 for value in values if math.isinf(value))}
+            if value_range is not None:
+                counts['out_of_range'] = sum(1 for value in values if value < value_range[0] or value > value_range[1])
+            counts = dict((name, count) for name, count in counts.items() if count)
+            if counts:
+                problems[concept_key] = counts
+        return problems
+
+    def rows(self):
+        """
+        Function: Generator of the subject rows, as dicts with key = header, value = value.
+        """
+        for row in range(self.row_count):
+            data_row_dict = {}
+            for index, concept_key in enumerate(self.concept_keys):
+                mask = self.masks[index]
+                if row < len(mask) and mask[row]:
+                    data_row_dict[concept_key] = self.stored_value(index, row)
+            yield data_row_dict
+
+
+def numeric_value(value):
+    """
+    Function: Convert a value to a float, when the float is written the same as the value.
+
+    Returns:
+        - number    Float   The number, None when the value is not a number that can be stored as float.
+    """
+    if isinstance(value, float):
+        return value
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    if repr(number) != value:
+        return None
+    return number
+
+
+class ExportState(object):
+    """
+    Function: State of the last incremental export, stored as JSON in the --incremental file.
+              Per subject it holds the last modified date and the session information per QIB experiment,
+              and a hash of the session information of the subject.
+    Parameters:
+        -state_file     String  Location of the state file, it is created when it does not exist yet.
+    """
+
+    def __init__(self, state_file):
+        self.state_file = state_file
+        self.subjects = {}
+        self.seen_subjects = {}
+        if os.path.exists(state_file):
+            with open(state_file, 'r') as open_state_file:
+                self.subjects = json.load(open_state_file)['subjects']
+
+    def stored_sessions(self, subject_label, experiments):
+        """
+        Function: Get the session information of the QIB experiments of a subject from the last run.
+
+        Returns:
+            - session_infos     List    The session information per experiment, None for the experiments that are
+                                        new or changed since the last run.
+        """
+        stored_subject = self.subjects.get(subject_label, {'experiments': {}, 'sessions': {}})
+        session_infos = []
+        for experiment in experiments:
+            last_modified = experiment.get('last_modified')
+            if last_modified and stored_subject['experiments'].get(experiment['ID']) == last_modified:
+                session_infos.append(stored_subject['sessions'][experiment['ID']])
+            else:
+                session_infos.append(None)
+        return session_infos
+
+    def update(self, subject_label, experiments, session_infos):
+        """
+        Function: Store the session information of a subject.
+
+        Returns:
+            - changed   Boolean     True when the subject is new or the session information changed.
+        """
+        row_hash = hashlib.md5(json.dumps(session_infos, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+        stored_subject = self.subjects.get(subject_label)
+        self.seen_subjects[subject_label] = {
+            'experiments': dict((experiment['ID'], experiment.get('last_modified')) for experiment in experiments),
+            'sessions': dict((experiment['ID'], session_info) for experiment, session_info in zip(experiments, session_infos)),
+            'row_hash': row_hash}
+        return stored_subject is None or stored_subject['row_hash'] != row_hash
+
+    def keep(self, subject_label):
+        """
+        Function: Keep the state of the last run of a subject that was left out by a filter.
+        """
+        if subject_label in self.subjects and subject_label not in self.seen_subjects:
+            self.seen_subjects[subject_label] = self.subjects[subject_label]
+
+    def save(self):
+        """
+        Function: Write the state of the subjects that were seen in this run to the state file.
+        """
+        with open(self.state_file + '.tmp', 'w') as open_state_file:
+            json.dump({'subjects': self.seen_subjects}, open_state_file, default=str)
+        if os.path.exists(self.state_file):
+            os.remove(self.state_file)
+        os.rename(self.state_file + '.tmp', self.state_file)
+
+
+def open_checkpoint(config):
+    """
+    Function: Open the --checkpoint of the harvest. The checkpoint of an earlier run is removed, unless --resume is given.
+
+    Parameters:
+        - config        QIBConfig       Settings of the run.
+
+    Returns:
+        - checkpoint    Checkpoint      The checkpoint, None when there is no --checkpoint.
+    """
+    if not config.checkpoint:
+        return None
+    if not config.resume and os.path.exists(config.checkpoint):
+        os.remove(config.checkpoint)
+    return Checkpoint(config.checkpoint, config.checkpoint_interval)
+
+
+def remove_checkpoint(config):
+    """
+    Function: Remove the --checkpoint after the files are written.
+    """
+    if config.checkpoint and os.path.exists(config.checkpoint):
+        os.remove(config.checkpoint)
+
+
+class Checkpoint(object):
+    """
+    Function: SQLite checkpoint of a harvest. It holds the harvested subjects in harvest order, with their rows,
+              the headers and the metadata tags in the order they were found, and the export state of the subjects.
+              The subjects are added one at a time and saved in one transaction every interval subjects, so a
+              checkpoint always ends at a subject, also when the run is killed while it is saved.
+    Parameters:
+        -checkpoint_file    String  Location of the checkpoint, it is created when it does not exist yet.
+        -interval           Int     Number of subjects between two saves.
+    """
 
-def main(args):
+    def __init__(self, checkpoint_file, interval):
+        self.interval = interval
+        self.pending = []
+        self.saved_headers = 0
+        self.saved_tags = 0
+        self.database = sqlite3.connect(checkpoint_file)
+        self.database.execute("CREATE TABLE IF NOT EXISTS subjects (position INTEGER PRIMARY KEY, label TEXT, data_row TEXT)")
+        self.database.execute("CREATE TABLE IF NOT EXISTS headers (position INTEGER PRIMARY KEY, header TEXT)")
+        self.database.execute("CREATE TABLE IF NOT EXISTS tags (position INTEGER PRIMARY KEY, concept_key TEXT, tag TEXT, "
+                              "value TEXT, weight TEXT)")
+        self.database.execute("CREATE TABLE IF NOT EXISTS states (label TEXT PRIMARY KEY, subject_state TEXT)")
+        self.database.commit()
+
+    def load(self):
+        """
+        Function: Read the checkpoint.
+
+        Returns:
+            - subject_labels    List    Labels of the harvested subjects, in harvest order.
+            - data_list         List    (label, row) of the harvested subjects, without the subjects that had no row.
+            - headers           List    The headers, in the order they were found.
+            - tags              List    (concept key, tag, value, weight) of the metadata tags, in the order they were found.
+            - subject_states    Dict    key = subject label, value = export state of the subject, see ExportState.
+        """
+        subjects = self.database.execute("SELECT label, data_row FROM subjects ORDER BY position").fetchall()
+        headers = [header for (header,) in self.database.execute("SELECT header FROM headers ORDER BY position")]
+        tags = [(concept_key, tag, json.loads(value), json.loads(weight)) for concept_key, tag, value, weight in
+                self.database.execute("SELECT concept_key, tag, value, weight FROM tags ORDER BY position")]
+        subject_states = dict((label, json.loads(subject_state)) for label, subject_state in
+                              self.database.execute("SELECT label, subject_state FROM states"))
+        self.saved_headers = len(headers)
+        self.saved_tags = len(tags)
+        return ([label for label, data_row in subjects],
+                [(label, load_row(json.loads(data_row))) for label, data_row in subjects if data_row is not None],
+                headers, tags, subject_states)
+
+    def add(self, subject_label, data_row_dict):
+        """
+        Function: Add a harvested subject, data_row_dict is None when the subject has no row.
+        """
+        self.pending.append((subject_label, data_row_dict))
+
+    def save(self, data_header_list, tag_registry, state=None):
+        """
+        Function: Save the added subjects, with the headers and tags that were found since the last save.
+        """
+        with self.database:
+            self.database.executemany("INSERT INTO subjects (label, data_row) VALUES (?, ?)",
+                                      [(label, None if data_row_dict is None else json.dumps(dump_row(data_row_dict)))
+                                       for label, data_row_dict in self.pending])
+            self.database.executemany("INSERT INTO headers (header) VALUES (?)",
+                                      [(header,) for header in data_header_list[self.saved_headers:]])
+            self.database.executemany("INSERT INTO tags (concept_key, tag, value, weight) VALUES (?, ?, ?, ?)",
+                                      [(concept_key, tag, json.dumps(value, default=str), json.dumps(weight))
+                                       for concept_key, tag, value, weight in tag_registry.entries[self.saved_tags:]])
+            if state is not None:
+                self.database.executemany("INSERT OR REPLACE INTO states VALUES (?, ?)",
+                                          [(label, json.dumps(state.seen_subjects[label], default=str))
+                                           for label, data_row_dict in self.pending if label in state.seen_subjects])
+        self.saved_headers = len(data_header_list)
+        self.saved_tags = len(tag_registry.entries)
+        self.pending = []
+
+    def close(self):
+        self.database.close()
+
+
+def open_cache(config):
     """
-    Function: Call all the methods, passing along all the needed variables.
+    Function: Open the session cache in --cache-dir.
+
     Parameters:
-        -args   ArgumentParser      Contains the location of the configuration files.
+        - config    QIBConfig       Settings of the run.
+
+    Returns:
+        - cache     SessionCache    The cache, None when --no-cache is given or there is no --cache-dir.
     """
+    if config.no_cache or not config.cache_dir:
+        return None
+    return SessionCache(config.cache_dir, config.cache_size * 1024 * 1024)
 
-    #Maybe create an object for the config reading part. Because it's taking in a lot of space.
-    #Maybe create a liberary of this script and a seperate one as running script.
-    logging.info("Start.")
-    print('Establishing connection\n')
-    project, connection = make_connection(args)
 
-    print('Creating directory structure\n')
-    path = create_dir(args)
+class SessionCache(object):
+    """
+    Function: SQLite cache of the session information made by retrieve_session, keyed by experiment ID.
+              A cached session is only used when its last modified date in the XNAT listing is still the same,
+              and the same tags are requested. When the cache gets bigger than max_size bytes the least recently
+              used sessions are removed. The last use of a hit is kept in memory and written in the transaction of
+              the next put or close, so a hit does not hold the write lock of the database, which can be shared by
+              the projects of a --batch export or by the shards of a --shard export.
+    Parameters:
+        -cache_dir      String  Directory where the cache database is stored.
+        -max_size       Int     Maximum size of the cached session information in bytes.
+    """
 
-    print('Write .params files\n')
-    write_params(path, args)
+    def __init__(self, cache_dir, max_size):
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.used = {}
+        self.lock = threading.Lock()
+        self.database = sqlite3.connect(os.path.join(cache_dir, "sessions.db"), check_same_thread=False)
+        self.database.execute("CREATE TABLE IF NOT EXISTS sessions (experiment_id TEXT PRIMARY KEY, last_modified TEXT, "
+                              "tag_list TEXT, session_info TEXT, size INTEGER, last_used REAL)")
+        self.database.commit()
+
+    def get(self, experiment_id, last_modified, tag_list):
+        with self.lock:
+            row = self.database.execute("SELECT last_modified, tag_list, session_info FROM sessions WHERE experiment_id = ?",
+                                        (experiment_id,)).fetchone()
+            if row is None or not last_modified or row[0] != last_modified or row[1] != ', '.join(tag_list):
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.used[experiment_id] = time.time()
+            return json.loads(row[2])
+
+    def put(self, experiment_id, last_modified, tag_list, session_info):
+        if not last_modified:
+            return
+        data = json.dumps(session_info, default=str)
+        with self.lock:
+            self.write_used()
+            self.database.execute("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?, ?)",
+                                  (experiment_id, last_modified, ', '.join(tag_list), data, len(data), time.time()))
+            self.evict()
+            self.database.commit()
+
+    def write_used(self):
+        """
+        Function: Write the last use of the hits since the last transaction, before it is committed.
+        """
+        if self.used:
+            self.database.executemany("UPDATE sessions SET last_used = ? WHERE experiment_id = ?",
+                                      [(last_used, experiment_id) for experiment_id, last_used in self.used.items()])
+            self.used = {}
+
+    def evict(self):
+        total_size = self.database.execute("SELECT COALESCE(SUM(size), 0) FROM sessions").fetchone()[0]
+        if total_size <= self.max_size:
+            return
+        for experiment_id, size in self.database.execute("SELECT experiment_id, size FROM sessions "
+                                                         "ORDER BY last_used").fetchall():
+            self.database.execute("DELETE FROM sessions WHERE experiment_id = ?", (experiment_id,))
+            total_size -= size
+            if total_size <= self.max_size:
+                break
+
+    def close(self):
+        with self.lock:
+            self.write_used()
+            self.database.commit()
+            self.database.close()
+        logging.info("Session cache: %d hits, %d misses." % (self.hits, self.misses))
+
+
+def isolate(function, *args):
+    """
+    Function: Call function, and return the exception instead of raising it, so a failure in a worker thread
+              only affects the subject it belongs to.
 
-    print('Write headers\n')
-    tag_file, data_file, concept_file = write_headers(path, args)
+    Returns:
+        - result    Object      The result of function, or the exception it raised.
+    """
+    try:
+        return function(*args)
+    except Exception as e:
+        return e
 
-    print('Obtaining data from XNAT\n')
-    data_list, data_header_list = obtain_data(project, tag_file, args)
-    logging.info("Data obtained from XNAT.")
 
-    print('Write data to files\n')
-    write_data(data_file, concept_file, data_list, data_header_list)
-    logging.info("Data written to files.")
+def map_work(pool, function, items, window=None):
+    """
+    Function: Apply function to all the items, using the thread pool when there is one.
 
-    connection.disconnect()
-    logging.info("Exit.")
+    Parameters:
+        - pool          ThreadPool      Pool of worker threads, None to do the work in the calling thread.
+        - function      Function        Function that is applied to each item.
+        - items         List            Items to process.
+        - window        Int             Maximum number of items that are processed ahead of the result that is read,
+                                        None to give all the items to the pool at once.
 
+    Returns:
+        - results       Iterator        The results, in the same order as items.
+    """
+    if pool is None:
+        return (function(item) for item in items)
+    if window is None:
+        return pool.imap(function, items)
+    return bounded_map(pool, function, items, window)
 
-def make_connection(args):
+
+def bounded_map(pool, function, items, window):
     """
-    Function: Create the connection to XNAT.
-    Returns: 
-        -project    xnatpy object   Xnat connection to a specific project.
+    Function: Generator like pool.imap, but with at most window items in the pool at the same time,
+              so the items after the last result that is read are not processed.
     """
-    config = check_file_existence(args.connection, "connection")
+    pending = collections.deque()
+    for item in items:
+        pending.append(pool.apply_async(function, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
 
-    try:
-        connection_name = config.get('Connection', 'url')
-        user = config.get('Connection', 'user')
-        pssw = config.get('Connection', 'password')
-        project_name = config.get('Connection', 'project')
-        connection = xnat.connect(connection_name, user=user, password=pssw)
-        project = connection.projects[project_name]
-        logging.info("Connection established.")
-        return project, connection
 
-    except ConfigParser.NoSectionError as e:
-        configError(e)
+def list_qib_experiments(project, subject, config=None):
+    """
+    Function: List the QIB experiments of a subject.
 
-    except KeyError:
-        print("Project not found in XNAT.\nExit")
-        logging.critical("Project not found in XNAT.")
-        if __name__ == "__main__":
-            sys.exit()
-        else:
-            return None, None
+    Parameters:
+        - project       xnatpy object   Xnat connection to a specific project.
+        - subject       Subject         Subject derived from XNATpy
+        - config        QIBConfig       Settings of the run, see experiment_query.
 
-    except Exception as e:
-        print(str(e) + "\nExit")
-        if __name__ == "__main__":
-            logging.critical(e.message)
-            sys.exit()
-        else:
-            return e, None
+    Returns:
+        - subject       Subject         Subject derived from XNATpy
+        - experiments   List            List containing a dict (ID, label, last_modified) per QIB experiment of the subject.
+    """
+    result = project.xnat_session.get_json('/data/projects/' + project.id + '/subjects/' + subject.id + '/experiments',
+                                           query=experiment_query(EXPERIMENT_COLUMNS, config))
+    experiments = [row for row in result['ResultSet']['Result'] if "qib" in row['label'].lower()]
+    return subject, experiments
 
 
-def create_dir(args):
+def list_project_qib_experiments(project, config=None):
     """
-    Function: Create the directory structure.
-    Returns: 
-        -new_path    String   Path to the directory where all the files will be saved.
+    Function: List the QIB experiments of all the subjects in the project with a single XNAT request.
+
+    Parameters:
+        - project       xnatpy object   Xnat connection to a specific project.
+        - config        QIBConfig       Settings of the run, see experiment_query.
+
+    Returns:
+        - experiment_dict   Dict        key = subject ID, value = list containing a dict (ID, label, last_modified)
+                                        per QIB experiment of the subject, in the order of the XNAT listing.
     """
-    config = check_file_existence(args.params, "params")
+    result = project.xnat_session.get_json('/data/projects/' + project.id + '/experiments',
+                                           query=experiment_query(EXPERIMENT_COLUMNS + ',subject_ID', config))
+    experiment_dict = {}
+    for row in result['ResultSet']['Result']:
+        if "qib" in row['label'].lower():
+            experiment_dict.setdefault(row['subject_ID'], []).append(row)
+    return experiment_dict
 
-    try:
-        base_path = config.get('Directory', 'path')
-        new_path = config.get('Study', 'STUDY_ID')
-        path = base_path+new_path
-        #Test if the /tags/ and /clinical are also there
-        if not os.path.exists(path):
-            os.makedirs(path)
-            os.makedirs(path + "/tags/")
-            os.makedirs(path + "/clinical/")
-        return path
 
-    except ConfigParser.NoSectionError as e:
-        configError(e)
+def experiment_query(columns, config=None):
+    """
+    Function: Make the query of an XNAT experiment listing. With --analysis-tool only the QIB sessions are listed,
+              with their analysis tool and version, so the sessions of other tools are left out before they are downloaded.
 
+    Parameters:
+        - columns       String          Columns of the listing.
+        - config        QIBConfig       Settings of the run, None for a listing without filter.
 
-def write_params(path, args):
+    Returns:
+        - query         Dict            Query parameters of the listing.
     """
-    Function: Uses the configuration files to write the .params files.
+    if config is not None and config.analysis_tool:
+        return {'columns': columns + ',' + ANALYSIS_TOOL_COLUMNS, 'xsiType': QIB_XSI_TYPE, 'format': 'json'}
+    return {'columns': columns, 'format': 'json'}
+
+
+def select_listed_subjects(subjects, config, state=None):
+    """
+    Function: Apply the --subjects-file and --shard filters to the subject listing of the project.
+              With an export state the subjects that are left out keep their state of the last run.
+
     Parameters:
-        -path   String  Path to the directory where all the files will be saved.
+        - subjects      List            Subjects derived from XNATpy.
+        - config        QIBConfig       Settings of the run.
+        - state         ExportState     State of the last run for an incremental export, None for a full export.
+
+    Returns:
+        - subjects      List            The subjects in the --subjects-file and the --shard, all the subjects without them.
+    """
+    if config.subject_labels is None and config.shard is None:
+        return subjects
+    if config.subject_labels is not None:
+        missing = len(config.subject_labels - set(subject.label for subject in subjects))
+        if missing:
+            logging.warning("%d subjects of the --subjects-file are not in the project." % missing)
+    selected = []
+    for subject in subjects:
+        if ((config.subject_labels is None or subject.label in config.subject_labels) and
+                (config.shard is None or shard_of(subject.label, config.shard[1]) == config.shard[0] - 1)):
+            selected.append(subject)
+        elif state is not None:
+            state.keep(subject.label)
+    return selected
+
+
+def shard_of(subject_label, shards):
+    """
+    Function: Get the shard of a subject, from 0 to shards - 1. It only depends on the label of the subject, so every
+              node of a --shard export makes the same partition.
+    """
+    return int(hashlib.md5(subject_label.encode('utf-8')).hexdigest(), 16) % shards
+
+
+def select_subjects(subject_list, config, state=None):
+    """
+    Function: Apply the --since, --label-pattern and --analysis-tool filters to the QIB experiments of the listing.
+              The subjects without QIB experiments after the filters are left out, with an export state they keep
+              their state of the last run. When the listing has no analysis tool, the --analysis-tool filter is
+              applied by harvest after the session is downloaded.
+
+    Parameters:
+        - subject_list  List            Tuple (subject, experiments) per subject.
+        - config        QIBConfig       Settings of the run.
+        - state         ExportState     State of the last run for an incremental export, None for a full export.
+
+    Returns:
+        - subject_list  List            Tuple (subject, experiments) per subject that is left.
+    """
+    if not (config.since or config.label_pattern or config.analysis_tool):
+        return subject_list
+    selected_list = []
+    for subject, experiments in subject_list:
+        experiments = [experiment for experiment in experiments if experiment_selected(experiment, config)]
+        if experiments:
+            selected_list.append((subject, experiments))
+        elif state is not None:
+            state.keep(subject.label)
+    return selected_list
+
+
+def experiment_selected(experiment, config):
+    """
+    Function: Check an experiment of the XNAT listing against the filters. An experiment without a last modified date
+              or analysis tool in the listing is not left out by --since or --analysis-tool.
     """
-    config = check_file_existence(args.params, "Params")
+    last_modified = experiment.get('last_modified')
+    if config.since and last_modified and last_modified < config.since:
+        return False
+    if config.label_pattern and not config.label_pattern.search(experiment['label']):
+        return False
+    analysis_tool = listing_value(experiment, 'analysis_tool')
+    if config.analysis_tool and analysis_tool is not None:
+        analysis_tool = tool_concept_key(analysis_tool, listing_value(experiment, 'analysis_tool_version'))
+        return analysis_tool_selected(analysis_tool, config.analysis_tool)
+    return True
+
+
+def listing_value(experiment, field):
+    """
+    Function: Get a field of the QIB session from an experiment of the XNAT listing, the column name of XNAT is
+              the datatype and the field, in any case.
+
+    Returns:
+        - value         String          Value of the field, None when it is not in the listing.
+    """
+    for column, value in experiment.items():
+        if column.lower().endswith('/' + field):
+            return value or ''
+    return None
+
+
+def analysis_tool_selected(analysis_tool, selected_tool):
+    """
+    Function: Check if the analysis tool of a session, the analysis tool and version separated by a space as in its
+              concept key, is the --analysis-tool. --analysis-tool is the name of the tool, or its name and version.
+    """
+    return analysis_tool == selected_tool or analysis_tool.startswith(selected_tool + " ")
 
+
+def fetch_session(project, experiment, tag_list, cache, engine="xnatpy", concept_tags=False):
+    """
+    Function: Get the information of a QIB experiment from the cache, or from XNAT when it is not cached
+              or changed since it was cached. Both engines give the same session information, so they share the cache.
+
+    Parameters:
+        - project       xnatpy object   Xnat connection to a specific project.
+        - experiment    Dict            ID, label and last_modified of the experiment from the XNAT listing.
+        - tag_list      List            Names of the session fields that are written as tags.
+        - cache         SessionCache    Cache of the session information, None to always download the session.
+        - engine        String          xnatpy to read the session with the xnatpy objects, see retrieve_session,
+                                        rest to read the XML of the session, see retrieve_session_xml.
+        - concept_tags  Boolean         Also read the accession identifier of the base session, see retrieve_session.
+
+    Returns:
+        - session_info  Dict            Session information, see retrieve_session.
+    """
+    if cache is not None:
+        session_info = cache.get(experiment['ID'], experiment.get('last_modified'), tag_list)
+        if session_info is not None:
+            return session_info
+    RequestCounter.session_scope(experiment['ID'])
+    start = time.time()
     try:
-        study_id = config.get('Study', "STUDY_ID")
-        security_req = config.get('Study', 'SECURITY_REQUIRED')
-        top_node = config.get('Study', 'TOP_NODE')
-        tag_param_file = open(path + '/tags/tags.params', 'w')
-        tag_param_file.write("TAGS_FILE=tags.txt")
-        study_param_file = open(path + '/study.params', 'w')
-        study_param_file.write("STUDY_ID=" + study_id +
-                         "\nSECURITY_REQUIRED=" + security_req +
-                         "\nTOP_NODE=" + top_node)
-        clinical_param_file = open(path + '/clinical/clinical.params', 'w')
-        clinical_param_file.write("COLUMN_MAP_FILE=" + str(study_id) + "_columns.txt")
-        tag_param_file.close()
-        study_param_file.close()
-        clinical_param_file.close()
-
-    except ConfigParser.NoSectionError as e:
-        configError(e)
+        if engine == "rest":
+            session_info = retrieve_session_xml(project.xnat_session, experiment['ID'], tag_list)
+        else:
+            session_info = retrieve_session(project.xnat_session.create_object('/data/experiments/' + experiment['ID']),
+                                            tag_list, concept_tags)
+    finally:
+        RequestCounter.session_scope(None)
+    run_stats.add_session(time.time() - start)
+    if cache is not None:
+        cache.put(experiment['ID'], experiment.get('last_modified'), tag_list, session_info)
+    return session_info
 
 
-def write_headers(path, args):
+def retrieve_session(session, tag_list, concept_tags=False):
     """
-    Function: Uses the configuration files to write the headers of the .txt files. 
+    Function: Download the QIB session and collect all the information that is needed for the files.
+              This is the only place where a QIB session is read from XNAT, so it can run in a worker thread.
+              Every attribute of the session, including the base session listing, is read once, the biomarkers
+              and tag writers only use the returned session_info.
+
     Parameters:
-        -path   String  Path to the directory where all the files will be saved.
+        - session           XNAT.experiment QIB experiment object derived from XNATpy
+        - tag_list          List            Names of the session fields that are written as tags.
+        - concept_tags      Boolean         Also read the base sessions for the accession identifier, which takes a
+                                            request, see retrieveQIB. Otherwise accession_identifier is None.
+
     Returns:
-        -tag_file        File    tags.txt, used to upload the metadata into TranSMART.
-        -data_file       File    (STUDY_ID)_clinical.txt, used to upload the clinical data into TranSMART.
-        -concept_file    File    (STUDY_ID)_columns.txt, used to determine which values are in which columns for uploading to TranSMART.
+        - session_info      Dict            label, concept_key, tags, missing_tags, biomarkers and accession_identifier of the session.
     """
-    config = check_file_existence(args.params, "Params")
+    concept_key = tool_concept_key(getattr(session, "analysis_tool"), getattr(session, "analysis_tool_version"))
+
+    tags = []
+    missing_tags = []
+    for tag in tag_list:
+        try:
+            tags.append((tag, getattr(session, tag)))
+        except AttributeError:
+            missing_tags.append(tag)
+
+    biomarkers = []
+    for biomarker_category in session.biomarker_categories:
+        results = session.biomarker_categories[biomarker_category]
+        for biomarker in results.biomarkers:
+            biomarker_obj = results.biomarkers[biomarker]
+            biomarkers.append((biomarker_category, biomarker, biomarker_obj.value,
+                               biomarker_obj.ontology_name, biomarker_obj.ontology_iri))
+
+    accession_identifier = None
+    if concept_tags:
+        base_sessions = session.base_sessions.values()
+        if base_sessions:
+            accession_identifier = base_sessions[0].accession_identifier
+
+    return {'label': session.label, 'concept_key': concept_key, 'tags': tags, 'missing_tags': missing_tags,
+            'biomarkers': biomarkers, 'accession_identifier': accession_identifier}
+
+
+def retrieve_session_xml(xnat_session, experiment_id, tag_list):
+    """
+    Function: Download the XML of the QIB session with one REST request and parse it, see parse_session_xml.
+              This gives the same session information as retrieve_session, without the xnatpy objects.
+
+    Parameters:
+        - xnat_session      XNATSession     Xnat connection.
+        - experiment_id     String          ID of the QIB experiment.
+        - tag_list          List            Names of the session fields that are written as tags.
 
-    try:
-        study_id = config.get('Study', "STUDY_ID")
-        data_file = open(path + '/clinical/' + study_id + '_clinical.txt', 'w')
-        concept_file = open(path + '/clinical/' + study_id + '_columns.txt', 'w')
-        tag_file = open(path + '/tags/tags.txt', 'w')
-        #Hardcoded right now, because transmart does not need other headers. But this can be subject to change.
-        concept_headers = ['Filename', 'Category Code', 'Column Number', 'Data Label']
-        tag_headers = ['Concept Path', 'Title', 'Description', 'Weight']
-        concept_file.write("\t".join(concept_headers) + '\n')
-        tag_file.write("\t".join(tag_headers) + "\n")
-        tag_file.flush()
-        data_file.flush()
-        concept_file.flush()
-        return tag_file, data_file, concept_file
-
-    except ConfigParser.NoSectionError as e:
-        configError(e)
-
-
-def obtain_data(project, tag_file, args):
-    """
-    Function: Obtains all the QIB data from the XNAT project.
-    Parameters: 
-        -project        xnatpy object   Xnat connection to a specific project.
-        -tag_file        File            tags.txt, used to upload the metadata into TranSMART.
     Returns:
-        -data_list           List    List containing directories per subject, key = header, value = value.
-        -data_header_list     List    List containing all the headers.
+        - session_info      Dict            Session information, see retrieve_session.
     """
-    concept_key_list = []
-    data_header_list = []
-    data_list = []
-    tag_dict = {}
-    for subject in project.subjects.values():
-        data_row_dict = {}
-        subject_obj = project.subjects[subject.label]
-        for experiment in subject_obj.experiments.values():
-            if "qib" in experiment.label.lower():
-                #Make number of returns and parameters less.
-                data_header_list, data_row_dict, concept_key_list, tag_dict = retrieveQIB(subject_obj, experiment, tag_file, data_row_dict,
-                                                                                          subject, data_header_list, concept_key_list, tag_dict, args)
-        data_list.append(data_row_dict)
-    if data_list == [{}] or data_list == []:
-        logging.warning("No QIB datatypes found.")
-        print("No QIB datatypes found.\nExit")
-        if __name__ == "__main__":
-            sys.exit()
-        else:
-            return data_list
+    response = xnat_session.get('/data/experiments/' + experiment_id, format='xml')
+    return parse_session_xml(io.BytesIO(response.content), tag_list)
 
-    return data_list, data_header_list
+
+def parse_session_xml(xml_file, tag_list):
+    """
+    Function: Parse the XML of a QIB session with iterparse. A biomarker is turned into a tuple as soon as it is
+              read and its element is cleared, so no tree of the biomarkers is kept. The namespaces of the elements
+              are ignored. The XML has the layout of the QIB datatype:
+
+              <qib:qibSessionData label="...">
+                  <qib:analysis_tool>...</qib:analysis_tool>          (and the other fields of the session)
+                  <qib:base_sessions><qib:base_session><qib:accession_identifier>...
+                  <qib:biomarker_categories><qib:biomarker_category name="...">
+                      <qib:biomarkers><qib:biomarker name="...">
+                          <qib:value>...</qib:value><qib:ontology_name>...</qib:ontology_name><qib:ontology_iri>...
+
+              The name of a category or biomarker can also be a name element. A field of tag_list that is not in the
+              XML is a tag without value, which is written the same as a missing tag.
+              The accession identifier of the first base session is always returned, retrieveQIB decides if it is
+              written as tag.
+
+    Parameters:
+        - xml_file          File            The XML of the session.
+        - tag_list          List            Names of the session fields that are written as tags.
+
+    Returns:
+        - session_info      Dict            Session information, see retrieve_session.
+    """
+    names = {}
+    biomarkers = []
+    category_biomarkers = []
+    accession_identifier = None
+    element = None
+    for event, element in ElementTree.iterparse(xml_file):
+        name = names.get(element.tag)
+        if name is None:
+            name = names[element.tag] = local_name(element.tag)
+        if name == 'biomarker':
+            values = dict((local_name(child.tag), child.text) for child in element)
+            category_biomarkers.append((element.get('name') or values.get('name'), values.get('value'),
+                                        values.get('ontology_name'), values.get('ontology_iri')))
+            element.clear()
+        elif name == 'biomarker_category':
+            category = element.get('name') or element_text(element, 'name')
+            biomarkers.extend((category,) + biomarker for biomarker in category_biomarkers)
+            category_biomarkers = []
+            element.clear()
+        elif name == 'base_session' and accession_identifier is None:
+            accession_identifier = element_text(element, 'accession_identifier')
+
+    #The last element is the session, the fields are its children without children.
+    fields = dict((local_name(child.tag), child.text) for child in element if len(child) == 0)
+    return {'label': element.get('label'),
+            'concept_key': tool_concept_key(fields.get('analysis_tool'), fields.get('analysis_tool_version')),
+            'tags': [(tag, fields.get(tag)) for tag in tag_list], 'missing_tags': [],
+            'biomarkers': biomarkers, 'accession_identifier': accession_identifier}
+
+
+def local_name(tag):
+    """
+    Function: Remove the namespace from the tag of an element.
+    """
+    return tag.rsplit('}', 1)[-1]
+
+
+def element_text(element, name):
+    """
+    Function: Get the text of the child element with this name, in any namespace, None when there is none.
+    """
+    for child in element:
+        if local_name(child.tag) == name:
+            return child.text
+    return None
+
+
+def tool_concept_key(analysis_tool, analysis_tool_version):
+    """
+    Function: Make the first part of the concept keys of a QIB session, the analysis tool and its version.
+    """
+    if analysis_tool and analysis_tool_version:
+        return str(analysis_tool + " " + analysis_tool_version)
+    elif analysis_tool:
+        return analysis_tool
+    return "Generic Tool"
 
 
-def retrieveQIB(subject_obj, experiment, tag_file, data_row_dict, subject, data_header_list, concept_key_list, tag_dict, args):
+def retrieveQIB(session_info, data_row_dict, subject, header_registry, tag_registry, concept_tags=False):
     """
-    Function: Retrieve the biomarker information from the QIB datatype.
+    Function: Add the biomarker information from the QIB datatype to the subject row.
+              The values are converted to floats, see biomarker_value.
     
     Parameters:
-        - subject_obj        XNAT.subject    Subject object derived from XNATpy
-        - experiment        XNAT.experiment Experiment object derived from XNATpy
-        - tag_file           File            File used to write the metadata tags to
-        - data_row_dict       Dict            Dictionary for storing the subject information, headers = key
+        - session_info      Dict            QIB session information, made by retrieve_session.
+        - data_row_dict     Dict            Dictionary for storing the subject information, headers = key
         - subject           Subject         Subject derived from XNATpy
-        - data_header_list    List            List used for storing all the headers
-        - concept_key_list    List            List used for storing the concept keys
+        - header_registry   OrderedRegistry Registry of all the headers found so far.
+        - tag_registry      TagRegistry     Registry of the metadata tags written so far.
+        - concept_tags      Boolean         Also write the ontology and accession identifier tags of the concepts
+                                            that are new, see writeOntologyTag. On when run as script, see main.
     
     Returns:
-        - data_header_list    List            List with the headers stored
-        - data_row_dict       Dict            Dict containing all the QIB information of the subject
-        - concept_key_list    List            List containing all the concept keys so far.
+        - data_row_dict     Dict            Dict containing all the QIB information of the subject
     """
-    session = subject_obj.experiments[experiment.label]
-    begin_concept_key, tag_dict = writeMetaData(session, tag_file, tag_dict, args)
+    begin_concept_key = writeMetaData(session_info, tag_registry)
     data_row_dict['subject'] = subject.label
-    if 'subject' not in data_header_list:
-        data_header_list.append('subject')
+    header_registry.add('subject')
 
-    label_list = experiment.label.split('_')
-    for biomarker_category in session.biomarker_categories:
-        results = session.biomarker_categories[biomarker_category]
-        for biomarker in results.biomarkers:
-            concept_value = results.biomarkers[biomarker].value
-            label = label_list[2]
-            if label_list[2].lower() == "l":
-                label = "Left"
-            elif label_list[2].lower() == "r":
-                label = "Right"
-            concept_key = str(begin_concept_key) + '\\' + str(biomarker_category)+ " " + str(label_list[3])+ "\\" + label + "\\" + str(biomarker)
-            data_row_dict[concept_key] = concept_value
-            if concept_key not in data_header_list:
-                data_header_list.append(concept_key)
-                if __name__ == "__main__":
-                    concept_key_list, tag_dict = writeOntologyTag(results, biomarker, concept_key, concept_key_list, tag_file, tag_dict, session)
+    label_list = session_info['label'].split('_')
+    for biomarker_category, biomarker, concept_value, ontology_name, ontology_IRI in session_info['biomarkers']:
+        label = label_list[2]
+        if label_list[2].lower() == "l":
+            label = "Left"
+        elif label_list[2].lower() == "r":
+            label = "Right"
+        concept_key = str(begin_concept_key) + '\\' + str(biomarker_category)+ " " + str(label_list[3])+ "\\" + label + "\\" + str(biomarker)
+        data_row_dict[concept_key] = biomarker_value(concept_value)
+        if header_registry.add(concept_key) and concept_tags:
+            writeOntologyTag(ontology_name, ontology_IRI, concept_key, tag_registry, session_info['accession_identifier'])
 
-    return data_header_list, data_row_dict, concept_key_list, tag_dict
+    return data_row_dict
 
 
-def writeOntologyTag(results, biomarker, concept_key, concept_key_list, tag_file, tag_dict, session):
+def writeOntologyTag(ontology_name, ontology_IRI, concept_key, tag_registry, accession_identifier):
     """
+    Function: Write the ontology tags and the accession identifier of a biomarker concept to the tag file.
 
     Parameters:
-        - results           XNAT object     Parsed QIB XML object.
-        - biomarker         XNAT object     biomarker from parsed XML.
+        - ontology_name     String          Ontology name of the biomarker.
+        - ontology_IRI      String          Ontology IRI of the biomarker.
         - concept_key        String          concept key for TranSMART
-        - concept_key_list    List            List containing the already used concept keys.
-        - tag_file           File            File for the metadata tags.
-
-    Returns:
-        -concept_key_list     List    List containing the already used concept keys.
-
+        - tag_registry      TagRegistry     Registry of the metadata tags written so far.
+        - accession_identifier  String      Accession identifier of the base session, None if there is no base session.
     """
-    ontology_name = results.biomarkers[biomarker].ontology_name
-    ontology_IRI = results.biomarkers[biomarker].ontology_iri
-    if concept_key not in concept_key_list:
-        ontology_name_row = [concept_key, "Ontology name", ontology_name]
-        ontology_iri_row = [concept_key, "Ontology IRI", ontology_IRI]
-        weight = "1"
-        tag_file.write('\t'.join(ontology_name_row) + '\t'+weight+'\n')
-        tag_file.write('\t'.join(ontology_iri_row) + '\t'+weight+'\n')
-        if len(session.base_sessions.values()) >= 1:
-            accession_identifier = session.base_sessions.values()[0].accession_identifier
-            line = concept_key + "\taccession identifier\t" + str(accession_identifier) + "\t2\n"
-            if line in tag_dict.keys():
-                tag_dict[line] = True
-                tag_file.write(line)
-        concept_key_list.append(concept_key)
-    return concept_key_list, tag_dict
+    tag_registry.add(concept_key, "Ontology name", ontology_name, 1)
+    tag_registry.add(concept_key, "Ontology IRI", ontology_IRI, 1)
+    if accession_identifier is not None:
+        tag_registry.add(concept_key, "accession identifier", accession_identifier, 2)
 
 
-def writeMetaData(session, tag_file, tag_dict, args):
+def writeMetaData(session_info, tag_registry):
     """
     Function: Write the metadata tags to the tag file.
 
     Parameters:
-        - session       XNAT object     QIB datatype object in XNATpy
-        - tag_file       File            File for the metadata tags.
-        - args          ArgumentParser
+        - session_info  Dict            QIB session information, made by retrieve_session.
+        - tag_registry  TagRegistry     Registry of the metadata tags written so far.
 
     Returns:
          - concept_key   String          concept key for TranSMART
 
     """
-    config = check_file_existence(args.tags, "Tags")
+    concept_key = session_info['concept_key']
+    with run_stats.stage("writeMetaData"):
+        i = len(session_info['tags']) + len(session_info['missing_tags'])
+        for tag, info_tag in session_info['tags']:
+            if info_tag:
+                tag_registry.add(concept_key, tag.replace('_', ' '), info_tag, i)
+                i -= 1
+        for tag in session_info['missing_tags']:
+            logging.info(tag + " not found for " + str(concept_key))
+    return concept_key
+
+
+class OrderedRegistry(object):
+    """
+    Function: Ordered set of keys, with constant time membership tests. The keys are kept in the order they are
+              added, in the list items, which can be a list that is shared with the caller.
+    """
+
+    def __init__(self, items=None):
+        self.items = items if items is not None else []
+        self.index = dict((item, position) for position, item in enumerate(self.items))
+
+    def __contains__(self, item):
+        return item in self.index
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, item):
+        """
+        Function: Add a key, when it is not in the registry yet.
+
+        Returns:
+            - new       Boolean     True when the key was added, False when it was already in the registry.
+        """
+        if item in self.index:
+            return False
+        self.index[item] = len(self.items)
+        self.items.append(item)
+        return True
+
+
+class TagRegistry(object):
+    """
+    Function: Registry of the metadata tags, a tag is written to the tag file the first time its concept key and
+              tag name are added. Later values for the same tag are ignored, so a concept gets one value per tag.
+    Parameters:
+        -tag_file   File    tags.txt, None to only keep the tags in the registry.
+    """
+
+    def __init__(self, tag_file=None):
+        self.tag_file = tag_file
+        self.tags = OrderedRegistry()
+        self.concept_tags = {}
+        self.entries = []
+
+    def __contains__(self, concept_tag):
+        return concept_tag in self.tags
+
+    def __len__(self):
+        return len(self.tags)
+
+    def add(self, concept_key, tag, value, weight):
+        """
+        Function: Write a tag line to the tag file, when the concept has no value for the tag yet.
+
+        Parameters:
+            - concept_key   String      concept key for TranSMART
+            - tag           String      Name of the tag.
+            - value         String      Value of the tag.
+            - weight        Int         Weight of the tag, the order of the tags in TranSMART.
+
+        Returns:
+            - new           Boolean     True when the tag was written.
+        """
+        if not self.tags.add((concept_key, tag)):
+            return False
+        self.concept_tags.setdefault(concept_key, []).append((tag, value))
+        self.entries.append((concept_key, tag, value, weight))
+        if self.tag_file is not None:
+            self.tag_file.write(concept_key + "\t" + tag + "\t" + str(value) + "\t" + str(weight) + "\n")
+        return True
+
+    def tags_of(self, concept_key):
+        """
+        Function: Get the tags of a concept, including the tags of the concepts above it, like the session tags
+                  that are added to the analysis tool.
+
+        Returns:
+            - tags      List    (tag name, value) tuples, the top concept first.
+        """
+        parts = concept_key.split("\\")
+        tags = []
+        for end in range(1, len(parts) + 1):
+            tags.extend(self.concept_tags.get("\\".join(parts[:end]), []))
+        return tags
+
+
+class BiomarkerNumber(float):
+    """
+    Function: Float of a biomarker value that keeps the text it was read from XNAT, so without --precision the
+              value is written to the clinical data file as it is in XNAT, 1 stays 1 and NaN stays NaN.
+    Parameters:
+        -text   String  The value as read from XNAT, without the white space around it.
+    """
+    __slots__ = ('text',)
 
+    def __new__(cls, text):
+        number = float.__new__(cls, text)
+        number.text = text
+        return number
+
+    def __reduce__(self):
+        return BiomarkerNumber, (self.text,)
+
+
+def biomarker_value(value):
+    """
+    Function: Convert a biomarker value from XNAT to a number.
+
+    Parameters:
+        - value     String          The value as read from XNAT.
+
+    Returns:
+        - value     Float           The value as BiomarkerNumber, None when the value is missing,
+                                    the value itself when it is not a number.
+    """
+    if value is None or isinstance(value, float):
+        return value
+    if hasattr(value, 'strip'):
+        text = value.strip()
+        if not text:
+            return None
+        try:
+            return BiomarkerNumber(text)
+        except ValueError:
+            return value
     try:
-        tag_list = config.get("Tags", "Taglist").split(', ')
-        analysis_tool = getattr(session, "analysis_tool")
-        analysis_tool_version = getattr(session, "analysis_tool_version")
-        if analysis_tool and analysis_tool_version:
-            concept_key = str(analysis_tool + " " + analysis_tool_version)
-        elif analysis_tool:
-            concept_key = (analysis_tool)
-        else:
-            concept_key = "Generic Tool"
-        i = len(tag_list)
-        for tag in tag_list:
-            try:
-                info_tag = getattr(session, tag)
-                if info_tag:
-                    line = concept_key + "\t" + tag.replace('_', ' ') + "\t" + str(info_tag) + "\t"+str(i)+"\n"
-                    i -= 1
-                    if line not in tag_dict.keys():
-                        tag_dict[line] = True
-                        tag_file.write(line)
-            except AttributeError:
-                logging.info(tag + " not found for " + str(concept_key))
-        return concept_key, tag_dict
+        return float(value)
+    except (TypeError, ValueError):
+        return value
+
+
+def dump_row(data_row_dict):
+    """
+    Function: Make a subject row JSON serializable without losing the text of its numbers, see load_row.
+    """
+    return dict((header, value.text if isinstance(value, BiomarkerNumber) else value)
+                for header, value in data_row_dict.items())
+
 
-    except ConfigParser.NoSectionError as e:
-        configError(e)
+def load_row(data_row_dict):
+    """
+    Function: Convert a subject row of dump_row back, the biomarker values are converted again with biomarker_value.
+    """
+    return dict((header, value if header == "subject" else biomarker_value(value))
+                for header, value in data_row_dict.items())
+
+
+def format_value(value, precision=None):
+    """
+    Function: Format a value for the clinical data file.
 
+    Parameters:
+        - value         Float       The value, strings are written as they are.
+        - precision     Int         Number of decimals of floats, None to write a BiomarkerNumber as it was read from
+                                    XNAT and other floats as the shortest text that reads back as the same float.
 
-def write_data(data_file, concept_file, data_list, data_header_list):
+    Returns:
+        - text          String      The text of the cell, empty for missing values and, except for the text of a
+                                    BiomarkerNumber, NaN.
+    """
+    if value is None:
+        return ''
+    if not isinstance(value, float):
+        return value
+    if precision is None and isinstance(value, BiomarkerNumber):
+        return value.text
+    if math.isnan(value):
+        return ''
+    if precision is None:
+        return repr(value)
+    return '%.*f' % (precision, value)
+
+
+def write_data(data_file, concept_file, data_list, data_header_list, precision=None):
     """
     Function: Writes the data from data_list to data_file.
     Parameters: 
@@ -366,92 +2766,458 @@ def write_data(data_file, concept_file, data_list, data_header_list):
         -concept_file        File    (STUDY_ID)_columns.txt, used to determine which values are in which columns for uploading to TranSMART.
         -data_list           List    List containing a directory per subject, key = header, value = value.
         -data_header_list     List    List containing all the headers.
+        -precision           Int     Number of decimals of the numbers, None to write them in full.
     """
-    data_file.write("\t".join(data_header_list) + '\n')
-    column_list = []
-    rows = []
-    for line in data_list:
-        row = []
-        i = 0
-
-        while i < len(data_header_list):
-            row.append('\t')
-            i += 1
-
-        for header in data_header_list:
-            if header in line.keys():
-                info_piece = line[header]
-                index = data_header_list.index(header)
-                row[index] = info_piece + '\t'
-                if header == "subject":
-                    concept_file.write(str(os.path.basename(data_file.name)) + '\t' + str(header) + '\t' + str(
-                        index + 1) + '\tSUBJ_ID\n')
-                elif header not in column_list:
-                    data_label = header.split("\\")[-1]
-                    concept_file.write(str(os.path.basename(data_file.name)) + '\t' + str(
-                        "\\".join(header.split("\\")[:-1])) + '\t' + str(index + 1) + '\t' + str(data_label) + '\n')
-                    column_list.append(header)
-        row[-1] = row[-1].replace('\t', '\n')
-        data_file.write(''.join(row))
-        print(''.join(row))
-        rows.append(row)
-    check_subject(rows)
+    check_subject(write_rows(data_file, concept_file, data_list, data_header_list, precision))
     data_file.close()
 
 
+def write_rows(data_file, concept_file, data_list, data_header_list, precision=None):
+    """
+    Function: Generator that writes the header and the rows to data_file, and the column map to concept_file.
+              data_list can be a generator that adds headers to data_header_list while it runs. The rows are
+              spooled to a temporary file with their column numbers until data_list is finished, then the
+              column map and the header and the rows are written. Only one row is kept in memory at a time,
+              and nothing is written when data_list raises an error, like the invalid values of write_export.
+              The column of each header is looked up in a dict and the cells are spooled in any order, so writing
+              a row takes time linear in its size. Only the columns that are new in a row are sorted.
+              The values are formatted once, with format_value, when they are spooled.
+              Only the time spent in write_rows itself is added to the write_data stage of run_stats.
+    Parameters:
+        -data_file           File    (STUDY_ID)_clinical.txt, used to upload the clinical data into TranSMART.
+        -concept_file        File    (STUDY_ID)_columns.txt, used to determine which values are in which columns for uploading to TranSMART.
+        -data_list           List    List containing a directory per subject, key = header, value = value,
+                                     or a ColumnStore.
+        -data_header_list     List    List containing all the headers.
+        -precision           Int     Number of decimals of the numbers, None to write them in full.
+    Yields:
+        -row                List    List of the cells of a row, as used by check_subject.
+    """
+    if isinstance(data_list, ColumnStore):
+        data_list = data_list.rows()
+    file_name = str(os.path.basename(data_file.name))
+    column_index = {}
+    column_set = set()
+    column_lines = []
+    spool_file = tempfile.TemporaryFile(mode='w+')
+    try:
+        for line in data_list:
+            with run_stats.stage("write_data"):
+                for index in range(len(column_index), len(data_header_list)):
+                    column_index[data_header_list[index]] = index
+                cells = []
+                new_columns = []
+                for header, info_piece in line.items():
+                    index = column_index[header]
+                    cells.append((index, format_value(info_piece, precision)))
+                    if header not in column_set:
+                        column_set.add(header)
+                        new_columns.append((index, header))
+                for index, header in sorted(new_columns):
+                    column_lines.append(column_line(file_name, header, index))
+                spool_file.write(json.dumps(cells) + '\n')
+
+        concept_file.writelines(column_lines)
+        data_file.write("\t".join(data_header_list) + '\n')
+        spool_file.seek(0)
+        for spooled_row in spool_file:
+            with run_stats.stage("write_data"):
+                row = [''] * len(data_header_list)
+                for index, info_piece in json.loads(spooled_row):
+                    row[index] = info_piece
+                data_file.write('\t'.join(row) + '\n')
+            yield [cell + '\t' for cell in row[:-1]] + [row[-1] + '\n']
+    finally:
+        spool_file.close()
+
+
+def column_line(file_name, header, index):
+    """
+    Function: Make the line of the column map file for a column of the clinical data file.
+
+    Parameters:
+        - file_name     String  Name of the clinical data file.
+        - header        String  Header of the column.
+        - index         Int     Index of the column.
+
+    Returns:
+        - line          String  Filename, category code, column number and data label of the column.
+    """
+    if header == "subject":
+        return file_name + '\t' + header + '\t' + str(index + 1) + '\tSUBJ_ID\n'
+    category_code, data_label = column_code(header)
+    return file_name + '\t' + category_code + '\t' + str(index + 1) + '\t' + data_label + '\n'
+
+
 def check_subject(rows):
     """
     Function: Checks in a log file if the subject is new or if there is information added or removed.
+              The projects of a --batch export share the subject log, so they are checked one at a time, after
+              their harvest.
 
     Parameters:
         - rows   List    List containing lists with the retrieved QIB information of a subject.
     """
-    #Could become slow, because of the way it is checking if a row is already presented. Also needs a way to read the header for each datapiece.
-
     if __name__ != "__main__":
         set_subject_logger(True)
         subject_logger = logging.getLogger("QIBSubjects")
     else:
         subject_logger = logging.getLogger("QIBSubjects")
 
-    with open(subject_logger.handlers[0].baseFilename, "r") as log_file:
-        log_data = log_file.read()
-
-    written_to_file = []
+    #The first row is only there when the harvest is finished and the rows are spooled, see write_rows, so the projects
+    #of a batch export are harvested at the same time and only their spooled rows are checked one at a time.
+    rows = iter(rows)
+    first_row = next(rows, None)
+    if first_row is None:
+        return
+    with SUBJECT_LOG_LOCK:
+        store = SubjectStore(subject_logger.handlers[0].baseFilename)
+        try:
+            check_rows(itertools.chain([first_row], rows), subject_logger, store)
+        finally:
+            store.close()
+
+
+def check_rows(rows, subject_logger, store):
+    """
+    Function: Log the rows of the subjects that are new or have new information, and add them to the subject store.
 
+    Parameters:
+        - rows              List            List containing lists with the retrieved QIB information of a subject.
+        - subject_logger    Logger          Logger that writes to the subject log.
+        - store             SubjectStore    Index of the subject log.
+    """
     for row in rows:
-        found_info = False
-        found_subject = False
-        if row[0] in log_data:
-            found_subject = True
-            print("subject found")
-            if ''.join(row) in log_data:
-                found_info = True
-                print("info found")
-
-        if not found_subject and row not in written_to_file:
-            subject_logger.info("New subject: " + ''.join(row))
-            written_to_file.append(row)
-            print ("subject log written")
-        elif not found_info and row not in written_to_file:
-            subject_logger.info("New info for Subject: " + ''.join(row))
-            written_to_file.append(row)
-            print ("info log written")
+        with run_stats.stage("check_subject"):
+            row_text = ''.join(row)
+            found_info = False
+            found_subject = False
+            if store.has_subject(row[0]):
+                found_subject = True
+                if store.has_row(row[0], row_text):
+                    found_info = True
+
+            if not found_subject:
+                subject_logger.info("New subject: " + row_text)
+                store.add(row[0], row_text)
+            elif not found_info:
+                subject_logger.info("New info for Subject: " + row_text)
+                store.add(row[0], row_text)
+
+
+class SubjectStore(object):
+    """
+    Function: SQLite index of the subject log, with a hash of every row that is logged per subject.
+              The index is stored next to the log file (QIBSubjects.log -> QIBSubjects.db). When it is opened
+              the lines that were added to the log since the last time are indexed, so existing log files are
+              imported once. When the log was emptied or replaced the index is made again.
+    Parameters:
+        -log_file       String  Location of the subject log.
+    """
+
+    def __init__(self, log_file):
+        self.log_file = log_file
+        self.database = sqlite3.connect(os.path.splitext(log_file)[0] + ".db")
+        self.database.execute("CREATE TABLE IF NOT EXISTS rows (subject TEXT, row_hash TEXT, PRIMARY KEY (subject, row_hash))")
+        self.database.execute("CREATE TABLE IF NOT EXISTS log_state (id INTEGER PRIMARY KEY, size INTEGER, head TEXT)")
+        self.import_log()
+
+    def import_log(self):
+        """
+        Function: Index the lines of the log file that are not indexed yet.
+        """
+        state = self.database.execute("SELECT size, head FROM log_state WHERE id = 0").fetchone()
+        size, head = state if state is not None else (0, None)
+        with open(self.log_file, 'rb') as log_file:
+            log_head = hashlib.md5(log_file.read(LOG_HEAD_SIZE)).hexdigest()
+            log_file.seek(0, os.SEEK_END)
+            if log_file.tell() < size or (size > 0 and log_head != head):
+                self.database.execute("DELETE FROM rows")
+                size = 0
+            log_file.seek(size)
+            for line in log_file:
+                line = line.decode('utf-8')
+                for marker in (":New subject: ", ":New info for Subject: "):
+                    if marker in line:
+                        row_text = line.split(marker, 1)[1]
+                        subject = row_text.split('\t', 1)[0] + '\t' if '\t' in row_text else row_text
+                        self.add(subject, row_text)
+                        break
+            self.set_state(log_file.tell(), log_head)
+        self.database.commit()
+
+    def set_state(self, size, head):
+        self.database.execute("INSERT OR REPLACE INTO log_state VALUES (0, ?, ?)", (size, head))
+
+    def has_subject(self, subject):
+        return self.database.execute("SELECT 1 FROM rows WHERE subject = ? LIMIT 1", (subject,)).fetchone() is not None
+
+    def has_row(self, subject, row_text):
+        return self.database.execute("SELECT 1 FROM rows WHERE subject = ? AND row_hash = ?",
+                                     (subject, row_hash(row_text))).fetchone() is not None
+
+    def add(self, subject, row_text):
+        self.database.execute("INSERT OR IGNORE INTO rows VALUES (?, ?)", (subject, row_hash(row_text)))
+
+    def close(self):
+        """
+        Function: Mark everything that is in the log file now as indexed, and close the index.
+        """
+        with open(self.log_file, 'rb') as log_file:
+            log_head = hashlib.md5(log_file.read(LOG_HEAD_SIZE)).hexdigest()
+            log_file.seek(0, os.SEEK_END)
+            self.set_state(log_file.tell(), log_head)
+        self.database.commit()
+        self.database.close()
+
+
+def row_hash(row_text):
+    return hashlib.md5(row_text.encode('utf-8')).hexdigest()
 
 
 def check_file_existence(file, type):
     try:
-        file_test = open(file, 'r')
-        config = ConfigParser.SafeConfigParser()
-        config.read(file)
+        with open(file, 'r') as file_test:
+            if sys.version_info.major == 2:
+                config = ConfigParser.SafeConfigParser()
+                config.readfp(file_test)
+            else:
+                config = ConfigParser.ConfigParser()
+                config.read_file(file_test)
         return config
 
-    except IOError:
-        print("%s config file not found") % type
+    except (IOError, TypeError):
+        print("%s config file not found" % type)
         logging.critical(type + " config file not found")
         sys.exit()
 
 
+class QIBConfig(object):
+    """
+    Function: The settings of a run. The configuration files are read and checked once, when the object is made,
+              so a mistake in them is found before the connection to XNAT is made. The object is passed to all
+              the steps instead of the ArgumentParser.
+    Parameters:
+        -args   ArgumentParser      Contains the location of the configuration files and the command line options.
+                                    Only the configuration files that are given are read.
+    """
+    url = None
+    user = None
+    password = None
+    project = None
+    base_path = None
+    study_id = None
+    security_required = None
+    top_node = None
+    tag_list = None
+
+    def __init__(self, args):
+        self.batch = getattr(args, "batch", None)
+        self.batch_workers = getattr(args, "batch_workers", None) or 1
+        self.studies = []
+        self.workers = getattr(args, "workers", None) or 1
+        self.retrieval = getattr(args, "retrieval", None) or "bulk"
+        self.engine = getattr(args, "engine", None) or "xnatpy"
+        self.cache_dir = getattr(args, "cache_dir", None)
+        self.schema_cache = getattr(args, "schema_cache", None)
+        self.cache_size = getattr(args, "cache_size", None) or DEFAULT_CACHE_SIZE
+        self.no_cache = getattr(args, "no_cache", False)
+        self.incremental = getattr(args, "incremental", None)
+        self.watch = getattr(args, "watch", False)
+        self.delta = getattr(args, "delta", False) or self.watch
+        poll_interval = getattr(args, "poll_interval", None)
+        self.poll_interval = DEFAULT_POLL_INTERVAL if poll_interval is None else poll_interval
+        debounce = getattr(args, "debounce", None)
+        self.debounce = DEFAULT_DEBOUNCE if debounce is None else debounce
+        self.webhook = getattr(args, "webhook", None)
+        self.precision = getattr(args, "precision", None)
+        self.database = getattr(args, "database", None)
+        self.report = getattr(args, "report", None)
+        self.checkpoint = getattr(args, "checkpoint", None)
+        self.checkpoint_interval = getattr(args, "checkpoint_interval", None) or DEFAULT_CHECKPOINT_INTERVAL
+        self.resume = getattr(args, "resume", False)
+        timeout = getattr(args, "timeout", None)
+        self.timeout = DEFAULT_TIMEOUT if timeout is None else timeout
+        retries = getattr(args, "retries", None)
+        self.retries = DEFAULT_RETRIES if retries is None else retries
+        backoff = getattr(args, "backoff", None)
+        self.backoff = DEFAULT_BACKOFF if backoff is None else backoff
+        self.validate = getattr(args, "validate", False)
+        self.concept_tags = getattr(args, "concept_tags", False)
+        self.value_range = getattr(args, "value_range", None)
+        self.subjects_file = getattr(args, "subjects_file", None)
+        self.shard = None
+        self.merge = getattr(args, "merge", None)
+        self.subject_labels = None
+        self.since = getattr(args, "since", None)
+        self.analysis_tool = getattr(args, "analysis_tool", None)
+        self.label_pattern = None
+        formats = getattr(args, "format", None) or ["tsv"]
+        format_registry = OrderedRegistry()
+        for output_format in (formats if isinstance(formats, list) else [formats]):
+            format_registry.add(output_format)
+        self.formats = format_registry.items
+
+        parsers = {}
+        try:
+            if getattr(args, "connection", None):
+                config = self.read(parsers, args.connection, "connection")
+                self.url = config.get('Connection', 'url')
+                self.user = config.get('Connection', 'user')
+                self.password = config.get('Connection', 'password')
+                if not self.batch:
+                    self.project = config.get('Connection', 'project')
+            if getattr(args, "params", None):
+                config = self.read(parsers, args.params, "Params")
+                self.base_path = config.get('Directory', 'path')
+                self.study_id = config.get('Study', 'STUDY_ID')
+                self.security_required = config.get('Study', 'SECURITY_REQUIRED')
+                self.top_node = config.get('Study', 'TOP_NODE')
+            if getattr(args, "tags", None):
+                config = self.read(parsers, args.tags, "Tags")
+                self.tag_list = config.get("Tags", "Taglist").split(', ')
+            if self.batch:
+                config = self.read(parsers, self.batch, "Batch")
+                for project in config.sections():
+                    study = {'project': project, 'study_id': config.get(project, 'STUDY_ID'),
+                             'top_node': config.get(project, 'TOP_NODE')}
+                    if config.has_option(project, 'SECURITY_REQUIRED'):
+                        study['security_required'] = config.get(project, 'SECURITY_REQUIRED')
+                    if config.has_option(project, 'path'):
+                        study['base_path'] = config.get(project, 'path')
+                    self.studies.append(study)
+        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError) as e:
+            configError(e)
+        if self.subjects_file:
+            try:
+                with open(self.subjects_file, 'r') as open_subjects_file:
+                    self.subject_labels = set(line.strip() for line in open_subjects_file
+                                              if line.strip() and not line.startswith('#'))
+            except IOError as e:
+                configError(e)
+        if getattr(args, "shard", None):
+            try:
+                self.shard = tuple(int(part) for part in args.shard.split('/'))
+            except ValueError:
+                self.shard = ()
+            if len(self.shard) != 2 or not 1 <= self.shard[0] <= self.shard[1]:
+                configError(ValueError("--shard should be i/N, with i from 1 to N."))
+            elif self.checkpoint:
+                #Every shard has its own checkpoint, also when the shards run in the same directory.
+                root, extension = os.path.splitext(self.checkpoint)
+                self.checkpoint = "%s_%s_%d_of_%d%s" % (root, self.study_id, self.shard[0], self.shard[1], extension)
+        if getattr(args, "label_pattern", None):
+            try:
+                self.label_pattern = re.compile(args.label_pattern)
+            except re.error as e:
+                configError(ValueError("--label-pattern is not a valid regular expression: " + str(e)))
+
+        if self.workers < 1:
+            configError(ValueError("--workers should be at least 1."))
+        if self.retrieval not in ("bulk", "crawl"):
+            configError(ValueError("--retrieval should be bulk or crawl."))
+        if self.engine not in ENGINES:
+            configError(ValueError("--engine should be one of " + ", ".join(ENGINES) + "."))
+        if self.security_required is not None and self.security_required not in ("Y", "N"):
+            configError(ValueError("SECURITY_REQUIRED should be Y or N."))
+        if self.batch_workers < 1:
+            configError(ValueError("--batch-workers should be at least 1."))
+        for study in self.studies:
+            if study.get('security_required', "Y") not in ("Y", "N"):
+                configError(ValueError("SECURITY_REQUIRED of " + study['project'] + " should be Y or N."))
+        if len(set(study['study_id'] for study in self.studies)) < len(self.studies):
+            configError(ValueError("Every project in the --batch file should have its own STUDY_ID."))
+        if self.checkpoint_interval < 1:
+            configError(ValueError("--checkpoint-interval should be at least 1."))
+        if self.resume and not self.checkpoint:
+            configError(ValueError("--resume needs a --checkpoint."))
+        if self.shard and (self.resume or self.batch):
+            configError(ValueError("--shard can not be used with --resume or --batch."))
+        if self.watch and not self.incremental:
+            configError(ValueError("--watch needs an --incremental state."))
+        if self.watch and (self.batch or self.shard or self.merge or self.resume):
+            configError(ValueError("--watch can not be used with --batch, --shard, --merge or --resume."))
+        if self.webhook is not None and not self.watch:
+            configError(ValueError("--webhook can only be used with --watch."))
+        if self.poll_interval <= 0 or self.debounce < 0:
+            configError(ValueError("--poll-interval should be more than 0, --debounce should be at least 0."))
+        if self.retries < 0 or self.backoff < 0 or self.timeout <= 0:
+            configError(ValueError("--retries and --backoff should be at least 0, --timeout should be more than 0."))
+        if self.precision is not None and self.precision < 0:
+            configError(ValueError("--precision should be at least 0."))
+        if self.since and not any(valid_date(self.since, date_format) for date_format in SINCE_FORMATS):
+            configError(ValueError("--since should be a date, YYYY-MM-DD or YYYY-MM-DD HH:MM:SS."))
+        if self.value_range is not None and self.value_range[0] > self.value_range[1]:
+            configError(ValueError("The minimum of --value-range should not be larger than the maximum."))
+        for output_format in self.formats:
+            if output_format not in OUTPUT_FORMATS:
+                configError(ValueError("--format should be one of " + ", ".join(OUTPUT_FORMATS) + "."))
+            elif output_format in ("parquet", "feather") and pyarrow is None:
+                configError(ImportError("pyarrow is needed for --format " + output_format + "."))
+        if "database" in self.formats:
+            if not self.database:
+                configError(ValueError("--format database needs a --database."))
+            elif self.delta:
+                configError(ValueError("--format database replaces the whole study, it can not be used with --delta or --watch."))
+            elif not self.database.startswith("sqlite:") and psycopg2 is None:
+                configError(ImportError("psycopg2 is needed for --format database with PostgreSQL."))
+
+    def for_study(self, study):
+        """
+        Function: Make the settings of a study of the --batch file. The --incremental state and the --checkpoint
+                  get the project in their name, so every project has its own.
+
+        Parameters:
+            - study     Dict        project, study_id, top_node and optionally security_required and base_path.
+
+        Returns:
+            - config    QIBConfig   The settings of the run, with the settings of the study.
+        """
+        config = copy.copy(self)
+        for name, value in study.items():
+            setattr(config, name, value)
+        for name in ("incremental", "checkpoint"):
+            file_name = getattr(self, name)
+            if file_name:
+                root, extension = os.path.splitext(file_name)
+                setattr(config, name, root + "_" + study['project'] + extension)
+        return config
+
+    def read(self, parsers, file, type):
+        """
+        Function: Parse a configuration file, every file is parsed once.
+        """
+        if file not in parsers:
+            parsers[file] = check_file_existence(file, type)
+        return parsers[file]
+
+
+def valid_date(text, date_format):
+    """
+    Function: Check if text is a date in date_format.
+    """
+    try:
+        time.strptime(text, date_format)
+    except ValueError:
+        return False
+    return True
+
+
+def as_config(args):
+    """
+    Function: Get the settings of the run.
+
+    Parameters:
+        - args      ArgumentParser or QIBConfig     Contains the location of the configuration files.
+
+    Returns:
+        - config    QIBConfig                       args itself when it is a QIBConfig already.
+    """
+    if isinstance(args, QIBConfig):
+        return args
+    return QIBConfig(args)
+
+
 def configError(e):
     """
     Function: Error for when a variable is not found in a config file.
@@ -485,7 +3251,71 @@ if __name__ == "__main__":
     parser.add_argument("--connection", help="Location of the configuration file for establishing XNAT connection.")
     parser.add_argument("--params", help="Location of the configuration file for the variables in the .params files.")
     parser.add_argument("--tags", help="Location of the configuration file for the tags.")
+    parser.add_argument("--schema-cache",
+                        help="Directory of the cache of the xnatpy classes of the XNAT data model, no cache without it.")
+    parser.add_argument("--workers", type=int, default=1, help="Number of threads that retrieve the data from XNAT.")
+    parser.add_argument("--retrieval", choices=["bulk", "crawl"], default="bulk",
+                        help="Find the QIB experiments with one project listing (bulk) or by listing every subject (crawl).")
+    parser.add_argument("--engine", choices=ENGINES, default="xnatpy",
+                        help="Read the QIB sessions with the xnatpy objects or from their XML (rest).")
+    parser.add_argument("--cache-dir", default="QIBcache", help="Directory of the session cache.")
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_CACHE_SIZE, help="Maximum size of the session cache in MB.")
+    parser.add_argument("--no-cache", action="store_true", help="Always download all the sessions from XNAT.")
+    parser.add_argument("--incremental", help="Location of the state file for an incremental export.")
+    parser.add_argument("--delta", action="store_true",
+                        help="Only write the subjects that are new or changed since the last incremental export.")
+    parser.add_argument("--format", nargs="+", choices=OUTPUT_FORMATS, default=["tsv"],
+                        help="Output formats, tsv for TranSMART, parquet or feather for a biomarker table (needs pyarrow), "
+                             "database for the staging tables of the tranSMART database.")
+    parser.add_argument("--database",
+                        help="libpq connection string of the tranSMART database for --format database, or sqlite:FILE.")
+    parser.add_argument("--precision", type=int, help="Number of decimals of the numbers in the clinical data file.")
+    parser.add_argument("--validate", action="store_true",
+                        help="Check the numbers of all the subjects for NaN and infinite values before writing the files.")
+    parser.add_argument("--value-range", type=float, nargs=2, metavar=("MIN", "MAX"),
+                        help="Also check that all the numbers are between MIN and MAX, implies --validate.")
+    parser.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT, help="Seconds to wait for an answer of XNAT.")
+    parser.add_argument("--retries", type=int, default=DEFAULT_RETRIES,
+                        help="Number of retries of a XNAT request after a connection error or a 5xx status.")
+    parser.add_argument("--backoff", type=float, default=DEFAULT_BACKOFF,
+                        help="Seconds before the first retry, doubled for every next retry.")
+    parser.add_argument("--checkpoint", default="QIBcheckpoint.db",
+                        help="Location of the checkpoint of the harvest, empty for no checkpoint.")
+    parser.add_argument("--checkpoint-interval", type=int, default=DEFAULT_CHECKPOINT_INTERVAL,
+                        help="Number of subjects between two saves of the checkpoint.")
+    parser.add_argument("--resume", action="store_true", help="Continue the harvest of the last run from its checkpoint.")
+    parser.add_argument("--subjects-file", help="Location of a file with the labels of the subjects to export, one per line.")
+    parser.add_argument("--since", help="Only export the QIB sessions that were added or changed since this date, YYYY-MM-DD.")
+    parser.add_argument("--analysis-tool", help="Only export the QIB sessions of this analysis tool, its name or name and version.")
+    parser.add_argument("--label-pattern", help="Only export the QIB sessions with a label that matches this regular expression.")
+    parser.add_argument("--shard", metavar="i/N", help="Only export shard i of N of the subjects, to a partial output for --merge.")
+    parser.add_argument("--merge", nargs="+", metavar="FILE",
+                        help="Merge the partial outputs of all the shards of a --shard export into the study directory.")
+    parser.add_argument("--watch", action="store_true",
+                        help="Keep running and export the new and changed QIB sessions to micro-batch directories.")
+    parser.add_argument("--poll-interval", type=float, default=DEFAULT_POLL_INTERVAL,
+                        help="Seconds between two listings of the QIB experiments of --watch.")
+    parser.add_argument("--debounce", type=float, default=DEFAULT_DEBOUNCE,
+                        help="Seconds the listing should not change before a micro-batch of --watch is exported.")
+    parser.add_argument("--webhook", type=int, metavar="PORT",
+                        help="Port on localhost for a webhook of the XNAT event service that starts a poll of --watch.")
+    parser.add_argument("--batch", help="Location of the configuration file with the projects of a batch export.")
+    parser.add_argument("--batch-workers", type=int, default=1, help="Number of projects of a batch export that are exported at the same time.")
+    parser.add_argument("--report", default="QIBreport.json",
+                        help="Location of the JSON report with the timing of the stages of the run, empty for no report.")
+    parser.add_argument("--profile", help="Location of a cProfile dump of the run.")
     args = parser.parse_args()
+    if args.value_range:
+        args.validate = True
+    if args.delta and not args.incremental:
+        parser.error("--delta can only be used with --incremental")
     logging.basicConfig(filename="QIBlog.log", format='%(asctime)s:%(levelname)s:%(message)s', level=logging.INFO)
     set_subject_logger(False)
-    main(args)
+    if args.profile:
+        profiler = cProfile.Profile()
+        try:
+            profiler.runcall(main, args)
+        finally:
+            profiler.dump_stats(args.profile)
+    else:
+        main(args)
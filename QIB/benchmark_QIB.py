@@ -0,0 +1,346 @@
+'''
+Name: benchmark_QIB
+Function: Benchmarks for the parts of QIBPrototype that have to scale with the size of a project, as pytest-benchmark tests.
+Author: Jarno van Erp
+Company: The Hyve
+
+Benchmarks:
+   - Checking subjects against a growing subject log (test_subject_log)
+   - Writing the clinical data file, compared with the old implementation (test_write_data)
+   - Memory use of the harvested data, list of dicts compared with ColumnStore (test_store_memory)
+   - Registering concept keys and metadata tags, lists compared with the registries (test_registry)
+   - The whole export of a synthetic project from fake_xnat, obtain_data, write_data and check_subject
+     (test_pipeline)
+   - Parsing the XML of large QIB sessions with the rest engine (test_parse_session_xml), and obtain_data with both
+     engines (test_engine)
+   - Connecting to a XNAT without, with a cold and with a warm schema cache (test_startup), it needs the configuration
+     file of a XNAT in the environment variable QIB_CONNECTION and is skipped without it
+
+Usage:
+    pytest benchmark_QIB.py --benchmark-compare=benchmarks/baseline.json --benchmark-compare-fail=median:25%
+
+The run fails when the median of a benchmark is more than 25% slower than in the baseline. The baseline is made on one
+machine, make it again on the machine that runs the comparison, and after an intended change of the performance:
+    pytest benchmark_QIB.py --benchmark-json=benchmarks/baseline.json
+Numbers that are not times, like the memory use and the requests to XNAT, are stored in the extra_info of a benchmark.
+'''
+
+import argparse
+import io
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import pytest
+import fake_xnat
+import QIBPrototype
+
+
+def write_log(log_file, history_size):
+    """
+    Function: Write a subject log with history_size subjects.
+    """
+    with open(log_file, 'w') as open_log_file:
+        for i in range(history_size):
+            open_log_file.write("2017-02-21 16:27:26,552:New subject: subject%d\tfoo\t%d\n\n" % (i, i))
+
+
+@pytest.mark.parametrize("history_size", [10000, 100000, 1000000])
+def test_subject_log(benchmark, tmpdir, history_size, checked_rows=1000):
+    """
+    Function: Time check_rows for a subject log with a growing number of entries. The time to check the rows should
+              stay the same when the history grows, the one-time import of the existing log is done before.
+              Half of the rows are known subjects with new information, the other half are new subjects, every round
+              has its own new information and new subjects.
+    """
+    log_file = str(tmpdir.join("QIBSubjects.log"))
+    write_log(log_file, history_size)
+    QIBPrototype.SubjectStore(log_file).close()
+    subject_logger, handler = open_subject_logger("QIBSubjectsBenchmark%d" % history_size, log_file)
+    rounds = []
+
+    def setup():
+        round_number = len(rounds)
+        rounds.append(round_number)
+        rows = [["subject%d\t" % (i * (history_size // checked_rows)), "bar%d\n" % round_number] for i in range(checked_rows // 2)]
+        rows += [["new_subject%d_%d\t" % (round_number, i), "bar\n"] for i in range(checked_rows // 2)]
+        return (rows,), {}
+
+    def check(rows):
+        store = QIBPrototype.SubjectStore(log_file)
+        QIBPrototype.check_rows(rows, subject_logger, store)
+        store.close()
+
+    try:
+        benchmark.pedantic(check, setup=setup, rounds=10, warmup_rounds=1)
+    finally:
+        handler.close()
+        subject_logger.removeHandler(handler)
+
+
+def open_subject_logger(name, log_file):
+    """
+    Function: Make a subject logger like set_subject_logger, that writes to log_file.
+
+    Returns:
+        - subject_logger    Logger          The logger.
+        - handler           FileHandler     Its handler, to be closed and removed after the benchmark.
+    """
+    subject_logger = logging.getLogger(name)
+    subject_logger.propagate = False
+    handler = logging.FileHandler(log_file)
+    handler.setFormatter(logging.Formatter('%(asctime)s:%(message)s'))
+    subject_logger.addHandler(handler)
+    subject_logger.setLevel(logging.INFO)
+    return subject_logger, handler
+
+
+def synthetic_rows(subjects, columns):
+    """
+    Function: Generate the rows of a synthetic project, every subject has a value for every column.
+
+    Parameters:
+        - subjects      Int     Number of subjects.
+        - columns       Int     Number of biomarker columns.
+
+    Returns:
+        - data_header_list  List        The headers.
+        - data_list         Generator   The rows, made one at a time to keep the memory use low.
+    """
+    data_header_list = ['subject'] + ["Tool 0.1\\Category %d T0\\Left\\biomarker %d" % (i // 10, i) for i in range(columns)]
+    template = dict((header, "%d.5" % i) for i, header in enumerate(data_header_list))
+    data_list = (dict(template, subject="subject%d" % i) for i in range(subjects))
+    return data_header_list, data_list
+
+
+def legacy_write_rows(data_file, concept_file, data_list, data_header_list):
+    """
+    Function: The implementation of write_data before the column index map, without the check_subject call.
+    """
+    data_file.write("\t".join(data_header_list) + '\n')
+    column_list = []
+    rows = []
+    for line in data_list:
+        row = []
+        i = 0
+
+        while i < len(data_header_list):
+            row.append('\t')
+            i += 1
+
+        for header in data_header_list:
+            if header in line.keys():
+                info_piece = line[header]
+                index = data_header_list.index(header)
+                row[index] = info_piece + '\t'
+                if header == "subject":
+                    concept_file.write(str(os.path.basename(data_file.name)) + '\t' + str(header) + '\t' + str(
+                        index + 1) + '\tSUBJ_ID\n')
+                elif header not in column_list:
+                    data_label = header.split("\\")[-1]
+                    concept_file.write(str(os.path.basename(data_file.name)) + '\t' + str(
+                        "\\".join(header.split("\\")[:-1])) + '\t' + str(index + 1) + '\t' + str(data_label) + '\n')
+                    column_list.append(header)
+        row[-1] = row[-1].replace('\t', '\n')
+        data_file.write(''.join(row))
+        rows.append(row)
+    return rows
+
+
+@pytest.mark.parametrize("name, subjects", [("legacy", 20), ("write_rows", 20), ("write_rows", 5000)])
+def test_write_data(benchmark, tmpdir, name, subjects, columns=3000):
+    """
+    Function: Time write_rows for a synthetic project, and the old implementation for 20 subjects only, because it
+              takes time quadratic in the number of columns per subject.
+    """
+    function = legacy_write_rows if name == "legacy" else QIBPrototype.write_rows
+
+    def write():
+        data_header_list, data_list = synthetic_rows(subjects, columns)
+        with open(str(tmpdir.join("data.txt")), 'w') as data_file:
+            with open(str(tmpdir.join("columns.txt")), 'w') as concept_file:
+                for row in function(data_file, concept_file, data_list, data_header_list):
+                    pass
+
+    benchmark.pedantic(write, rounds=5 if subjects < 1000 else 1, warmup_rounds=1 if subjects < 1000 else 0)
+
+
+def harvested_rows(subjects, columns):
+    """
+    Function: Generate the rows of a synthetic project like harvest does, the concept keys are made per subject,
+              so every dict has its own copies.
+    """
+    for i in range(subjects):
+        data_row_dict = {'subject': "subject%d" % i}
+        for j in range(columns):
+            data_row_dict["Tool 0.1" + "\\Category %d T0" % (j // 10) + "\\Left\\" + "biomarker %d" % j] = "%d.%d" % (i, j)
+        yield data_row_dict
+
+
+@pytest.mark.skipif(sys.version_info.major == 2, reason="tracemalloc is not available in Python 2")
+def test_store_memory(benchmark, subjects=2000, columns=1000):
+    """
+    Function: Compare the memory use of a list of dicts per subject, as returned by obtain_data, with a ColumnStore.
+              The time to fill the ColumnStore is benchmarked, the memory of both is in the extra_info, in MB.
+    """
+    import tracemalloc
+    tracemalloc.start()
+    data_list = list(harvested_rows(subjects, columns))
+    list_memory = tracemalloc.get_traced_memory()[0] / 1e6
+    del data_list
+    tracemalloc.stop()
+    tracemalloc.start()
+    store = QIBPrototype.ColumnStore()
+    for data_row_dict in harvested_rows(subjects, columns):
+        store.append(data_row_dict)
+    store_memory = tracemalloc.get_traced_memory()[0] / 1e6
+    tracemalloc.stop()
+    del store
+    benchmark.extra_info.update({'list_of_dicts_mb': list_memory, 'column_store_mb': store_memory})
+
+    def fill():
+        store = QIBPrototype.ColumnStore()
+        for data_row_dict in harvested_rows(subjects, columns):
+            store.append(data_row_dict)
+
+    benchmark.pedantic(fill, rounds=1)
+    assert store_memory < list_memory / 2
+
+
+@pytest.mark.parametrize("name, concepts", [("legacy", 10000), ("registry", 10000), ("registry", 100000)])
+def test_registry(benchmark, tmpdir, name, concepts, tags_per_concept=5):
+    """
+    Function: Time the registration of the concept keys and their metadata tags of a synthetic project, every
+              concept is seen twice, like a biomarker that is found for two subjects. The old implementation, with
+              lists of concept keys and a scan of the tag lines, is only timed for 10000 concepts, because it takes
+              time quadratic in the number of concepts.
+    """
+    def legacy_register(concept_keys, tag_file):
+        data_header_list = []
+        tag_dict = {}
+        for concept_key in concept_keys:
+            if concept_key not in data_header_list:
+                data_header_list.append(concept_key)
+            for i in range(tags_per_concept):
+                line = concept_key + "\ttag %d\tvalue\t%d\n" % (i, i)
+                if line not in tag_dict.keys():
+                    tag_dict[line] = True
+                    tag_file.write(line)
+        return data_header_list
+
+    def register(concept_keys, tag_file):
+        data_header_list = []
+        header_registry = QIBPrototype.OrderedRegistry(data_header_list)
+        tag_registry = QIBPrototype.TagRegistry(tag_file)
+        for concept_key in concept_keys:
+            header_registry.add(concept_key)
+            for i in range(tags_per_concept):
+                tag_registry.add(concept_key, "tag %d" % i, "value", i)
+        return data_header_list
+
+    function = legacy_register if name == "legacy" else register
+    concept_keys = ["Tool 0.1\\Category %d T0\\Left\\biomarker %d" % (i // 10, i) for i in range(concepts)]
+
+    def run():
+        with open(str(tmpdir.join("tags.txt")), 'w') as tag_file:
+            function(concept_keys + concept_keys, tag_file)
+
+    benchmark.pedantic(run, rounds=5, warmup_rounds=1)
+
+
+@pytest.mark.parametrize("workers", [1, 8])
+def test_pipeline(benchmark, tmpdir, workers, subjects=200, sessions=8, categories=4, biomarkers=3, latency=0.005):
+    """
+    Function: Time the export of a synthetic fake_xnat project end to end: obtain_data, then write_rows and check_rows
+              into a new subject log. The seconds of the stages from run_stats, the sessions per second and the
+              number of requests are in the extra_info.
+    """
+    results = {}
+
+    def export():
+        connection = fake_xnat.synthetic_connection(subjects, sessions, categories, biomarkers, latency)
+        config = QIBPrototype.QIBConfig(argparse.Namespace(workers=workers, no_cache=True))
+        config.tag_list = ['analysis_tool', 'analysis_tool_version', 'description', 'review_status']
+        output_dir = tempfile.mkdtemp(dir=str(tmpdir))
+        QIBPrototype.run_stats.reset()
+        with open(os.path.join(output_dir, "tags.txt"), 'w') as tag_file:
+            data_list, data_header_list = QIBPrototype.obtain_data(connection.projects['Synthetic'], tag_file, config)
+        subject_logger, handler = open_subject_logger("QIBSubjectsPipeline%d" % workers,
+                                                      os.path.join(output_dir, "QIBSubjects.log"))
+        store = QIBPrototype.SubjectStore(handler.baseFilename)
+        with open(os.path.join(output_dir, "data.txt"), 'w') as data_file:
+            with open(os.path.join(output_dir, "columns.txt"), 'w') as concept_file:
+                QIBPrototype.check_rows(QIBPrototype.write_rows(data_file, concept_file, data_list, data_header_list),
+                                        subject_logger, store)
+        store.close()
+        handler.close()
+        subject_logger.removeHandler(handler)
+        shutil.rmtree(output_dir)
+        stages = QIBPrototype.run_stats.report()['stages']
+        results.update({'write_data': stages['write_data']['seconds'], 'check_subject': stages['check_subject']['seconds'],
+                        'requests': connection.requests})
+
+    benchmark.pedantic(export, rounds=3)
+    results['sessions_per_second'] = subjects * sessions / benchmark.stats.stats.median
+    benchmark.extra_info.update(results)
+
+
+def test_parse_session_xml(benchmark, sessions=200, categories=50, biomarkers=20):
+    """
+    Function: Time parse_session_xml on sessions with many biomarkers, the biomarkers per second are in the extra_info.
+    """
+    connection = fake_xnat.synthetic_connection(1, 1, categories, biomarkers)
+    xml = fake_xnat.session_xml(connection.experiment_dict["SYN_E00000_01"])
+
+    def parse():
+        for session_index in range(sessions):
+            QIBPrototype.parse_session_xml(io.BytesIO(xml), ['analysis_tool', 'description'])
+
+    benchmark.pedantic(parse, rounds=5, warmup_rounds=1)
+    benchmark.extra_info['biomarkers_per_second'] = sessions * categories * biomarkers / benchmark.stats.stats.median
+
+
+@pytest.mark.parametrize("engine", QIBPrototype.ENGINES)
+def test_engine(benchmark, engine, subjects=200):
+    """
+    Function: Time obtain_data of a synthetic project with the xnatpy and rest engines. The xnatpy engine reads the
+              fake_xnat objects here, which are plain Python objects without the schema checks and lazy requests of
+              xnatpy, so on a real XNAT the difference is larger. The XML is made before the timing, it is the work
+              of the XNAT server.
+    """
+    def setup():
+        connection = fake_xnat.synthetic_connection(subjects, 8, 4, 3)
+        for experiment_id, record in connection.experiment_dict.items():
+            connection.xml_documents[experiment_id] = fake_xnat.session_xml(record)
+        config = QIBPrototype.QIBConfig(argparse.Namespace(engine=engine, no_cache=True))
+        config.tag_list = ['analysis_tool', 'analysis_tool_version', 'description', 'review_status']
+        return (connection.projects['Synthetic'], None, config), {}
+
+    benchmark.pedantic(QIBPrototype.obtain_data, setup=setup, rounds=3)
+
+
+@pytest.mark.skipif(not os.environ.get("QIB_CONNECTION"), reason="needs the configuration file of a XNAT in QIB_CONNECTION")
+@pytest.mark.parametrize("start", ["no_cache", "cold", "warm"])
+def test_startup(benchmark, tmpdir, start):
+    """
+    Function: Time make_connection to the XNAT of the QIB_CONNECTION file: without schema cache, with an empty schema
+              cache (cold) and with the cache of an earlier start (warm).
+    """
+    schema_dir = str(tmpdir.join("schemas"))
+
+    def setup():
+        if os.path.exists(schema_dir) and start == "cold":
+            shutil.rmtree(schema_dir)
+        return (QIBPrototype.QIBConfig(argparse.Namespace(connection=os.environ["QIB_CONNECTION"],
+                                                          schema_cache=None if start == "no_cache" else schema_dir)),), {}
+
+    def connect(config):
+        project, connection = QIBPrototype.make_connection(config)
+        if connection is None:
+            raise RuntimeError("Could not connect to XNAT: " + str(project))
+        connection.disconnect()
+
+    if start == "warm":
+        connect(setup()[0][0])
+    benchmark.pedantic(connect, setup=setup, rounds=3)
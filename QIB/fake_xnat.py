@@ -0,0 +1,477 @@
+'''
+Name: fake_xnat
+Function: Stand-in for an xnatpy connection that replays recorded XNAT projects, so the harvesting can be tested offline.
+Author: Jarno van Erp
+Company: The Hyve
+
+The recorded projects are stored as JSON (test_files/xnat_projects.json). Only the parts of the xnatpy interface that are
+used by QIBPrototype are implemented. Every call that would be a REST request on a real XNAT is counted in
+FakeConnection.requests, and can be given a latency to simulate a remote XNAT. The experiments in
+FakeConnection.fail_experiments raise XNATResponseError when they are retrieved, to test the handling of errors.
+The experiment listings support the xsiType filter and the columns of a datatype field, like
+qib:qibSessionData/analysis_tool. The name of such a column is returned in lower case, QIBPrototype accepts any case.
+FakeConnection.get serves the XML of an experiment, made from the recording by session_xml.
+
+RecordedXNATServer serves the same recordings as the REST API of XNAT on a local HTTP server, for a real xnatpy
+connection made with xnat.connect(server.url, no_parse_model=True). The subject and experiment listings and the XML of
+the sessions then go through xnatpy and requests, with the query encoding, response hooks and adapters of a real run.
+Without the data model of XNAT only --engine rest can read the sessions, ConnectedProject is the project of such a
+connection.
+
+Synthetic projects of any size can be made with synthetic_connection, for the benchmarks in benchmark_QIB.py.
+'''
+
+import collections
+import json
+import random
+import sys
+import threading
+import time
+from xml.etree import ElementTree
+if sys.version_info.major == 3:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from urllib.parse import parse_qsl, urlparse
+elif sys.version_info.major == 2:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from urlparse import parse_qsl, urlparse
+
+
+def load_connection(fixture_file="test_files/xnat_projects.json"):
+    """
+    Function: Create a fake connection for the recorded projects.
+
+    Parameters:
+        - fixture_file  String          Location of the JSON file with the recorded projects.
+
+    Returns:
+        - connection    FakeConnection  Connection that replays the recorded projects.
+    """
+    return FakeConnection(load_projects(fixture_file))
+
+
+def load_projects(fixture_file="test_files/xnat_projects.json"):
+    """
+    Function: Read the recorded projects, for FakeConnection or RecordedXNATServer.
+
+    Returns:
+        - projects      List            Record per project.
+    """
+    with open(fixture_file, 'r') as open_fixture_file:
+        return json.load(open_fixture_file, object_pairs_hook=collections.OrderedDict)['projects']
+
+
+def synthetic_connection(subjects=100, sessions=8, categories=2, biomarkers=3, latency=0.0, seed=0, tools=1):
+    """
+    Function: Create a fake connection with one synthetic project, Synthetic.
+
+    Parameters:
+        - subjects      Int             Number of subjects.
+        - sessions      Int             Number of QIB sessions per subject, alternating left and right, time points T0, T1, ...
+        - categories    Int             Number of biomarker categories per session.
+        - biomarkers    Int             Number of biomarkers per category.
+        - latency       Float           Seconds every request takes.
+        - seed          Int             Seed of the random biomarker values, the same seed gives the same project.
+        - tools         Int             Number of analysis tool versions, subject i is analysed with version 1.(i % tools).
+
+    Returns:
+        - connection    FakeConnection  Connection to the synthetic project.
+    """
+    return FakeConnection([synthetic_project(subjects, sessions, categories, biomarkers, seed, tools)], latency)
+
+
+def synthetic_project(subjects, sessions, categories, biomarkers, seed=0, tools=1):
+    """
+    Function: Make the record of a synthetic project, in the format of test_files/xnat_projects.json.
+              Every subject has an MR session, which is the base session of its QIB sessions.
+    """
+    values = random.Random(seed)
+    subject_list = []
+    for subject_index in range(subjects):
+        label = "SYN%05d" % subject_index
+        base_session = {'ID': "SYN_E%05d_00" % subject_index, 'label': label + "_MR", 'xsiType': 'xnat:mrSessionData',
+                        'last_modified': '2017-02-20 14:10:07.512'}
+        experiments = [base_session]
+        for session_index in range(sessions):
+            experiments.append({
+                'ID': "SYN_E%05d_%02d" % (subject_index, session_index + 1),
+                'label': "%s_QIB_%s_T%d" % (label, "LR"[session_index % 2], session_index // 2),
+                'xsiType': 'qib:qibSessionData',
+                'last_modified': '2017-02-20 14:11:07.512',
+                'fields': {'analysis_tool': 'Synthetic Tool', 'analysis_tool_version': '1.%d' % (subject_index % tools),
+                           'description': 'Synthetic biomarkers', 'review_status': 'Not reviewed'},
+                'biomarker_categories': [{'name': 'Category %d' % category_index,
+                                          'biomarkers': [{'name': 'biomarker %d' % biomarker_index,
+                                                          'value': repr(round(values.uniform(0, 10000), 3)),
+                                                          'ontology_name': 'Volume',
+                                                          'ontology_iri': 'http://purl.obolibrary.org/obo/PATO_0000918'}
+                                                         for biomarker_index in range(biomarkers)]}
+                                         for category_index in range(categories)],
+                'base_sessions': [{'accession_identifier': base_session['ID']}]})
+        subject_list.append({'ID': "SYN_S%05d" % subject_index, 'label': label, 'experiments': experiments})
+    return {'ID': 'Synthetic', 'subjects': subject_list}
+
+
+QIB_NAMESPACE = 'http://www.bigr.nl/qib'
+ElementTree.register_namespace('qib', QIB_NAMESPACE)
+
+
+def session_xml(record):
+    """
+    Function: Make the XML of a recorded QIB experiment, as XNAT returns it for /data/experiments/ID?format=xml.
+              The fields without value are left out, like XNAT does.
+
+    Returns:
+        - xml           Bytes           The XML document.
+    """
+    def qib(name):
+        return '{' + QIB_NAMESPACE + '}' + name
+
+    root = ElementTree.Element(qib('qibSessionData'), {'ID': record['ID'], 'label': record['label']})
+    for name, value in record.get('fields', {}).items():
+        if value is not None:
+            ElementTree.SubElement(root, qib(name)).text = value
+    if record.get('base_sessions'):
+        base_sessions = ElementTree.SubElement(root, qib('base_sessions'))
+        for base_session in record['base_sessions']:
+            element = ElementTree.SubElement(base_sessions, qib('base_session'))
+            ElementTree.SubElement(element, qib('accession_identifier')).text = base_session['accession_identifier']
+    categories = ElementTree.SubElement(root, qib('biomarker_categories'))
+    for category in record.get('biomarker_categories', []):
+        category_element = ElementTree.SubElement(categories, qib('biomarker_category'), {'name': category['name']})
+        biomarkers = ElementTree.SubElement(category_element, qib('biomarkers'))
+        for biomarker in category['biomarkers']:
+            biomarker_element = ElementTree.SubElement(biomarkers, qib('biomarker'), {'name': biomarker['name']})
+            for name in ('value', 'ontology_name', 'ontology_iri'):
+                if biomarker.get(name) is not None:
+                    ElementTree.SubElement(biomarker_element, qib(name)).text = biomarker[name]
+    return ElementTree.tostring(root, encoding='utf-8')
+
+
+def experiment_listing(project, subject_id, query):
+    """
+    Function: Make the experiment listing of a recorded project, or of one subject, as XNAT returns it for
+              /data/projects/ID/experiments?format=json. The listing supports the xsiType filter and the columns
+              of a datatype field, the name of such a column is in lower case.
+
+    Parameters:
+        - project       Dict            Record of the project.
+        - subject_id    String          ID of the subject to list the experiments of, None for the whole project.
+        - query         Dict            Query parameters of the listing.
+
+    Returns:
+        - result        Dict            The listing, with its rows in result['ResultSet']['Result'].
+    """
+    columns = query.get('columns', 'ID,label').split(',')
+    xsi_type = query.get('xsiType')
+    rows = []
+    for subject in project['subjects']:
+        if subject_id is not None and subject['ID'] != subject_id:
+            continue
+        for experiment in subject['experiments']:
+            if xsi_type and experiment.get('xsiType', '').lower() != xsi_type.lower():
+                continue
+            row = dict((column.lower(), experiment.get('fields', {}).get(column.split('/')[-1]) or '')
+                       if '/' in column else (column, experiment.get(column, '')) for column in columns)
+            if 'subject_ID' in columns:
+                row['subject_ID'] = subject['ID']
+            row['URI'] = '/data/experiments/' + experiment['ID']
+            rows.append(row)
+    return {'ResultSet': {'Result': rows, 'totalRecords': str(len(rows))}}
+
+
+class RecordedXNATServer(object):
+    """
+    Function: Local HTTP server that serves the recorded projects as the REST API of XNAT: the login page, the
+              project, subject and experiment listings in JSON and the XML of the experiments. The server runs in
+              a thread until close is called.
+    Parameters:
+        -projects       List    Records of the projects, in the format of test_files/xnat_projects.json.
+        -user           String  User that is shown as logged in.
+
+    Every request is added to requests, as (method, path, query). The experiments in fail_experiments are answered
+    with status 500, and the statuses in fail_statuses are returned for the next requests, one per request, to test
+    the retries of QIBPrototype.tune_session.
+    """
+
+    def __init__(self, projects, user="user"):
+        self.projects = collections.OrderedDict((project['ID'], project) for project in projects)
+        self.experiment_dict = dict((experiment['ID'], experiment) for project in projects
+                                    for subject in project['subjects'] for experiment in subject['experiments'])
+        self.user = user
+        self.requests = []
+        self.fail_experiments = set()
+        self.fail_statuses = []
+        self.lock = threading.Lock()
+        self.server = HTTPServer(('127.0.0.1', 0), RecordedXNATHandler)
+        self.server.recording = self
+        self.url = "http://127.0.0.1:%d" % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def respond(self, method, path, query):
+        """
+        Function: Make the response of a request.
+
+        Returns:
+            - status        Int             HTTP status.
+            - content_type  String          Content type of the body.
+            - body          Bytes           Body of the response.
+        """
+        with self.lock:
+            self.requests.append((method, path, query))
+            if self.fail_statuses:
+                return self.fail_statuses.pop(0), 'text/plain', b'Service unavailable'
+        parts = path.strip('/').split('/')
+        if method == 'DELETE' or parts == ['data', 'JSESSION']:
+            return 200, 'text/plain', b'0123456789ABCDEF'
+        if parts == ['']:
+            return 200, 'text/html', ('<html><body><span id="user_info">Logged in as: &nbsp;<a id="username-link" '
+                                      'href="/app/template/XDATScreen_UpdateUser.vm">' + self.user +
+                                      '</a></span></body></html>').encode('utf-8')
+        if parts == ['data', 'projects']:
+            return self.json([{'ID': project_id, 'URI': '/data/projects/' + project_id} for project_id in self.projects])
+        if parts[:2] == ['data', 'projects'] and len(parts) > 2 and parts[2] in self.projects:
+            project = self.projects[parts[2]]
+            if parts[3:] == ['subjects']:
+                return self.json([{'ID': subject['ID'], 'label': subject['label'], 'project': project['ID'],
+                                   'URI': '/data/subjects/' + subject['ID']} for subject in project['subjects']])
+            if parts[3:] == ['experiments'] or (len(parts) == 6 and parts[3] == 'subjects' and parts[5] == 'experiments'):
+                listing = experiment_listing(project, parts[4] if len(parts) == 6 else None, query)
+                return 200, 'application/json', json.dumps(listing).encode('utf-8')
+        if parts[:2] == ['data', 'experiments'] and len(parts) == 3 and parts[2] in self.experiment_dict:
+            if parts[2] in self.fail_experiments:
+                return 500, 'text/plain', b'Internal server error'
+            return 200, 'text/xml', session_xml(self.experiment_dict[parts[2]])
+        return 404, 'text/plain', b'Not found'
+
+    def json(self, rows):
+        return 200, 'application/json', json.dumps({'ResultSet': {'Result': rows,
+                                                                  'totalRecords': str(len(rows))}}).encode('utf-8')
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class RecordedXNATHandler(BaseHTTPRequestHandler):
+    """
+    Function: Handler of the requests of RecordedXNATServer.
+    """
+
+    def do_GET(self):
+        self.answer('GET')
+
+    def do_DELETE(self):
+        self.answer('DELETE')
+
+    def answer(self, method):
+        url = urlparse(self.path)
+        status, content_type, body = self.server.recording.respond(method, url.path, dict(parse_qsl(url.query)))
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ConnectedProject(object):
+    """
+    Function: Project of an xnatpy connection without the data model, with the parts of an xnatpy project that
+              QIBPrototype uses with --engine rest. The subjects are listed with the connection.
+    """
+
+    def __init__(self, xnat_session, project_id):
+        self.xnat_session = xnat_session
+        self.id = project_id
+
+    @property
+    def subjects(self):
+        result = self.xnat_session.get_json('/data/projects/' + self.id + '/subjects')
+        return Listing((row['label'], FakeRecord({'id': row['ID'], 'label': row['label']}))
+                       for row in result['ResultSet']['Result'])
+
+
+class XNATResponseError(ValueError):
+    """
+    Function: Error of a failed request, like xnat.exceptions.XNATResponseError.
+    """
+
+
+class Listing(collections.OrderedDict):
+    """
+    Function: XNAT listing, values() returns a list like xnatpy does.
+    """
+
+    def values(self):
+        return list(collections.OrderedDict.values(self))
+
+
+class FakeResponse(object):
+    """
+    Function: The parts of a requests response that are used by the response hooks.
+    """
+
+    def __init__(self, size, latency=0.0, content=b''):
+        self.headers = {'Content-Length': str(size)}
+        self.content = content
+        self.elapsed = _Elapsed(latency)
+
+
+class _Elapsed(object):
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def total_seconds(self):
+        return self.seconds
+
+
+class FakeConnection(object):
+
+    def __init__(self, projects, latency=0.0):
+        self.latency = latency
+        self.fail_experiments = set()
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.interface = _Interface()
+        self.experiment_dict = {}
+        self.xml_documents = {}
+        self.projects = Listing()
+        for project in projects:
+            self.projects[project['ID']] = FakeProject(self, project)
+
+    def request(self, data, content=None):
+        """
+        Function: Register a REST request that returns data, or content when it is given.
+        """
+        with self.lock:
+            self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if content is None:
+            response = FakeResponse(len(json.dumps(data)), self.latency)
+        else:
+            response = FakeResponse(len(content), self.latency, content)
+        for hook in self.interface.hooks['response']:
+            hook(response)
+        return response
+
+    def get(self, path, format=None, query=None):
+        parts = path.strip('/').split('/')
+        if parts[:2] != ['data', 'experiments'] or len(parts) != 3 or format != 'xml':
+            raise ValueError("Unknown URI in fake XNAT: " + path)
+        if parts[2] in self.fail_experiments:
+            self.request({})
+            raise XNATResponseError("Invalid response from XNATSession for url " + path + " (status 500)")
+        if parts[2] not in self.xml_documents:
+            self.xml_documents[parts[2]] = session_xml(self.experiment_dict[parts[2]])
+        return self.request(None, self.xml_documents[parts[2]])
+
+    def get_json(self, uri, query=None):
+        parts = uri.strip('/').split('/')
+        if parts[:2] != ['data', 'projects'] or parts[-1] != 'experiments' or len(parts) not in (4, 6):
+            raise ValueError("Unknown URI in fake XNAT: " + uri)
+        result = experiment_listing(self.projects[parts[2]].record, parts[4] if len(parts) == 6 else None, query or {})
+        self.request(result)
+        return result
+
+    def create_object(self, uri):
+        experiment_id = uri.rstrip('/').split('/')[-1]
+        if experiment_id in self.fail_experiments:
+            self.request({})
+            raise XNATResponseError("Invalid response from XNATSession for url " + uri + " (status 500)")
+        experiment = FakeExperiment(self, self.experiment_dict[experiment_id])
+        experiment.load()
+        return experiment
+
+    def disconnect(self):
+        pass
+
+
+class _Interface(object):
+
+    def __init__(self):
+        self.hooks = {'response': []}
+        self.adapters = collections.OrderedDict()
+
+    def mount(self, prefix, adapter):
+        self.adapters[prefix] = adapter
+
+
+class FakeProject(object):
+
+    def __init__(self, connection, record):
+        self.xnat_session = connection
+        self.record = record
+        self.id = record['ID']
+        for subject in record['subjects']:
+            for experiment in subject['experiments']:
+                connection.experiment_dict[experiment['ID']] = experiment
+
+    @property
+    def subjects(self):
+        listing = Listing()
+        for subject in self.record['subjects']:
+            listing[subject['label']] = FakeSubject(self.xnat_session, subject)
+        self.xnat_session.request(self.record['subjects'])
+        return listing
+
+
+class FakeSubject(object):
+
+    def __init__(self, connection, record):
+        self.xnat_session = connection
+        self.record = record
+        self.id = record['ID']
+        self.label = record['label']
+
+
+class FakeExperiment(object):
+    """
+    Function: Experiment that is loaded from the recording on first access of its data.
+    """
+
+    def __init__(self, connection, record):
+        self.xnat_session = connection
+        self.record = record
+        self.id = record['ID']
+        self.label = record['label']
+        self.loaded = False
+
+    def load(self):
+        if not self.loaded:
+            self.loaded = True
+            self.xnat_session.request(self.record)
+
+    def __getattr__(self, name):
+        if name == 'record':
+            raise AttributeError(name)
+        self.load()
+        if name == 'biomarker_categories':
+            categories = collections.OrderedDict()
+            for category in self.record.get('biomarker_categories', []):
+                categories[category['name']] = FakeBiomarkerCategory(category)
+            return categories
+        if name == 'base_sessions':
+            return Listing((str(index), FakeRecord(base_session))
+                           for index, base_session in enumerate(self.record.get('base_sessions', [])))
+        if name in self.record.get('fields', {}):
+            return self.record['fields'][name]
+        raise AttributeError(name)
+
+
+class FakeBiomarkerCategory(object):
+
+    def __init__(self, record):
+        self.biomarkers = collections.OrderedDict((biomarker['name'], FakeRecord(biomarker))
+                                                  for biomarker in record['biomarkers'])
+
+
+class FakeRecord(object):
+
+    def __init__(self, record):
+        self.__dict__.update(record)
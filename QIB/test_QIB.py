@@ -9,32 +9,75 @@ Functions that are tested:
         - Good (test_main_connection)
         - Wrong (test_wrong_connection)
         - not finding project (test_unfound_project)
+   - Read the configuration once (test_config)
    - Create dir structure (test_create_dir_structure)
    - Write params (test_write_params)
    - Write header (test_write_headers)
-   - Obtain data (test_obtain_data)
+   - Obtain data from XNAT, skipped when it is not reachable (test_obtain_data)
+   - Obtain data from the recorded project (test_obtain_data_recorded)
+   - Obtain data with multiple workers (test_obtain_data_workers)
+   - Counting XNAT requests, in total and per session (test_request_counter)
+   - Report of the stages of a run (test_run_report)
+   - Bulk and crawl retrieval give the same data, also over HTTP with xnatpy (test_bulk_retrieval)
+   - Cached sessions are not downloaded again (test_session_cache)
+   - Incremental export of new or changed subjects (test_incremental_export)
+   - Harvesting a synthetic project (test_synthetic_project)
+   - Cache of the xnatpy classes of the XNAT data model (test_schema_cache)
+   - Connection pool, timeout and retries of the XNAT requests (test_http_tuning)
+   - A subject with a failing session is skipped (test_failure_isolation)
+   - A harvest that is killed and resumed from its checkpoint gives the same files (test_checkpoint_resume)
+   - Batch export of several projects over one connection (test_batch_export)
+   - Shards that are merged give the same files as one export (test_shard_merge)
+   - Watch mode exports the new and changed sessions to micro-batches (test_watch)
+   - Filters of the subjects and sessions, before the sessions are downloaded (test_filters)
+   - The rest engine gives the same data and concept tags as the xnatpy engine (test_rest_engine)
+   - Lazy harvest that is stopped early (test_lazy_harvest)
    - if no QIB is present (test_no_QIB)
    - Write meta_data (test_write_meta_data)
+   - Tags are written once per concept and tag name (test_tag_registry)
    - Write data (test_write_data)
+   - Memory use of writing the data does not grow with the number of subjects (test_write_data_streaming)
+   - Columnar store of the data (test_column_store)
+   - Typed values, precision and validation (test_typed_values)
+   - Without --precision the values are written as they are in XNAT (test_default_values)
+   - Streaming and stored columns with numbers and text are written the same (test_mixed_column)
+   - Biomarker table in Parquet and Feather format (test_arrow_writer)
+   - Loading into the staging tables of the tranSMART database (test_database_writer)
    - write logging of subjects
         - New subject (test_write_logging_new_subject)
         - New information (test_write_logging_new_information)
         - Nothing new (test_write_logging_existing_information)
+        - Subject ID that contains another subject ID (test_write_logging_similar_subject)
+   - Importing an existing subject log (test_subject_store_import)
 '''
 
 import unittest
 import QIBPrototype
+import fake_xnat
 from nose.tools import assert_not_equal
 import argparse
+import io
+import json
 import os
 import sys
 if sys.version_info.major == 3:
     import configparser as ConfigParser
 elif sys.version_info.major == 2:
     import ConfigParser
+import random
 import re 
 import time
 import shutil
+import socket
+import tempfile
+import threading
+import requests
+if sys.version_info.major == 3:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from urllib.parse import urlparse
+elif sys.version_info.major == 2:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from urlparse import urlparse
 
 
 class TestQIBDatatypeRetrieval(unittest.TestCase):
@@ -50,6 +93,15 @@ class TestQIBDatatypeRetrieval(unittest.TestCase):
         project, connection = QIBPrototype.make_connection(args)
         return project, connection
 
+    def skip_unreachable(self, conf_file):
+        config = ConfigParser.ConfigParser()
+        config.read(conf_file)
+        url = urlparse(config.get('Connection', 'url'))
+        try:
+            socket.create_connection((url.hostname, url.port or (443 if url.scheme == "https" else 80)), 5).close()
+        except socket.error as e:
+            self.skipTest("The XNAT server " + str(url.hostname) + " is not reachable: " + str(e))
+
     def empty_file(self, file_name):
         with open(file_name, 'w') as file_:
             file_.write("")
@@ -79,6 +131,26 @@ class TestQIBDatatypeRetrieval(unittest.TestCase):
         project, connection = QIBPrototype.make_connection(args)
         self.assertEqual(project, None)
 
+    def test_config(self):
+        parser = argparse.ArgumentParser()
+        parser.add_argument("--params")
+        args = parser.parse_args()
+        args.connection = args.params = args.tags = "test_files/test_confs/test.conf"
+        read_files = []
+        check_file_existence = QIBPrototype.check_file_existence
+        QIBPrototype.check_file_existence = lambda file, type: read_files.append(file) or check_file_existence(file, type)
+        try:
+            config = QIBPrototype.QIBConfig(args)
+        finally:
+            QIBPrototype.check_file_existence = check_file_existence
+        self.assertEqual(read_files, ["test_files/test_confs/test.conf"])
+        self.assertEqual(config.project, "Proof_Study")
+        self.assertEqual(config.study_id, "QIBTEST")
+        self.assertEqual(config.security_required, "N")
+        self.assertEqual(config.tag_list[:2], ["analysis_tool", "analysis_tool_version"])
+        self.assertEqual(config.workers, 1)
+        assert QIBPrototype.as_config(config) is config
+
     def test_create_dir_structure(self):
         parser = argparse.ArgumentParser()
         parser.add_argument("--params")
@@ -140,6 +212,7 @@ class TestQIBDatatypeRetrieval(unittest.TestCase):
         data_structure = [{'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T0\\Left\\1 volume (mm^3)': u'6980.625', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T3\\Right\\entire (masked) image volume (mm^3)': u'2457600.0', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T7\\Right\\1 volume (mm^3)': u'6980.625', 'subject': u'PROOF001', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T0\\Left\\0 volume (mm^3)': u'2450619.375', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T7\\Left\\0 volume (mm^3)': u'2450619.375', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T1\\Right\\1 volume (mm^3)': u'6980.625', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T1\\Left\\1 volume (mm^3)': u'6980.625', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T7\\Left\\1 volume (mm^3)': u'6980.625', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T1\\Right\\entire (masked) image volume (mm^3)': u'2457600.0', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T3\\Left\\entire (masked) image volume (mm^3)': u'2457600.0', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T0\\Right\\entire (masked) image volume (mm^3)': u'2457600.0', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T7\\Left\\entire (masked) image volume (mm^3)': u'2457600.0', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T1\\Left\\0 volume (mm^3)': u'2450619.375', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T0\\Right\\1 volume (mm^3)': u'6980.625', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T3\\Left\\0 volume (mm^3)': u'2450619.375', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T1\\Left\\entire (masked) image volume (mm^3)': u'2457600.0', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T1\\Right\\0 volume (mm^3)': u'2450619.375', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T7\\Right\\0 volume (mm^3)': u'2450619.375', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T0\\Right\\0 volume (mm^3)': u'2450619.375', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T7\\Right\\entire (masked) image volume (mm^3)': u'2457600.0', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T3\\Left\\1 volume (mm^3)': u'6980.625', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T3\\Right\\1 volume (mm^3)': u'6980.625', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T3\\Right\\0 volume (mm^3)': u'2450619.375', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T0\\Left\\entire (masked) image volume (mm^3)': u'2457600.0'}]
         header_test_list = ['subject', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T0\\Left\\1 volume (mm^3)', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T0\\Left\\0 volume (mm^3)', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T0\\Left\\entire (masked) image volume (mm^3)', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T1\\Left\\1 volume (mm^3)', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T1\\Left\\0 volume (mm^3)', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T1\\Left\\entire (masked) image volume (mm^3)', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T3\\Left\\1 volume (mm^3)', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T3\\Left\\0 volume (mm^3)', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T3\\Left\\entire (masked) image volume (mm^3)', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T7\\Left\\1 volume (mm^3)', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T7\\Left\\0 volume (mm^3)', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T7\\Left\\entire (masked) image volume (mm^3)', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T0\\Right\\1 volume (mm^3)', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T0\\Right\\0 volume (mm^3)', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T0\\Right\\entire (masked) image volume (mm^3)', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T1\\Right\\1 volume (mm^3)', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T1\\Right\\0 volume (mm^3)', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T1\\Right\\entire (masked) image volume (mm^3)', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T3\\Right\\1 volume (mm^3)', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T3\\Right\\0 volume (mm^3)', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T3\\Right\\entire (masked) image volume (mm^3)', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T7\\Right\\1 volume (mm^3)', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T7\\Right\\0 volume (mm^3)', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T7\\Right\\entire (masked) image volume (mm^3)']
         conf_file = 'test_files/test_confs/test.conf'
+        self.skip_unreachable(conf_file)
         tag_file = open("test.txt", "w")
         project, connection = self.setup(conf_file)
         parser = argparse.ArgumentParser()
@@ -153,6 +226,694 @@ class TestQIBDatatypeRetrieval(unittest.TestCase):
         self.assertEqual(data_header_list, header_test_list)
         connection.disconnect()
 
+    def test_obtain_data_recorded(self):
+        data_structure = [{'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T0\\Left\\1 volume (mm^3)': 6980.625, 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T3\\Right\\entire (masked) image volume (mm^3)': 2457600.0, 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T7\\Right\\1 volume (mm^3)': 6980.625, 'subject': u'PROOF001', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T0\\Left\\0 volume (mm^3)': 2450619.375, 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T7\\Left\\0 volume (mm^3)': 2450619.375, 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T1\\Right\\1 volume (mm^3)': 6980.625, 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T1\\Left\\1 volume (mm^3)': 6980.625, 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T7\\Left\\1 volume (mm^3)': 6980.625, 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T1\\Right\\entire (masked) image volume (mm^3)': 2457600.0, 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T3\\Left\\entire (masked) image volume (mm^3)': 2457600.0, 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T0\\Right\\entire (masked) image volume (mm^3)': 2457600.0, 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T7\\Left\\entire (masked) image volume (mm^3)': 2457600.0, 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T1\\Left\\0 volume (mm^3)': 2450619.375, 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T0\\Right\\1 volume (mm^3)': 6980.625, 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T3\\Left\\0 volume (mm^3)': 2450619.375, 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T1\\Left\\entire (masked) image volume (mm^3)': 2457600.0, 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T1\\Right\\0 volume (mm^3)': 2450619.375, 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T7\\Right\\0 volume (mm^3)': 2450619.375, 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T0\\Right\\0 volume (mm^3)': 2450619.375, 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T7\\Right\\entire (masked) image volume (mm^3)': 2457600.0, 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T3\\Left\\1 volume (mm^3)': 6980.625, 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T3\\Right\\1 volume (mm^3)': 6980.625, 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T3\\Right\\0 volume (mm^3)': 2450619.375, 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T0\\Left\\entire (masked) image volume (mm^3)': 2457600.0}]
+        header_test_list = ['subject', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T0\\Left\\1 volume (mm^3)', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T0\\Left\\0 volume (mm^3)', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T0\\Left\\entire (masked) image volume (mm^3)', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T1\\Left\\1 volume (mm^3)', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T1\\Left\\0 volume (mm^3)', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T1\\Left\\entire (masked) image volume (mm^3)', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T3\\Left\\1 volume (mm^3)', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T3\\Left\\0 volume (mm^3)', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T3\\Left\\entire (masked) image volume (mm^3)', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T7\\Left\\1 volume (mm^3)', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T7\\Left\\0 volume (mm^3)', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T7\\Left\\entire (masked) image volume (mm^3)', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T0\\Right\\1 volume (mm^3)', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T0\\Right\\0 volume (mm^3)', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T0\\Right\\entire (masked) image volume (mm^3)', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T1\\Right\\1 volume (mm^3)', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T1\\Right\\0 volume (mm^3)', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T1\\Right\\entire (masked) image volume (mm^3)', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T3\\Right\\1 volume (mm^3)', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T3\\Right\\0 volume (mm^3)', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T3\\Right\\entire (masked) image volume (mm^3)', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T7\\Right\\1 volume (mm^3)', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T7\\Right\\0 volume (mm^3)', 'MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1\\Femoral Cartilage Volume T7\\Right\\entire (masked) image volume (mm^3)']
+        tag_file = open("test.txt", "w")
+        connection = fake_xnat.load_connection()
+        args = argparse.Namespace(tags='test_files/test_confs/test.conf')
+        data_list, data_header_list = QIBPrototype.obtain_data(connection.projects["Proof_Study"], tag_file, args)
+        tag_file.close()
+        os.remove(tag_file.name)
+        self.assertEqual(data_structure, data_list)
+        #The numbers are typed, the subject label is not.
+        self.assertEqual(all(isinstance(value, float) for header, value in data_list[0].items() if header != 'subject'), True)
+        self.assertEqual(data_header_list, header_test_list)
+
+    def test_obtain_data_workers(self):
+        args = argparse.Namespace(tags='test_files/test_confs/test.conf')
+        results = {}
+        for workers in [1, 4]:
+            args.workers = workers
+            #The latency makes the sessions of the workers arrive out of order.
+            connection = fake_xnat.synthetic_connection(subjects=12, sessions=4, latency=0.002)
+            with open("test.txt", "w") as tag_file:
+                results[workers] = QIBPrototype.obtain_data(connection.projects["Synthetic"], tag_file, args)
+            connection = fake_xnat.load_connection()
+            with open("test.txt", "w") as tag_file:
+                QIBPrototype.obtain_data(connection.projects["Proof_Study"], tag_file, args)
+            with open("test.txt", "r") as tag_read_file:
+                with open(self.file_path + "tagstest.txt") as tag_test_file:
+                    self.assertEqual(tag_read_file.read(), tag_test_file.read())
+        os.remove("test.txt")
+        self.assertEqual(results[1], results[4])
+        self.assertEqual([data_row_dict['subject'] for data_row_dict in results[4][0]], ["SYN%05d" % i for i in range(12)])
+
+    def test_request_counter(self):
+        connection = fake_xnat.load_connection()
+        request_counter = QIBPrototype.RequestCounter(connection)
+        args = argparse.Namespace(tags='test_files/test_confs/test.conf')
+        with open("test.txt", "w") as tag_file:
+            QIBPrototype.obtain_data(connection.projects["Proof_Study"], tag_file, args)
+        os.remove("test.txt")
+        #The subject listing, the experiment listing of the project and one request per QIB session.
+        self.assertEqual(request_counter.requests, 2 + 8)
+        self.assertEqual(request_counter.requests, connection.requests)
+        assert request_counter.bytes > 0
+        #Every QIB session is downloaded with one request, its metadata is not read from XNAT again.
+        self.assertEqual(sorted(request_counter.session_requests.keys()), ["PROOF_E0000%d" % i for i in range(2, 10)])
+        self.assertEqual(set(request_counter.session_requests.values()), set([1]))
+        connection.disconnect()
+
+    def test_run_report(self):
+        QIBPrototype.run_stats.reset()
+        connection = fake_xnat.load_connection()
+        request_counter = QIBPrototype.RequestCounter(connection)
+        args = argparse.Namespace(tags='test_files/test_confs/test.conf')
+        with open("test.txt", "w") as tag_file:
+            QIBPrototype.obtain_data(connection.projects["Proof_Study"], tag_file, args)
+        os.remove("test.txt")
+        report_file = tempfile.NamedTemporaryFile(suffix=".json", delete=False)
+        report_file.close()
+        QIBPrototype.run_stats.write(report_file.name, request_counter)
+        with open(report_file.name, 'r') as open_report_file:
+            report = json.load(open_report_file)
+        os.remove(report_file.name)
+        self.assertEqual(sorted(report.keys()), ['failed_subjects', 'http', 'peak_memory_mb', 'schema_cache', 'session_latency',
+                                                 'stages', 'wall_seconds'])
+        self.assertEqual(sorted(report['stages'].keys()), ['fetch_session', 'list_experiments', 'obtain_data', 'writeMetaData'])
+        self.assertEqual(report['stages']['list_experiments']['calls'], 1)
+        self.assertEqual(report['stages']['obtain_data']['calls'], 1)
+        self.assertEqual(report['stages']['writeMetaData']['calls'], 8)
+        self.assertEqual(report['session_latency']['count'], 8)
+        assert report['session_latency']['p50'] <= report['session_latency']['p95'] <= report['session_latency']['max']
+        self.assertEqual(report['http'], {'requests': 10, 'bytes': request_counter.bytes, 'request_seconds': request_counter.request_time,
+                                          'sessions_downloaded': 8, 'requests_per_session': 1.0})
+        self.assertEqual(report['failed_subjects'], [])
+        self.assertEqual(report['schema_cache'], "off")
+        if QIBPrototype.resource is not None:
+            #Peak memory in MB (10^6 bytes), a Python process uses more than 1 MB and less than 100 GB.
+            assert 1 < report['peak_memory_mb'] < 1e5
+            rusage_peak = QIBPrototype.resource.getrusage(QIBPrototype.resource.RUSAGE_SELF).ru_maxrss
+            self.assertAlmostEqual(QIBPrototype.peak_memory(),
+                                   rusage_peak / 1e6 if sys.platform == "darwin" else rusage_peak * 1024 / 1e6)
+        self.assertEqual(QIBPrototype.percentile([1, 2, 3, 4], 0.5), 2)
+        self.assertEqual(QIBPrototype.percentile([1, 2, 3, 4], 0.95), 4)
+
+    def test_bulk_retrieval(self):
+        parser = argparse.ArgumentParser()
+        parser.add_argument("--params")
+        args = parser.parse_args()
+        args.tags = 'test_files/test_confs/test.conf'
+        results = {}
+        for retrieval in ["crawl", "bulk"]:
+            connection = fake_xnat.load_connection()
+            args.retrieval = retrieval
+            with open("test.txt", "w") as tag_file:
+                data_list, data_header_list = QIBPrototype.obtain_data(connection.projects["Proof_Study"], tag_file, args)
+            with open("test.txt", "r") as tag_read_file:
+                results[retrieval] = (data_list, data_header_list, tag_read_file.read(), connection.requests)
+        self.assertEqual(results["crawl"][:3], results["bulk"][:3])
+        with open(self.file_path + "tagstest.txt") as tag_test_file:
+            self.assertEqual(results["bulk"][2], tag_test_file.read())
+        assert results["bulk"][3] <= results["crawl"][3]
+
+        #The same over HTTP, with a real xnatpy connection to the recordings on a local server, read with the rest engine.
+        server = fake_xnat.RecordedXNATServer(fake_xnat.load_projects())
+        try:
+            try:
+                connection = QIBPrototype.xnat.connect(server.url, user="user", password="password", no_parse_model=True)
+            except TypeError:
+                self.skipTest("This xnatpy can not connect without the data model.")
+            config = QIBPrototype.QIBConfig(argparse.Namespace(tags='test_files/test_confs/test.conf', engine="rest",
+                                                               retries=2, backoff=0, timeout=10))
+            QIBPrototype.tune_session(connection.interface, config)
+            request_counter = QIBPrototype.RequestCounter(connection)
+            project = fake_xnat.ConnectedProject(connection, "Proof_Study")
+            for retrieval in ["crawl", "bulk"]:
+                config.retrieval = retrieval
+                del server.requests[:]
+                counted_requests = request_counter.requests
+                #The first request is answered with 503, the retries of the mounted adapter hide it.
+                server.fail_statuses.append(503)
+                with open("test.txt", "w") as tag_file:
+                    data_list, data_header_list = QIBPrototype.obtain_data(project, tag_file, config)
+                with open("test.txt", "r") as tag_read_file:
+                    self.assertEqual((data_list, data_header_list, tag_read_file.read()), results[retrieval][:3])
+                listings = [(path, query) for method, path, query in server.requests if path.endswith("/experiments")]
+                if retrieval == "bulk":
+                    self.assertEqual(listings, [("/data/projects/Proof_Study/experiments",
+                                                 {'columns': "ID,label,last_modified,subject_ID", 'format': "json"})])
+                else:
+                    self.assertEqual(listings, [("/data/projects/Proof_Study/subjects/PROOF_S00001/experiments",
+                                                 {'columns': "ID,label,last_modified", 'format': "json"})])
+                self.assertEqual(len([path for method, path, query in server.requests if path.startswith("/data/experiments/")]),
+                                 8)
+                #The response hooks count every response, but not the one that was retried.
+                self.assertEqual(request_counter.requests - counted_requests, len(server.requests) - 1)
+            connection.disconnect()
+        finally:
+            server.close()
+            os.remove("test.txt")
+
+    def test_session_cache(self):
+        parser = argparse.ArgumentParser()
+        parser.add_argument("--params")
+        args = parser.parse_args()
+        args.tags = 'test_files/test_confs/test.conf'
+        args.cache_dir = tempfile.mkdtemp()
+        results = []
+        for run in range(3):
+            connection = fake_xnat.load_connection()
+            project = connection.projects["Proof_Study"]
+            if run == 2:
+                project.record['subjects'][0]['experiments'][1]['last_modified'] = "2017-03-01 09:00:00.000"
+            with open("test.txt", "w") as tag_file:
+                data = QIBPrototype.obtain_data(project, tag_file, args)
+            with open("test.txt", "r") as tag_read_file:
+                results.append((data, tag_read_file.read(), connection.requests))
+        os.remove("test.txt")
+        self.assertEqual(results[0][:2], results[1][:2])
+        self.assertEqual(results[0][:2], results[2][:2])
+        #The warm run only lists the subjects and experiments, the third run also downloads the changed session.
+        self.assertEqual(results[1][2], 2)
+        self.assertEqual(results[2][2], 3)
+
+        shutil.rmtree(args.cache_dir)
+
+        #Two caches on one directory, a hit of one does not lock the database for the other.
+        cache_dir = tempfile.mkdtemp()
+        cache_a = QIBPrototype.SessionCache(cache_dir, 1000000)
+        cache_b = QIBPrototype.SessionCache(cache_dir, 1000000)
+        cache_b.database.execute("PRAGMA busy_timeout = 0")
+        cache_a.put("E1", "2017-02-20", ["tag"], {'label': "one"})
+        self.assertEqual(cache_a.get("E1", "2017-02-20", ["tag"]), {'label': "one"})
+        cache_b.put("E2", "2017-02-20", ["tag"], {'label': "two"})
+        self.assertEqual(cache_b.get("E1", "2017-02-20", ["tag"]), {'label': "one"})
+        #The last use of the hits is written when the cache is closed.
+        self.assertEqual(cache_a.get("E1", "2017-02-20", ["tag"]), {'label': "one"})
+        cache_a.close()
+        last_used = cache_b.database.execute("SELECT experiment_id FROM sessions ORDER BY last_used").fetchall()
+        self.assertEqual(last_used, [("E2",), ("E1",)])
+        cache_b.close()
+        shutil.rmtree(cache_dir)
+
+    def test_incremental_export(self):
+        parser = argparse.ArgumentParser()
+        parser.add_argument("--params")
+        args = parser.parse_args()
+        args.tags = 'test_files/test_confs/test.conf'
+        args.delta = True
+        state_dir = tempfile.mkdtemp()
+        state_file = os.path.join(state_dir, "state.json")
+        results = []
+        for run in range(3):
+            connection = fake_xnat.load_connection()
+            project = connection.projects["Proof_Study"]
+            if run == 2:
+                experiment = project.record['subjects'][0]['experiments'][1]
+                experiment['last_modified'] = "2017-03-01 09:00:00.000"
+                experiment['biomarker_categories'][0]['biomarkers'][0]['value'] = "7000.0"
+            state = QIBPrototype.ExportState(state_file)
+            with open("test.txt", "w") as tag_file:
+                data_list, data_header_list = QIBPrototype.obtain_data(project, tag_file, args, state)
+            state.save()
+            results.append((data_list, connection.requests))
+        os.remove("test.txt")
+        shutil.rmtree(state_dir)
+        self.assertEqual(len(results[0][0]), 1)
+        #Nothing changed, only the subjects and experiments are listed.
+        self.assertEqual(results[1], ([], 2))
+        self.assertEqual(len(results[2][0]), 1)
+        self.assertEqual(results[2][1], 3)
+        self.assertEqual(results[2][0][0]['MultiAtlas Appearance Model Segmentation with Volume Calculation 0.1'
+                                          '\\Femoral Cartilage Volume T0\\Left\\1 volume (mm^3)'], 7000.0)
+
+    def test_synthetic_project(self):
+        connection = fake_xnat.synthetic_connection(subjects=3, sessions=4, categories=2, biomarkers=3)
+        project = connection.projects['Synthetic']
+        config = QIBPrototype.QIBConfig(argparse.Namespace(workers=2))
+        config.tag_list = ['analysis_tool', 'analysis_tool_version', 'description']
+        with open("test.txt", "w") as tag_file:
+            data_list, data_header_list = QIBPrototype.obtain_data(project, tag_file, config)
+        os.remove("test.txt")
+        self.assertEqual([data_row_dict['subject'] for data_row_dict in data_list], ["SYN00000", "SYN00001", "SYN00002"])
+        self.assertEqual(len(data_header_list), 1 + 4 * 2 * 3)
+        self.assertEqual(data_header_list[1], "Synthetic Tool 1.0\\Category 0 T0\\Left\\biomarker 0")
+        #One project listing, one subject listing and one request per QIB session.
+        self.assertEqual(connection.requests, 2 + 3 * 4)
+        self.assertEqual(fake_xnat.synthetic_project(3, 4, 2, 3), fake_xnat.synthetic_project(3, 4, 2, 3))
+
+    def test_schema_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        cache = QIBPrototype.SchemaCache(os.path.join(cache_dir, "schemas"))
+        schemas = [('/xapi/schemas/xnat', '<xs:schema/>'), ('/xapi/schemas/qib', '<xs:schema/>')]
+        key = cache.key("https://xnat.example.org/", schemas)
+        self.assertEqual(key, cache.key("https://xnat.example.org", schemas))
+        self.assertNotEqual(key, cache.key("https://other.example.org", schemas))
+        self.assertNotEqual(key, cache.key("https://xnat.example.org", schemas[:1] + [('/xapi/schemas/qib', '<xs:schema></xs:schema>')]))
+        self.assertEqual(cache.get(key), (None, None))
+
+        #A cached entry is loaded and registered without parsing the schemas.
+        code = ("XNAT_CLASS_LOOKUP = {}\n\n"
+                "class QibSessionData(object):\n"
+                "    @classmethod\n"
+                "    def __register__(cls, target):\n"
+                "        target['qib:qibSessionData'] = cls\n")
+        code_file = cache.put(key, code, ['QibSessionData'])
+        self.assertEqual(cache.get(key), (code_file, ['QibSessionData']))
+        session = argparse.Namespace(XNAT_CLASS_LOOKUP={})
+        download_schemas = QIBPrototype.download_schemas
+        QIBPrototype.download_schemas = lambda xnat_session, extension_types: schemas
+        try:
+            QIBPrototype.run_stats.reset()
+            cache.build_model(session, "https://xnat.example.org")
+        finally:
+            QIBPrototype.download_schemas = download_schemas
+        self.assertEqual(QIBPrototype.run_stats.report()['schema_cache'], "warm")
+        self.assertEqual(list(session.XNAT_CLASS_LOOKUP), ['qib:qibSessionData'])
+        assert session.classes.SESSION is session
+
+        #Changed code is not executed, the entry is generated again.
+        with open(code_file, 'a') as open_code_file:
+            open_code_file.write("raise RuntimeError()\n")
+        self.assertEqual(cache.get(key), (None, None))
+
+        #The code that the parser of xnatpy writes is bytes on Python 2.
+        self.assertEqual(cache.put(key, code.encode('utf-8'), ['QibSessionData']), code_file)
+        self.assertEqual(cache.get(key), (code_file, ['QibSessionData']))
+
+        #Only the versions of xnatpy of which the private functions are known use the cache.
+        connection = fake_xnat.synthetic_connection(subjects=1)
+        connect_calls = []
+        xnat_module = QIBPrototype.xnat
+        version = getattr(xnat_module, "__version__", None)
+        try:
+            QIBPrototype.xnat = argparse.Namespace(__version__="0.3.20.dev1")
+            self.assertEqual(QIBPrototype.xnatpy_version(), (0, 3, 20))
+            QIBPrototype.xnat = xnat_module
+            xnat_module.__version__ = "0.4.0"
+            self.assertEqual(QIBPrototype.xnatpy_version(), (0, 4, 0))
+            self.assertFalse(QIBPrototype.has_model_api())
+        finally:
+            QIBPrototype.xnat = xnat_module
+            if version is None:
+                del xnat_module.__version__
+            else:
+                xnat_module.__version__ = version
+
+        #An xnatpy without the private functions of the cache connects without it.
+        QIBPrototype.xnat = argparse.Namespace(connect=lambda url, **kwargs: connect_calls.append(kwargs) or connection)
+        try:
+            self.assertFalse(QIBPrototype.has_model_api())
+            config = argparse.Namespace(url="https://xnat.example.org", user="user", password="password", schema_cache=cache_dir,
+                                        workers=1, retries=0, backoff=0, timeout=None)
+            self.assertIs(QIBPrototype.connect_xnat(config), connection)
+        finally:
+            QIBPrototype.xnat = xnat_module
+        self.assertEqual(connect_calls, [{'user': "user", 'password': "password"}])
+        shutil.rmtree(cache_dir)
+
+    def test_http_tuning(self):
+        config = QIBPrototype.QIBConfig(argparse.Namespace(workers=16, retries=2, backoff=0, timeout=10))
+        connection = fake_xnat.synthetic_connection(subjects=1)
+        QIBPrototype.tune_session(connection.interface, config)
+        adapter = connection.interface.adapters["https://"]
+        self.assertEqual(adapter.timeout, 10)
+        self.assertEqual(adapter.max_retries.total, 2)
+        self.assertEqual(adapter._pool_maxsize, 16)
+
+        #A server that answers 503 twice before it answers 200, the retries should hide the errors.
+        responses = [503, 503, 200]
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(responses.pop(0))
+                self.send_header('Content-Length', '2')
+                self.end_headers()
+                self.wfile.write(b'{}')
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        session = requests.Session()
+        QIBPrototype.tune_session(session, config)
+        response = session.get("http://127.0.0.1:%d/data/projects" % server.server_port)
+        server.shutdown()
+        server.server_close()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(responses, [])
+
+    def test_failure_isolation(self):
+        QIBPrototype.run_stats.reset()
+        connection = fake_xnat.synthetic_connection(subjects=3, sessions=2)
+        connection.fail_experiments.add("SYN_E00001_02")
+        config = QIBPrototype.QIBConfig(argparse.Namespace(workers=2))
+        config.tag_list = ['analysis_tool']
+        with open("test.txt", "w") as tag_file:
+            data_list, data_header_list = QIBPrototype.obtain_data(connection.projects['Synthetic'], tag_file, config)
+        os.remove("test.txt")
+        self.assertEqual([data_row_dict['subject'] for data_row_dict in data_list], ["SYN00000", "SYN00002"])
+        self.assertEqual(QIBPrototype.run_stats.failed_subjects, ["SYN00001"])
+
+    def export_files(self, connection, config, output_dir):
+        """
+        Write the tags, data and column map of the synthetic project of connection to output_dir, and return their contents.
+        """
+        file_names = [os.path.join(output_dir, name) for name in ("tags.txt", "data.txt", "columns.txt")]
+        with open(file_names[0], 'w') as tag_file:
+            with open(file_names[1], 'w') as data_file:
+                with open(file_names[2], 'w') as concept_file:
+                    data_header_list = []
+                    data_list = QIBPrototype.harvest(connection.projects['Synthetic'], tag_file, config, data_header_list)
+                    for row in QIBPrototype.write_rows(data_file, concept_file, data_list, data_header_list):
+                        pass
+        contents = []
+        for file_name in file_names:
+            with open(file_name, 'rb') as open_file:
+                contents.append(open_file.read())
+        return contents
+
+    def test_checkpoint_resume(self):
+        output_dir = tempfile.mkdtemp()
+        config = QIBPrototype.QIBConfig(argparse.Namespace(checkpoint=os.path.join(output_dir, "checkpoint.db"),
+                                                           checkpoint_interval=2))
+        config.tag_list = ['analysis_tool', 'analysis_tool_version', 'description']
+        connection = fake_xnat.synthetic_connection(subjects=9, sessions=3, tools=4)
+        expected = self.export_files(connection, config, output_dir)
+        request_count = connection.requests
+
+        def kill_after(count):
+            responses = []
+
+            def hook(response, *args, **kwargs):
+                responses.append(response)
+                if len(responses) == count:
+                    raise KeyboardInterrupt("Killed after %d requests" % count)
+            return hook
+
+        for kill_point in random.sample(range(1, request_count), 3):
+            config.resume = False
+            connection = fake_xnat.synthetic_connection(subjects=9, sessions=3, tools=4)
+            connection.interface.hooks['response'].append(kill_after(kill_point))
+            self.assertRaises(KeyboardInterrupt, self.export_files, connection, config, output_dir)
+            config.resume = True
+            connection = fake_xnat.synthetic_connection(subjects=9, sessions=3, tools=4)
+            self.assertEqual(self.export_files(connection, config, output_dir), expected, "Killed after %d requests" % kill_point)
+            #The first checkpoint is saved after two listings and the three sessions of two subjects,
+            #the subjects in it are not downloaded again.
+            if kill_point > 2 + 2 * 3:
+                self.assertLess(connection.requests, request_count)
+        shutil.rmtree(output_dir)
+
+    def test_batch_export(self):
+        output_dir = tempfile.mkdtemp()
+        conf_file = os.path.join(output_dir, "batch_params.conf")
+        with open(conf_file, 'w') as open_conf_file:
+            open_conf_file.write("[Study]\nSTUDY_ID = QIBTEST\nSECURITY_REQUIRED = N\nTOP_NODE = \\Public Studies\\QIBTest\\\n\n"
+                                 "[Directory]\npath = " + output_dir + "/\n")
+        batch_file = os.path.join(output_dir, "batch.conf")
+        with open(batch_file, 'w') as open_batch_file:
+            open_batch_file.write("[Proof_Study]\nSTUDY_ID = PROOF\nTOP_NODE = \\Public Studies\\Proof\\\n\n"
+                                  "[NOQIB]\nSTUDY_ID = NOQIB\nTOP_NODE = \\Public Studies\\NOQIB\\\nSECURITY_REQUIRED = Y\n\n"
+                                  "[Missing]\nSTUDY_ID = MISSING\nTOP_NODE = \\Public Studies\\Missing\\\n")
+        config = QIBPrototype.QIBConfig(argparse.Namespace(params=conf_file, tags='test_files/test_confs/test.conf',
+                                                           batch=batch_file, batch_workers=3, validate=True))
+        self.assertEqual(config.project, None)
+        connection = fake_xnat.load_connection()
+        #The projects are validated and written by the streaming writer, without a ColumnStore of all their subjects.
+        column_store = QIBPrototype.ColumnStore
+
+        class UnusedStore(column_store):
+            def __init__(self):
+                raise AssertionError("A batch export should not store all the subjects.")
+
+        QIBPrototype.ColumnStore = UnusedStore
+        try:
+            summaries = QIBPrototype.export_batch(connection, config)
+        finally:
+            QIBPrototype.ColumnStore = column_store
+        self.assertEqual([summary['study_id'] for summary in summaries], ["PROOF", "NOQIB", "MISSING"])
+        self.assertEqual((summaries[0]['subjects'], summaries[0]['columns']), (1, 24))
+        self.assertEqual((summaries[1]['subjects'], summaries[1]['columns']), (0, 0))
+        assert 'Missing' in summaries[2]['error']
+        with open(os.path.join(output_dir, "PROOF", "clinical", "PROOF_clinical.txt"), 'r') as data_file:
+            self.assertEqual(len(data_file.read().splitlines()), 2)
+        with open(os.path.join(output_dir, "NOQIB", "study.params"), 'r') as study_file:
+            self.assertEqual(study_file.read(), "STUDY_ID=NOQIB\nSECURITY_REQUIRED=Y\nTOP_NODE=\\Public Studies\\NOQIB\\")
+        self.assertEqual(os.path.exists(os.path.join(output_dir, "MISSING")), False)
+        shutil.rmtree(output_dir)
+
+    def test_shard_merge(self):
+        output_dir = tempfile.mkdtemp()
+
+        def config(directory, **options):
+            conf_file = os.path.join(output_dir, directory + ".conf")
+            with open(conf_file, 'w') as open_conf_file:
+                open_conf_file.write("[Study]\nSTUDY_ID = QIBTEST\nSECURITY_REQUIRED = N\nTOP_NODE = \\Public Studies\\QIBTest\\\n\n"
+                                     "[Directory]\npath = " + os.path.join(output_dir, directory) + "/\n")
+            return QIBPrototype.QIBConfig(argparse.Namespace(params=conf_file, tags='test_files/test_confs/test.conf',
+                                                             **options))
+
+        def study_files(directory):
+            contents = {}
+            for root, directories, files in os.walk(os.path.join(output_dir, directory, "QIBTEST")):
+                for file_name in files:
+                    with open(os.path.join(root, file_name), 'rb') as open_file:
+                        contents[os.path.relpath(os.path.join(root, file_name), output_dir + "/" + directory)] = open_file.read()
+            return contents
+
+        def export_shards(project, run, **options):
+            QIBPrototype.export_project(project, config(run + "single", **options))
+            shard_files = []
+            for shard in range(1, 4):
+                summary = QIBPrototype.export_project(project, config(run + "shards", shard="%d/3" % shard, **options))
+                assert 0 < summary['subjects'] < 12
+                shard_files.append(summary['path'])
+            self.assertEqual(sorted(os.listdir(os.path.join(output_dir, run + "shards"))),
+                             ["QIBTEST_shard_1_of_3.jsonl", "QIBTEST_shard_2_of_3.jsonl", "QIBTEST_shard_3_of_3.jsonl"])
+            summary = QIBPrototype.merge_shards(config(run + "merged", merge=list(reversed(shard_files)), **options))
+            self.assertEqual((summary['subjects'], summary['columns']), (12, 4 * 3 * 2 * 3))
+            expected = study_files(run + "single")
+            self.assertEqual(len(expected), 6)
+            self.assertEqual(study_files(run + "merged"), expected)
+            return shard_files, expected
+
+        shard_files, expected = export_shards(fake_xnat.synthetic_connection(subjects=12, sessions=3, tools=4).projects['Synthetic'], "")
+        self.assertRaises(ValueError, QIBPrototype.merge_shards, config("merged", merge=shard_files[:2]))
+
+        #With the concept tags, as when run as script, the concepts get the accession identifier of the first session that
+        #has them. The first sessions of two of the tools have no base session here, a later session in another shard has one.
+        project = fake_xnat.synthetic_connection(subjects=12, sessions=3, tools=4).projects['Synthetic']
+        for subject in project.record['subjects'][:2]:
+            for experiment in subject['experiments']:
+                experiment.pop('base_sessions', None)
+        shard_files, expected = export_shards(project, "concept_tags_", concept_tags=True)
+        tags = expected[os.path.join("QIBTEST", "tags", "tags.txt")].decode('utf-8')
+        self.assertEqual(tags.count("\taccession identifier\tSYN_E00004_00\t"), 0)
+        self.assertEqual(tags.count("\taccession identifier\t"), 2 * 3 * 2 * 3)
+        #Shards in the same directory have their own checkpoint.
+        self.assertEqual(config("shards", shard="2/3", checkpoint="QIBcheckpoint.db").checkpoint, "QIBcheckpoint_QIBTEST_2_of_3.db")
+        shutil.rmtree(output_dir)
+
+    def test_watch(self):
+        output_dir = tempfile.mkdtemp()
+        conf_file = os.path.join(output_dir, "watch_params.conf")
+        with open(conf_file, 'w') as open_conf_file:
+            open_conf_file.write("[Study]\nSTUDY_ID = QIBTEST\nSECURITY_REQUIRED = N\nTOP_NODE = \\Public Studies\\QIBTest\\\n\n"
+                                 "[Directory]\npath = " + output_dir + "/\n")
+        config = QIBPrototype.QIBConfig(argparse.Namespace(params=conf_file, tags='test_files/test_confs/test.conf', watch=True,
+                                                           incremental=os.path.join(output_dir, "state.json"),
+                                                           debounce=0.3, webhook=0))
+        self.assertEqual(config.delta, True)
+        connection = fake_xnat.synthetic_connection(subjects=4, sessions=2)
+        wake = threading.Event()
+        stop = threading.Event()
+        exported = threading.Event()
+        batches = []
+
+        def on_batch(summaries):
+            batches.append(summaries[-1])
+            exported.set()
+
+        def wait_for_batch():
+            exported.wait(10)
+            exported.clear()
+            return batches[-1]
+
+        watch_thread = threading.Thread(target=QIBPrototype.watch, args=(connection.projects['Synthetic'], config, wake, stop,
+                                                                         on_batch))
+        watch_thread.daemon = True
+        start = time.time()
+        watch_thread.start()
+        try:
+            self.assertEqual(wait_for_batch()['subjects'], 4)
+            #The first export waits until the listing did not change for the debounce time.
+            self.assertGreaterEqual(time.time() - start, 0.3)
+
+            experiment = connection.experiment_dict["SYN_E00002_01"]
+            experiment['last_modified'] = '2017-03-01 09:00:00.000'
+            experiment['biomarker_categories'][0]['biomarkers'][0]['value'] = '1.5'
+            QIBPrototype.run_stats.reset()
+            wake.set()
+            summary = wait_for_batch()
+            self.assertEqual(summary['subjects'], 1)
+            #Only the changed session is downloaded.
+            self.assertEqual(len(QIBPrototype.run_stats.session_times), 1)
+            with open(os.path.join(summary['path'], "clinical", "QIBTEST_clinical.txt"), 'r') as data_file:
+                lines = data_file.read().splitlines()
+            self.assertEqual([line.split("\t")[0] for line in lines], ["subject", "SYN00002"])
+            self.assertEqual(len([name for name in os.listdir(output_dir) if name.startswith("batch_")]), 2)
+        finally:
+            stop.set()
+            wake.set()
+            watch_thread.join(10)
+        self.assertEqual(watch_thread.is_alive(), False)
+        self.assertEqual(len(batches), 2)
+
+        #An empty micro-batch is only logged, the watch does not stop.
+        stdout = sys.stdout
+        sys.stdout = output = io.StringIO() if sys.version_info.major == 3 else io.BytesIO()
+        try:
+            self.assertEqual(QIBPrototype.export_project(connection.projects['Synthetic'], config)['subjects'], 0)
+        finally:
+            sys.stdout = stdout
+        self.assertEqual("No new or changed subjects" in output.getvalue(), False)
+
+        #A POST to the webhook wakes the watch.
+        server = QIBPrototype.start_webhook(0, wake)
+        wake.clear()
+        response = requests.post("http://127.0.0.1:%d/" % server.server_address[1], data='{"event": "qib"}')
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(wake.wait(5), True)
+        server.shutdown()
+        server.server_close()
+
+        #A micro-batch with invalid values is logged and tried again, the watch keeps running.
+        config = QIBPrototype.QIBConfig(argparse.Namespace(params=conf_file, tags='test_files/test_confs/test.conf', watch=True,
+                                                           incremental=os.path.join(output_dir, "validate_state.json"),
+                                                           debounce=0, validate=True))
+        connection = fake_xnat.synthetic_connection(subjects=2, sessions=1)
+        experiment = connection.experiment_dict["SYN_E00001_01"]
+        experiment['biomarker_categories'][0]['biomarkers'][0]['value'] = 'NaN'
+        checked = threading.Event()
+        check_values = QIBPrototype.check_values
+
+        def checked_values(problems):
+            valid = check_values(problems)
+            checked.set()
+            return valid
+
+        QIBPrototype.check_values = checked_values
+        stop.clear()
+        wake.clear()
+        watch_thread = threading.Thread(target=QIBPrototype.watch, args=(connection.projects['Synthetic'], config, wake, stop,
+                                                                         on_batch))
+        watch_thread.daemon = True
+        watch_thread.start()
+        try:
+            self.assertEqual(checked.wait(10), True)
+            self.assertEqual(len(batches), 2)
+            experiment['biomarker_categories'][0]['biomarkers'][0]['value'] = '2.5'
+            wake.set()
+            self.assertEqual(wait_for_batch()['subjects'], 2)
+            self.assertEqual(watch_thread.is_alive(), True)
+        finally:
+            QIBPrototype.check_values = check_values
+            stop.set()
+            wake.set()
+            watch_thread.join(10)
+        self.assertEqual(watch_thread.is_alive(), False)
+
+        #Without --watch the export stops after the harvest, the clinical data and the column map are not written.
+        experiment['biomarker_categories'][0]['biomarkers'][0]['value'] = 'NaN'
+        config = QIBPrototype.QIBConfig(argparse.Namespace(params=conf_file, tags='test_files/test_confs/test.conf', validate=True))
+        self.assertRaises(SystemExit, QIBPrototype.export_project, connection.projects['Synthetic'], config)
+        self.assertEqual(os.path.getsize(os.path.join(output_dir, "QIBTEST", "clinical", "QIBTEST_clinical.txt")), 0)
+        with open(os.path.join(output_dir, "QIBTEST", "clinical", "QIBTEST_columns.txt"), 'r') as concept_file:
+            self.assertEqual(len(concept_file.read().splitlines()), 1)
+        shutil.rmtree(output_dir)
+
+    def test_filters(self):
+        output_dir = tempfile.mkdtemp()
+        subjects_file = os.path.join(output_dir, "subjects.txt")
+        with open(subjects_file, 'w') as open_subjects_file:
+            open_subjects_file.write("# Subjects to export\nSYN00001\n\nSYN00003\nSYN00099\n")
+
+        def harvest(**options):
+            connection = fake_xnat.synthetic_connection(subjects=6, sessions=4, tools=2)
+            config = QIBPrototype.QIBConfig(argparse.Namespace(**options))
+            config.tag_list = ['analysis_tool']
+            QIBPrototype.run_stats.reset()
+            data_list = QIBPrototype.obtain_data(connection.projects['Synthetic'], None, config)
+            subjects = [data_row_dict['subject'] for data_row_dict in data_list[0]] if data_list else []
+            return subjects, len(QIBPrototype.run_stats.session_times)
+
+        self.assertEqual(harvest(), (["SYN00000", "SYN00001", "SYN00002", "SYN00003", "SYN00004", "SYN00005"], 24))
+        self.assertEqual(harvest(subjects_file=subjects_file), (["SYN00001", "SYN00003"], 8))
+        self.assertEqual(harvest(analysis_tool="Synthetic Tool 1.1", retrieval="crawl"), (["SYN00001", "SYN00003", "SYN00005"], 12))
+        self.assertEqual(harvest(analysis_tool="Synthetic Tool"), harvest())
+        self.assertEqual(harvest(label_pattern="_L_T[01]$", workers=2), (["SYN00000", "SYN00001", "SYN00002", "SYN00003", "SYN00004", "SYN00005"], 12))
+        self.assertEqual(harvest(since="2017-02-21"), ([], 0))
+        self.assertEqual(harvest(since="2017-02-20 14:11:00")[1], 24)
+
+        #Without the analysis tool in the listing, the sessions of other tools are left out after the download.
+        analysis_tool_columns = QIBPrototype.ANALYSIS_TOOL_COLUMNS
+        QIBPrototype.ANALYSIS_TOOL_COLUMNS = 'qib:qibSessionData/description'
+        try:
+            self.assertEqual(harvest(analysis_tool="Synthetic Tool 1.1"), (["SYN00001", "SYN00003", "SYN00005"], 24))
+        finally:
+            QIBPrototype.ANALYSIS_TOOL_COLUMNS = analysis_tool_columns
+        shutil.rmtree(output_dir)
+
+    def test_rest_engine(self):
+        def harvest(connection, project_name, **options):
+            config = QIBPrototype.QIBConfig(argparse.Namespace(**options))
+            config.tag_list = QIBPrototype.QIBConfig(argparse.Namespace(tags='test_files/test_confs/test.conf')).tag_list
+            tag_registry = QIBPrototype.TagRegistry()
+            data_list, data_header_list = QIBPrototype.obtain_data(connection.projects[project_name], tag_registry, config)
+            return data_list, data_header_list, tag_registry.entries
+
+        connection = fake_xnat.load_connection()
+        self.assertEqual(harvest(connection, "Proof_Study", engine="rest"), harvest(connection, "Proof_Study"))
+        connection = fake_xnat.synthetic_connection(subjects=5, sessions=4, tools=2)
+        request_count = connection.requests
+        self.assertEqual(harvest(connection, "Synthetic", engine="rest", workers=2), harvest(connection, "Synthetic"))
+        #One request per QIB session with both engines.
+        self.assertEqual(connection.requests - request_count, 2 * (2 + 5 * 4))
+
+        connection.fail_experiments.add("SYN_E00001_02")
+        data_list = harvest(connection, "Synthetic", engine="rest")[0]
+        self.assertEqual([data_row_dict['subject'] for data_row_dict in data_list], ["SYN00000", "SYN00002", "SYN00003", "SYN00004"])
+
+        xml = fake_xnat.session_xml(fake_xnat.load_connection().experiment_dict["PROOF_E00002"])
+        self.assertEqual(QIBPrototype.parse_session_xml(io.BytesIO(xml), [])['accession_identifier'], "PROOF_E00001")
+
+        #With the concept tags, as when run as script, both engines write the ontology and accession identifier tags
+        #of every concept, see test_files/concepttagstest.txt.
+        for engine in ["xnatpy", "rest"]:
+            with open("test.txt", "w") as tag_file:
+                QIBPrototype.obtain_data(fake_xnat.load_connection().projects["Proof_Study"], tag_file,
+                                         argparse.Namespace(tags='test_files/test_confs/test.conf', engine=engine, concept_tags=True))
+            with open("test.txt", "r") as tag_read_file:
+                with open(self.file_path + "concepttagstest.txt") as tag_test_file:
+                    self.assertEqual(tag_read_file.read(), tag_test_file.read())
+        os.remove("test.txt")
+
+        #Names as elements, after the biomarkers, and no namespace.
+        xml = (b"<QIBSession label='S_QIB_R_T2'><analysis_tool>Tool</analysis_tool><biomarker_categories><biomarker_category>"
+               b"<biomarkers><biomarker><value>1.5</value><name>volume</name></biomarker></biomarkers><name>Hippocampus</name>"
+               b"</biomarker_category></biomarker_categories><description/></QIBSession>")
+        session_info = QIBPrototype.parse_session_xml(io.BytesIO(xml), ['description', 'reviewer'])
+        self.assertEqual(session_info, {'label': 'S_QIB_R_T2', 'concept_key': 'Tool', 'tags': [('description', None), ('reviewer', None)],
+                                        'missing_tags': [], 'biomarkers': [('Hippocampus', 'volume', '1.5', None, None)],
+                                        'accession_identifier': None})
+
+    def test_lazy_harvest(self):
+        connection = fake_xnat.synthetic_connection(subjects=100, sessions=4)
+        config = QIBPrototype.QIBConfig(argparse.Namespace(workers=2))
+        config.tag_list = ['analysis_tool']
+        QIBPrototype.run_stats.reset()
+        data_iterator = QIBPrototype.DataIterator(connection.projects['Synthetic'], config)
+        subjects = [next(data_iterator)['subject'] for index in range(3)]
+        data_iterator.close()
+        self.assertEqual(subjects, ["SYN00000", "SYN00001", "SYN00002"])
+        self.assertEqual(len(data_iterator.data_header_list), 1 + 4 * 2 * 3)
+        #Only the sessions of the subjects that were read and the prefetched sessions are downloaded.
+        self.assertLessEqual(len(QIBPrototype.run_stats.session_times), 3 * 4 + 2 * QIBPrototype.PREFETCH_PER_WORKER)
 
     def test_no_QIB(self):
         config = ConfigParser.ConfigParser()
@@ -186,6 +947,31 @@ class TestQIBDatatypeRetrieval(unittest.TestCase):
         os.remove(tag_file.name)
         connection.disconnect()
 
+    def test_tag_registry(self):
+        tag_file = open("test.txt", "w")
+        tag_registry = QIBPrototype.TagRegistry(tag_file)
+        self.assertTrue(tag_registry.add("Tool\\Volume T0", "Reviewer", "Jarno", 2))
+        self.assertFalse(tag_registry.add("Tool\\Volume T0", "Reviewer", "Someone else", 1))
+        QIBPrototype.writeOntologyTag("Volume", "http://example.org/volume", "Tool\\Volume T0", tag_registry, "ACC001")
+        QIBPrototype.writeOntologyTag("Volume", "http://example.org/volume", "Tool\\Volume T0", tag_registry, "ACC001")
+        self.assertTrue(("Tool\\Volume T0", "accession identifier") in tag_registry)
+        self.assertEqual(len(tag_registry), 4)
+        tag_file.close()
+        with open("test.txt", "r") as tag_read_file:
+            self.assertEqual(tag_read_file.read(), "Tool\\Volume T0\tReviewer\tJarno\t2\n"
+                                                   "Tool\\Volume T0\tOntology name\tVolume\t1\n"
+                                                   "Tool\\Volume T0\tOntology IRI\thttp://example.org/volume\t1\n"
+                                                   "Tool\\Volume T0\taccession identifier\tACC001\t2\n")
+        os.remove(tag_file.name)
+
+        data_header_list = ["subject"]
+        header_registry = QIBPrototype.OrderedRegistry(data_header_list)
+        self.assertFalse(header_registry.add("subject"))
+        self.assertTrue(header_registry.add("b"))
+        self.assertTrue(header_registry.add("a"))
+        self.assertEqual(data_header_list, ["subject", "b", "a"])
+        self.assertTrue("a" in header_registry)
+
     def test_write_data(self):
         data_file_name = "writedata.txt"
         concept_file_name = "writeconcepts.txt"
@@ -203,6 +989,214 @@ class TestQIBDatatypeRetrieval(unittest.TestCase):
             with open(self.file_path+ "concepttest.txt", 'r') as  concept_test_file:
                 self.assertEqual(concept_final_file.read(), concept_test_file.read())
 
+    def test_column_store(self):
+        data_list = [{"subject": "s1", "volume": "6980.625", "side": "Left"}, {"subject": "s2", "side": "1e3"},
+                     {"subject": "s3", "volume": "2457600.0"}]
+        store = QIBPrototype.ColumnStore()
+        for data_row_dict in data_list:
+            store.append(data_row_dict)
+        self.assertEqual(list(store.rows()), [{"subject": "s1", "volume": 6980.625, "side": "Left"},
+                                              {"subject": "s2", "side": "1e3"}, {"subject": "s3", "volume": 2457600.0}])
+        self.assertEqual(store.column("volume"), [6980.625, None, 2457600.0])
+        self.assertEqual(store.column("side"), ["Left", "1e3", None])
+        self.assertEqual(store.summary("volume"), {'count': 2, 'min': 6980.625, 'max': 2457600.0,
+                                                   'mean': (6980.625 + 2457600.0) / 2})
+        self.assertEqual(store.summary("side"), None)
+
+        data_file = open("writedata.txt", 'w')
+        concept_file = open("writeconcepts.txt", 'w')
+        QIBPrototype.write_data(data_file, concept_file, store, ["subject", "volume", "side"])
+        concept_file.close()
+        with open("writedata.txt", 'r') as data_final_file:
+            self.assertEqual(data_final_file.read(), "subject\tvolume\tside\ns1\t6980.625\tLeft\ns2\t\t1e3\ns3\t2457600.0\t\n")
+
+    def test_typed_values(self):
+        self.assertEqual(QIBPrototype.biomarker_value(u"6980.625"), 6980.625)
+        self.assertEqual(QIBPrototype.biomarker_value(12), 12.0)
+        self.assertEqual(QIBPrototype.biomarker_value(" "), None)
+        self.assertEqual(QIBPrototype.biomarker_value(None), None)
+        self.assertEqual(QIBPrototype.biomarker_value("Left"), "Left")
+        self.assertEqual(QIBPrototype.format_value(2457600.0), "2457600.0")
+        self.assertEqual(QIBPrototype.format_value(6980.625, 2), "6980.62")
+        self.assertEqual(QIBPrototype.format_value(float("nan")), "")
+        self.assertEqual(QIBPrototype.format_value(None), "")
+
+        store = QIBPrototype.ColumnStore()
+        for volume in [6980.625, None, float("nan"), float("inf"), -1.0]:
+            store.append({"subject": "s", "volume": volume, "side": "Left"})
+        volumes = store.column("volume")
+        self.assertTrue(volumes[2] != volumes[2])
+        self.assertEqual(volumes[:2] + volumes[3:], [6980.625, None, float("inf"), -1.0])
+        self.assertEqual(store.validate(), {"volume": {"nan": 1, "infinite": 1}})
+        self.assertEqual(store.validate((0, 1e7)), {"volume": {"nan": 1, "infinite": 1, "out_of_range": 2}})
+
+        data_file = open("writedata.txt", 'w')
+        concept_file = open("writeconcepts.txt", 'w')
+        QIBPrototype.write_data(data_file, concept_file, [{"subject": "s1", "volume": 6980.625}, {"subject": "s2", "volume": None}],
+                                ["subject", "volume"], precision=1)
+        concept_file.close()
+        with open("writedata.txt", 'r') as data_final_file:
+            self.assertEqual(data_final_file.read(), "subject\tvolume\ns1\t6980.6\ns2\t\n")
+
+    def write_values(self, data_list, data_header_list, precision=None):
+        data_file = open("writedata.txt", 'w')
+        concept_file = open("writeconcepts.txt", 'w')
+        QIBPrototype.write_data(data_file, concept_file, data_list, data_header_list, precision)
+        concept_file.close()
+        with open("writedata.txt", 'r') as data_final_file:
+            return data_final_file.read()
+
+    def test_default_values(self):
+        data_list = [{"subject": "s1", "volume": "1", "count": "1234", "scale": "1e3", "fraction": "0.10", "ratio": "NaN",
+                      "side": "Left"},
+                     {"subject": "s2", "volume": "6980.625", "count": "2457600.0", "scale": "-0.0", "fraction": "1E-7",
+                      "ratio": "inf"},
+                     {"subject": "s3", "side": "Right", "ratio": "12.50"}]
+        data_header_list = ["subject", "volume", "count", "scale", "fraction", "ratio", "side"]
+        typed_list = [dict((header, value if header == "subject" else QIBPrototype.biomarker_value(value))
+                           for header, value in data_row_dict.items()) for data_row_dict in data_list]
+        self.assertEqual(typed_list[0]["count"], 1234.0)
+        store = QIBPrototype.ColumnStore()
+        for data_row_dict in typed_list:
+            store.append(data_row_dict)
+        #Without --precision the values are written as they were read from XNAT, by the streaming writer, from the
+        #store and after a round trip through the checkpoint, the same as test_files/valuestest.txt of the string values.
+        with open(self.file_path + "valuestest.txt", 'r') as values_test_file:
+            expected = values_test_file.read()
+        self.assertEqual(self.write_values(iter(typed_list), data_header_list), expected)
+        self.assertEqual(self.write_values(store, data_header_list), expected)
+        self.assertEqual(self.write_values([QIBPrototype.load_row(json.loads(json.dumps(QIBPrototype.dump_row(data_row_dict))))
+                                            for data_row_dict in typed_list], data_header_list), expected)
+        self.assertEqual(QIBPrototype.format_value(QIBPrototype.biomarker_value("  5 ")), "5")
+
+    def test_mixed_column(self):
+        data_list = [{"subject": "s1", "volume": QIBPrototype.biomarker_value("1.23456")},
+                     {"subject": "s2", "volume": "N/A"},
+                     {"subject": "s3", "volume": float("nan")},
+                     {"subject": "s4", "volume": QIBPrototype.biomarker_value("7")}]
+        store = QIBPrototype.ColumnStore()
+        for data_row_dict in data_list:
+            store.append(data_row_dict)
+        self.assertEqual(store.column("volume")[3], 7.0)
+        self.assertEqual(store.validate(), {"volume": {"nan": 1}})
+        for precision, expected in [(2, "subject\tvolume\ns1\t1.23\ns2\tN/A\ns3\t\ns4\t7.00\n"),
+                                    (None, "subject\tvolume\ns1\t1.23456\ns2\tN/A\ns3\t\ns4\t7\n")]:
+            self.assertEqual(self.write_values(iter(data_list), ["subject", "volume"], precision), expected)
+            self.assertEqual(self.write_values(store, ["subject", "volume"], precision), expected)
+
+    @unittest.skipIf(QIBPrototype.pyarrow is None, "pyarrow is not installed")
+    def test_arrow_writer(self):
+        concept_key = "Tool 0.1\\Femoral Cartilage Volume T0\\Left\\1 volume (mm^3)"
+        store = QIBPrototype.ColumnStore()
+        store.append({"subject": "s1", concept_key: "6980.625"})
+        store.append({"subject": "s2"})
+        tag_registry = QIBPrototype.TagRegistry()
+        tag_registry.add("Tool 0.1", "description", "Segmentation", 2)
+        tag_registry.add(concept_key, "Ontology name", "Volume", 1)
+        parser = argparse.ArgumentParser()
+        parser.add_argument("--params")
+        args = parser.parse_args()
+        args.params = 'test_files/test_confs/test.conf'
+        path = tempfile.mkdtemp()
+        for file_format, read_table in [("parquet", QIBPrototype.pyarrow.parquet.read_table),
+                                        ("feather", QIBPrototype.pyarrow.feather.read_table)]:
+            writer = QIBPrototype.make_writer(file_format, path, args)
+            writer.write(store, ["subject", concept_key], tag_registry)
+            writer.close()
+            self.assertEqual(writer.file_name, os.path.join(path, "QIBTEST_biomarkers." + file_format))
+            table = read_table(writer.file_name)
+            self.assertEqual(table.column_names, ["subject", concept_key])
+            self.assertEqual(table.column("subject").to_pylist(), ["s1", "s2"])
+            self.assertEqual(table.column(concept_key).to_pylist(), [6980.625, None])
+            field = table.schema.field(concept_key)
+            self.assertEqual(field.type, QIBPrototype.pyarrow.float64())
+            self.assertEqual(field.metadata, {b"concept_path": b"Tool 0.1\\Femoral Cartilage Volume T0\\Left",
+                                              b"data_label": b"1 volume (mm^3)", b"description": b"Segmentation",
+                                              b"Ontology name": b"Volume"})
+        shutil.rmtree(path)
+
+    def test_database_writer(self):
+        connection = fake_xnat.synthetic_connection(subjects=5, sessions=2, biomarkers=2)
+        config = QIBPrototype.QIBConfig(argparse.Namespace(params='test_files/test_confs/test.conf', format=["database"],
+                                                           database="sqlite:" + os.path.join(tempfile.mkdtemp(), "transmart.db")))
+        config.tag_list = ['description']
+        tag_registry = QIBPrototype.TagRegistry()
+        data_list, data_header_list = QIBPrototype.obtain_data(connection.projects['Synthetic'], tag_registry, config)
+        data_list[1] = dict(data_list[1], **{data_header_list[1]: None})
+        database = QIBPrototype.connect_database(config.database)
+        database.execute("PRAGMA busy_timeout = 0")
+        subject_counts = []
+
+        def harvest_rows():
+            for data_row_dict in data_list:
+                #The tables are not locked during the harvest, and still hold the rows of the last load.
+                database.execute("BEGIN IMMEDIATE")
+                subject_counts.append(database.execute("SELECT COUNT(DISTINCT subject_id) FROM lt_src_clinical_data").fetchone()[0])
+                database.rollback()
+                yield data_row_dict
+
+        for repeat in range(2):
+            writer = QIBPrototype.make_writer("database", None, config)
+            writer.write(harvest_rows(), data_header_list, tag_registry)
+            writer.close()
+        self.assertEqual(subject_counts, [0] * len(data_list) + [len(data_list)] * len(data_list))
+        observations = database.execute("SELECT subject_id, category_cd || '\\' || data_label, data_value "
+                                        "FROM lt_src_clinical_data WHERE study_id = 'QIBTEST'").fetchall()
+        self.assertEqual(sorted(observations), sorted((data_row_dict['subject'], header, QIBPrototype.format_value(value))
+                                                      for data_row_dict in data_list for header, value in data_row_dict.items()
+                                                      if header != 'subject' and value is not None))
+        self.assertEqual(database.execute("SELECT category_cd || '\\' || data_label, column_number FROM lt_src_column_map "
+                                          "ORDER BY column_number").fetchall(),
+                         [(header, index + 1) for index, header in enumerate(data_header_list) if header != 'subject'])
+        self.assertEqual(database.execute("SELECT concept_path, title, description, weight FROM lt_src_tags").fetchall(),
+                         [(concept_key, tag, str(value), weight) for concept_key, tag, value, weight in tag_registry.entries])
+
+        def failing_rows():
+            yield data_list[0]
+            raise ValueError("harvest failed")
+
+        #A failed load leaves the study as it was.
+        writer = QIBPrototype.DatabaseWriter(config)
+        self.assertRaises(ValueError, writer.write, failing_rows(), data_header_list, tag_registry)
+        writer.close()
+        self.assertEqual(database.execute("SELECT COUNT(*) FROM lt_src_clinical_data").fetchone()[0], len(observations))
+        database.close()
+        shutil.rmtree(os.path.dirname(config.database[len("sqlite:"):]))
+
+    @unittest.skipIf(sys.version_info.major == 2, "tracemalloc is not available in Python 2")
+    def test_write_data_streaming(self):
+        import tracemalloc
+
+        def synthetic_harvest(subjects, data_header_list):
+            data_header_list.append('subject')
+            header_set = set()
+            for i in range(subjects):
+                row = {'subject': 'subject%d' % i}
+                for j in range(5):
+                    header = "Tool 0.1\\Category %d T0\\Left\\biomarker" % ((i + j) % 50)
+                    row[header] = "%d.5" % j
+                    if header not in header_set:
+                        header_set.add(header)
+                        data_header_list.append(header)
+                yield row
+
+        peaks = []
+        for subjects in [5000, 50000]:
+            data_header_list = []
+            data_file = open("writedata.txt", 'w')
+            concept_file = open("writeconcepts.txt", 'w')
+            tracemalloc.start()
+            for row in QIBPrototype.write_rows(data_file, concept_file, synthetic_harvest(subjects, data_header_list),
+                                               data_header_list):
+                pass
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+            data_file.close()
+            concept_file.close()
+            with open("writedata.txt", 'r') as data_final_file:
+                self.assertEqual(sum(1 for line in data_final_file), subjects + 1)
+        assert peaks[1] < 2 * peaks[0]
+
     def test_write_logging_new_subject(self):
         rows = [["subject1\t","foo\n"], ["subject2\t", "bar\n"]]
         test_log = ["subject1\tfoo\n","subject2\tbar\n"]
@@ -253,6 +1247,27 @@ class TestQIBDatatypeRetrieval(unittest.TestCase):
                         not_found = False
         assert not_found
 
+    def test_write_logging_similar_subject(self):
+        rows = [["subject1\t","foo\n"], ["subject10\t", "foo\n"]]
+        log_file = (self.file_path + "QIBSubjects.log")
+        self.empty_file(log_file)
+        QIBPrototype.check_subject(rows)
+        with open(log_file, 'r') as open_log_file:
+            log_data = open_log_file.read()
+        assert "New subject: subject10\tfoo\n" in log_data
+
+    def test_subject_store_import(self):
+        store_dir = tempfile.mkdtemp()
+        log_file = os.path.join(store_dir, "QIBSubjects.log")
+        shutil.copy(self.file_path + "testQIBSubjects.log", log_file)
+        store = QIBPrototype.SubjectStore(log_file)
+        assert store.has_subject("subject1\t")
+        assert store.has_row("subject2\t", "subject2\tbar\n")
+        assert not store.has_row("subject2\t", "subject2\tfoo\n")
+        assert not store.has_subject("subject3\t")
+        store.close()
+        shutil.rmtree(store_dir)
+
     @classmethod
     def tearDownClass(self):
         conf_file = 'test_files/test_confs/test.conf'